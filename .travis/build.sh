@@ -4,6 +4,8 @@ set -e
 
 source .travis/common.sh
 
+python3 scripts/check_startup.py
+
 for target in "${TARGET_CONF[@]}"; do
 	echo -e "${PURPLE}[BUILD] CPU: ${C} | Toolchain: ${TC} | Platform: ${P} | Target: ${T} | Firmware: ${F}${NC}"
 	$SPACER
@@ -163,6 +163,7 @@ static void help_debug(void)
 	wputs("  debug sdram_test               - run a memory test");
 #endif
 	wputs("  debug clocks                   - dump pll/mmcm configuration");
+	wputs("  debug cycles                   - show clock cycles since boot");
 #ifdef CSR_HDMI_IN0_BASE
 	wputs("  debug input0 <on/off>          - debug dvisampler0");
 #endif
@@ -1233,6 +1234,8 @@ void ci_service(void)
 		token = get_token(&str);
 		if(strcmp(token, "clocks") == 0)
 			debug_clocks();
+		else if(strcmp(token, "cycles") == 0)
+			uptime_cycles_print();
 #ifdef CSR_GENERATOR_BASE
 		else if(strcmp(token, "sdram_test") == 0) bist_test();
 #endif
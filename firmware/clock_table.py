@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Generates clock_table.h, the clock generator settings for the pixel clocks
+of the video modes in processor.c, so they don't have to be searched at
+runtime. The solver is in scripts/targets/utils.py.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FIRMWARE_DIR, "..", "scripts"))
+
+from targets.utils import get_pixel_clock_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the clock generator settings of the video modes")
+    parser.add_argument("output", help="clock_table.h to write")
+    args = parser.parse_args()
+    with open(os.path.join(FIRMWARE_DIR, "processor.c"), "r") as f:
+        source = f.read()
+    # The modes, without the custom mode which is only known at runtime
+    modes = source[source.index("video_modes[PROCESSOR_MODE_COUNT]"):]
+    pixel_clocks = [int(clock) for clock in re.findall(r"\.pixel_clock\s*=\s*(\d+)", modes)]
+    with open(args.output, "w") as f:
+        f.write(get_pixel_clock_table(pixel_clocks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Generates edid_table.h, the EDIDs of the HDMI inputs for every pair of
+video modes in processor.c and the refresh rates of the modes, so the
+firmware copies them instead of building them when the mode changes.
+
+generate_edid() and calculate_refresh_rate() of edid.c are mirrored
+below. With --check, edid.c and the generated table are compiled for the
+host, and their EDIDs for all the modes are compared with each other and
+with the Python ones.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EDID_LENGTH = 128
+EDID_DESCRIPTOR_LENGTH = 18
+EDID_DATA_BLOCKS_OFFSET = 54
+EDID_HEADER = bytes([0x00, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x00])
+MAX_DESCRIPTOR_DATA_LEN = 13
+DESCRIPTOR_DUMMY = 0x10
+DESCRIPTOR_MONITOR_NAME = 0xfc
+DESCRIPTOR_MONITOR_RANGE = 0xfd
+
+TIMING_FIELDS = [
+    "pixel_clock",
+    "h_active", "h_blanking", "h_sync_offset", "h_sync_width",
+    "v_active", "v_blanking", "v_sync_offset", "v_sync_width",
+    "flags", "established_timing",
+]
+
+
+def read_source(name):
+    with open(os.path.join(FIRMWARE_DIR, name), "r") as f:
+        return f.read()
+
+
+def get_defines(source):
+    return {name: int(value, 0) for name, value in
+            re.findall(r"#define\s+(\w+)\s+(0b[01]+|0x[0-9a-fA-F]+|\d+)\s*$", source, re.M)}
+
+
+def parse_video_modes(source, defines):
+    """
+    Returns the modes of video_modes[] in processor.c as dicts of their
+    timing fields, "comment" (the first comment line above the mode) and
+    "conditions" (the preprocessor conditions the mode is under).
+    """
+    start = source.index("video_modes[PROCESSOR_MODE_COUNT]")
+    start = source.index("{", start) + 1
+    end = source.index("\n};", start)
+    modes = []
+    conditions = []
+    comment = None
+    mode = None
+    for line in source[start:end].splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            # Comments only describe the mode right below them
+            comment = None
+        if line.startswith("#if"):
+            conditions.append(line)
+        elif line.startswith("#endif"):
+            conditions.pop()
+        elif line.startswith("#"):
+            raise Exception("Unsupported preprocessor line in video_modes: {}".format(line))
+        elif mode is None:
+            if line.startswith("//") and comment is None:
+                comment = line[2:].strip()
+            elif line == "{":
+                mode = dict.fromkeys(TIMING_FIELDS, 0)
+                mode["comment"] = comment
+                mode["conditions"] = list(conditions)
+        elif line.startswith("}"):
+            modes.append(mode)
+            mode = None
+            comment = None
+        else:
+            m = re.match(r"\.(\w+)\s*=\s*([^,\"]+?)\s*,?$", line)
+            if m and m.group(1) in TIMING_FIELDS:
+                value = 0
+                for term in m.group(2).split("|"):
+                    term = term.strip()
+                    value |= defines[term] if term in defines else int(term, 0)
+                mode[m.group(1)] = value
+    return modes
+
+
+def parse_edid_inputs(source):
+    """
+    Returns the generate_edid() arguments edid_set_mode() in processor.c
+    uses for each HDMI input: manufacturer, product code, year and name.
+    """
+    return [(mfg, product, int(year), name) for mfg, product, year, name in
+            re.findall(r'generate_edid\(&edid, "(\w{3})", "(\w{2})", (\d+), "([^"]*)"', source)]
+
+
+def calculate_refresh_rate(mode):
+    """
+    Refresh rate in Hz * 100, as calculate_refresh_rate() in edid.c.
+    """
+    refresh_span = ((mode["h_active"] + mode["h_blanking"])*(mode["v_active"] + mode["v_blanking"])) & 0xffffffff
+    return (mode["pixel_clock"]*10000*100 // refresh_span) & 0xffffffff
+
+
+def _descriptor(data_type, data):
+    return bytes([0, 0, 0, data_type, 0]) + data
+
+
+def _descriptor_padding(data):
+    if len(data) >= MAX_DESCRIPTOR_DATA_LEN:
+        return data
+    return data + b"\x0a" + b"\x20"*(MAX_DESCRIPTOR_DATA_LEN - len(data) - 1)
+
+
+def _edid_timing(timing):
+    h_image_size = 10*timing["h_active"]//64
+    v_image_size = 10*timing["v_active"]//64
+    return bytes(v & 0xff for v in [
+        timing["pixel_clock"], timing["pixel_clock"] >> 8,
+        timing["h_active"], timing["h_blanking"],
+        ((timing["h_active"] >> 8) << 4) | (timing["h_blanking"] >> 8),
+        timing["v_active"], timing["v_blanking"],
+        ((timing["v_active"] >> 8) << 4) | (timing["v_blanking"] >> 8),
+        timing["h_sync_offset"], timing["h_sync_width"], timing["v_sync_offset"],
+        ((timing["h_sync_offset"] >> 8) << 6) | ((timing["h_sync_width"] >> 8) << 4)
+        | ((timing["v_sync_offset"] >> 8) << 2) | (timing["v_sync_width"] >> 8),
+        h_image_size, v_image_size, ((h_image_size >> 8) << 4) | (v_image_size >> 8),
+        0, 0,
+        timing["flags"],
+    ])
+
+
+def _monitor_name(name):
+    return _descriptor(DESCRIPTOR_MONITOR_NAME, _descriptor_padding(name.encode("ascii")[:MAX_DESCRIPTOR_DATA_LEN]))
+
+
+def _monitor_range():
+    # Same fixed limits as edid.c
+    return _descriptor(DESCRIPTOR_MONITOR_RANGE, _descriptor_padding(bytes([50, 60, 31, 68, 8, 0x00])))
+
+
+def _unused():
+    return _descriptor(DESCRIPTOR_DUMMY, bytes(MAX_DESCRIPTOR_DATA_LEN))
+
+
+def generate_edid(mfg_name, product_code, year, name, timing, secondary_timing=None):
+    """
+    The 128-byte EDID generate_edid() in edid.c writes.
+    """
+    i, j, k = (ord(c) - ord("A") + 1 for c in mfg_name)
+    e = bytearray(EDID_HEADER)
+    e += bytes(v & 0xff for v in [
+        (i << 2) | (j >> 3), ((j & 0x07) << 5) | k,
+        ord(product_code[0]), ord(product_code[1]),
+        0, 0, 0, 0,
+        0, year - 1990,
+        1, 3,
+        0x80, timing["h_active"]//64, timing["v_active"]//64, 0x50, 0x06,
+    ])
+    e += bytes(10)
+    e += bytes([(timing["established_timing"] >> 8) & 0xff, timing["established_timing"] & 0xff, 0])
+    e += b"\x01"*16
+
+    e += _edid_timing(timing)
+    if secondary_timing is not None:
+        e += _edid_timing(secondary_timing)
+    e += _monitor_name(name)
+    e += _monitor_range()
+    if secondary_timing is None:
+        e += _unused()
+
+    e.append(0)
+    e.append(-sum(e) & 0xff)
+    assert len(e) == EDID_LENGTH
+    return bytes(e)
+
+
+def get_edids(modes, inputs):
+    """
+    Returns the EDIDs of each input, indexed by mode and secondary mode.
+    The secondary mode is the mode itself when there is none, as the
+    firmware doesn't announce a secondary mode equal to the mode.
+    """
+    return [[[generate_edid(mfg, product, year, name, mode, None if sec is mode else sec)
+              for sec in modes] for mode in modes] for mfg, product, year, name in inputs]
+
+
+def _conditional(lines, conditions):
+    return conditions + lines + ["#endif"]*len(conditions)
+
+
+def _bytes_lines(data, indent):
+    return [indent + " ".join("0x{:02x},".format(b) for b in data[offset:offset + 16])
+            for offset in range(0, len(data), 16)]
+
+
+def _name_offset(with_secondary):
+    # The monitor name descriptor follows the timing descriptors
+    return EDID_DATA_BLOCKS_OFFSET + EDID_DESCRIPTOR_LENGTH*(2 if with_secondary else 1)
+
+
+def get_edid_table(modes, inputs):
+    """
+    The EDIDs of the first input are stored as they are. The others only
+    differ in the monitor name descriptor and the checksum, which
+    edid_table_get() replaces with the ones of the input.
+    """
+    edids = get_edids(modes, inputs)
+    names = [_monitor_name(name) for _, _, _, name in inputs]
+    deltas = []
+    for edid_rows, name in zip(edids, names):
+        delta = None
+        for i, row in enumerate(edid_rows):
+            for j, edid in enumerate(row):
+                offset = _name_offset(i != j)
+                image = edids[0][i][j]
+                if edid[:offset] + edid[offset + EDID_DESCRIPTOR_LENGTH:-1] != \
+                        image[:offset] + image[offset + EDID_DESCRIPTOR_LENGTH:-1] or \
+                        edid[offset:offset + EDID_DESCRIPTOR_LENGTH] != name:
+                    raise Exception("The EDIDs of the inputs differ in more than their names")
+                if delta is None:
+                    delta = (edid[-1] - image[-1]) & 0xff
+                assert (edid[-1] - image[-1]) & 0xff == delta
+        deltas.append(delta)
+
+    lines = [
+        "/* Generated from the modes in processor.c by edid_table.py, do not edit */",
+        "#ifndef __EDID_TABLE_H",
+        "#define __EDID_TABLE_H",
+        "",
+        "#include <generated/csr.h>",
+        "",
+        "#include \"processor.h\"",
+        "",
+        "/* calculate_refresh_rate() of the modes */",
+        "static const unsigned video_mode_refresh_rates[PROCESSOR_MODE_COUNT] = {",
+    ]
+    for mode in modes:
+        lines += _conditional(["\t{}, /* {} */".format(calculate_refresh_rate(mode), mode["comment"])],
+                              mode["conditions"])
+    lines.append("};")
+
+    lines += [
+        "",
+        "#if {}".format(" || ".join("defined(CSR_HDMI_IN{}_BASE)".format(n) for n in range(len(inputs)))),
+        "#define EDID_TABLE_LENGTH {}".format(EDID_LENGTH),
+        "#define EDID_TABLE_DESCRIPTOR_LENGTH {}".format(EDID_DESCRIPTOR_LENGTH),
+        "#define EDID_TABLE_NAME_OFFSET {}".format(_name_offset(False)),
+        "#define EDID_TABLE_SECONDARY_NAME_OFFSET {}".format(_name_offset(True)),
+        "",
+        "/* EDIDs of hdmi_in0 by mode and secondary mode, the mode itself for none */",
+        "static const unsigned char edid_table[PROCESSOR_MODE_COUNT][PROCESSOR_MODE_COUNT][EDID_TABLE_LENGTH] = {",
+    ]
+    for mode, row in zip(modes, edids[0]):
+        row_lines = ["\t{{ /* {} */".format(mode["comment"])]
+        for sec, edid in zip(modes, row):
+            row_lines += _conditional(["\t\t{"] + _bytes_lines(edid, "\t\t\t") + ["\t\t},"], sec["conditions"])
+        row_lines.append("\t},")
+        lines += _conditional(row_lines, mode["conditions"])
+    lines += [
+        "};",
+        "",
+        "/* Monitor name descriptors of the inputs */",
+        "static const unsigned char edid_table_names[{}][EDID_TABLE_DESCRIPTOR_LENGTH] = {{".format(len(inputs)),
+    ]
+    for (_, _, _, name), descriptor in zip(inputs, names):
+        lines += ["\t{{ /* {} */".format(name)] + _bytes_lines(descriptor, "\t\t") + ["\t},"]
+    lines += [
+        "};",
+        "",
+        "/* Checksum of the inputs minus the one of hdmi_in0 */",
+        "static const unsigned char edid_table_checksum_deltas[{}] = {{ {} }};".format(
+            len(inputs), ", ".join("0x{:02x}".format(d) for d in deltas)),
+        "",
+        "/* Copies the EDID of hdmi_in<input> for the mode and secondary mode to out */",
+        "static inline void edid_table_get(unsigned char *out, int mode, int sec, int input)",
+        "{",
+        "\tconst unsigned char *image = edid_table[mode][sec];",
+        "\tint offset = sec == mode ? EDID_TABLE_NAME_OFFSET : EDID_TABLE_SECONDARY_NAME_OFFSET;",
+        "\tint i;",
+        "",
+        "\tfor(i=0;i<EDID_TABLE_LENGTH;i++)",
+        "\t\tout[i] = image[i];",
+        "\tfor(i=0;i<EDID_TABLE_DESCRIPTOR_LENGTH;i++)",
+        "\t\tout[offset + i] = edid_table_names[input][i];",
+        "\tout[EDID_TABLE_LENGTH - 1] += edid_table_checksum_deltas[input];",
+        "}",
+        "#endif",
+        "",
+        "#endif",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+CHECK_PROGRAM = """
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "edid.h"
+#include "edid_table.h"
+
+static const struct video_timing modes[] = {
+%(modes)s
+};
+static const char *names[] = { %(names)s };
+
+int main(void)
+{
+	unsigned char edid[EDID_TABLE_LENGTH];
+	unsigned int n = sizeof(modes)/sizeof(modes[0]);
+	unsigned int input, i, j, rate;
+
+	if(n != PROCESSOR_MODE_COUNT) {
+		fprintf(stderr, "%%u modes, PROCESSOR_MODE_COUNT is %%u\\n", n, (unsigned)PROCESSOR_MODE_COUNT);
+		return 1;
+	}
+	for(i=0;i<n;i++) {
+		rate = calculate_refresh_rate(&modes[i]);
+		fwrite(&rate, sizeof(rate), 1, stdout);
+		fwrite(&video_mode_refresh_rates[i], sizeof(rate), 1, stdout);
+	}
+	for(input=0;input<sizeof(names)/sizeof(names[0]);input++)
+		for(i=0;i<n;i++)
+			for(j=0;j<n;j++) {
+				generate_edid(edid, "%(mfg)s", "%(product)s", %(year)d, names[input],
+					&modes[i], i == j ? NULL : &modes[j]);
+				fwrite(edid, sizeof(edid), 1, stdout);
+				edid_table_get(edid, i, j, input);
+				fwrite(edid, sizeof(edid), 1, stdout);
+			}
+	return 0;
+}
+"""
+
+
+def check(modes, inputs, cc="cc"):
+    """
+    Compiles edid.c and the generated edid_table.h for the host, with all
+    the modes and inputs regardless of the platform. The EDIDs and refresh
+    rates of edid.c must match the Python ones, and the EDIDs of the table
+    must be byte-identical to the ones of generate_edid().
+    """
+    mfg, product, year = inputs[0][:3]
+    if any(i[:3] != (mfg, product, year) for i in inputs):
+        raise Exception("The check expects the same manufacturer, product and year on all inputs")
+    program = CHECK_PROGRAM % {
+        "modes": "\n".join("\t{{ {} }},".format(", ".join(".{} = {}".format(f, mode[f]) for f in TIMING_FIELDS))
+                           for mode in modes),
+        "names": ", ".join("\"{}\"".format(name) for _, _, _, name in inputs),
+        "mfg": mfg, "product": product, "year": year,
+    }
+    # Every mode and input, whatever their conditions
+    defines = {condition: "1" for mode in modes for c in mode["conditions"]
+               for condition in re.findall(r"\b([A-Z][A-Z0-9_]+)\b", c)}
+    defines.update({"CSR_HDMI_IN{}_BASE".format(n): "1" for n in range(len(inputs))})
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "generated"))
+        open(os.path.join(tmp, "generated", "csr.h"), "w").close()
+        with open(os.path.join(tmp, "edid_table.h"), "w") as f:
+            f.write(get_edid_table(modes, inputs))
+        with open(os.path.join(tmp, "check.c"), "w") as f:
+            f.write(program)
+        binary = os.path.join(tmp, "check")
+        subprocess.check_call([cc, "-O2", "-Wall", "-Werror", "-I" + tmp, "-I" + FIRMWARE_DIR, "-o", binary] +
+                              ["-D{}={}".format(name, value) for name, value in sorted(defines.items())] +
+                              [os.path.join(FIRMWARE_DIR, "edid.c"), os.path.join(tmp, "check.c")])
+        output = subprocess.check_output([binary])
+
+    pos = 0
+    for mode in modes:
+        for source in ("C", "table"):
+            rate = int.from_bytes(output[pos:pos + 4], sys.byteorder)
+            if rate != calculate_refresh_rate(mode):
+                raise Exception("Refresh rate of {}: {} {}, Python {}".format(
+                    mode["comment"], source, rate, calculate_refresh_rate(mode)))
+            pos += 4
+    count = 0
+    for (_, _, _, name), edids in zip(inputs, get_edids(modes, inputs)):
+        for i, row in enumerate(edids):
+            for j, edid in enumerate(row):
+                generated = output[pos:pos + EDID_LENGTH]
+                table = output[pos + EDID_LENGTH:pos + 2*EDID_LENGTH]
+                for expected, actual, what in ((edid, generated, "edid.c, Python"),
+                                               (generated, table, "edid_table.h, edid.c")):
+                    if actual != expected:
+                        offset = next(n for n in range(EDID_LENGTH) if actual[n] != expected[n])
+                        raise Exception("EDID {} of {} with secondary {} differs at byte {}: {} 0x{:02x}, 0x{:02x}".format(
+                            name, modes[i]["comment"], modes[j]["comment"], offset, what, actual[offset], expected[offset]))
+                pos += 2*EDID_LENGTH
+                count += 1
+    if pos != len(output):
+        raise Exception("Unexpected output length of the C check program")
+    return count
+
+
+def main():
+    args = sys.argv[1:]
+    if args not in (["--check"],) and (len(args) != 1 or args[0].startswith("-")):
+        sys.stderr.write("Usage: {} <edid_table.h> | --check\n".format(sys.argv[0]))
+        sys.exit(1)
+    defines = get_defines(read_source("edid.h"))
+    source = read_source("processor.c")
+    modes = parse_video_modes(source, defines)
+    inputs = parse_edid_inputs(source)
+    if not modes or not inputs:
+        raise Exception("No video modes or EDID inputs found in processor.c")
+
+    if args == ["--check"]:
+        count = check(modes, inputs, os.environ.get("HOSTCC", "cc"))
+        print("{} EDIDs of edid_table.h and {} refresh rates match edid.c".format(count, len(modes)))
+        return
+    with open(args[0], "w") as f:
+        f.write(get_edid_table(modes, inputs))
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,8 @@
 #include "mmcm.h"
 #include "processor.h"
 #include "heartbeat.h"
+#include "clock_table.h"
+#include "edid_table.h"
 
 /*
  ----------------->>> Time ----------->>>
@@ -386,7 +388,7 @@ void processor_list_modes(char *mode_descriptors)
 void processor_describe_mode(char *mode_descriptor, int mode)
 {
 	if (mode >= PROCESSOR_MODE_COUNT) return;
-	unsigned refresh_rate = calculate_refresh_rate(&(video_modes[mode]));
+	unsigned refresh_rate = video_mode_refresh_rates[mode];
 	sprintf(mode_descriptor,
 		"%ux%u@" REFRESH_RATE_PRINTF "Hz%s%s",
 		video_modes[mode].h_active,
@@ -408,7 +410,14 @@ static void fb_clkgen_write(int cmd, int data)
 }
 #elif CSR_HDMI_OUT0_DRIVER_CLOCKING_MMCM_RESET_ADDR
 // Artix-7 MMCM clocking
-static void fb_clkgen_write(int m, int d)
+static void fb_clkgen_write_divide(int adr, int divide)
+{
+	/* ClkReg1: high and low time, ClkReg2: edge for odd and no count for 1 */
+	hdmi_out0_driver_clocking_mmcm_write(adr, 0x1000 | ((divide/2)<<6) | (divide - divide/2));
+	hdmi_out0_driver_clocking_mmcm_write(adr + 1, (divide%2 ? 0x80 : 0) | (divide == 1 ? 0x40 : 0));
+}
+
+static void fb_clkgen_write(int m, int d, int divide)
 {
 	/* MMCM VCO range for slowest speed grade Artix-7 is 600MHz-1200MHz
 	   Warn if the VCO strays outside these limits.
@@ -435,22 +444,39 @@ static void fb_clkgen_write(int m, int d)
 		hdmi_out0_driver_clocking_mmcm_write(0x16, ((d/2)<<6) | (d/2 + 1));
 	else
 		hdmi_out0_driver_clocking_mmcm_write(0x16, ((d/2)<<6) | d/2);
-	/* clkout0_divide = 10 */
-	hdmi_out0_driver_clocking_mmcm_write(0x8, 0x1000 | (5<<6) | 5);
-	/* clkout1_driver_clocking_divide = 2 */
-	hdmi_out0_driver_clocking_mmcm_write(0xa, 0x1000 | (1<<6) | 1);
+	/* clkout0_divide = divide (pixel clock) */
+	fb_clkgen_write_divide(0x8, divide);
+	/* clkout1_divide = divide / 5 (5x pixel clock) */
+	fb_clkgen_write_divide(0xa, divide/5);
 }
 #else
 
 // Unsupported clocking!@?
-static void fb_clkgen_write(int m, int d)
+static void fb_clkgen_write(int m, int d, int divide)
 {
 	assert(false);
 }
 #endif
 
+// Look up the clock settings of the modes, precomputed by clock_table.py
+static int fb_lookup_clock_md(unsigned int pixel_clock, unsigned int *m, unsigned int *d, unsigned int *divide)
+{
+#ifdef CLOCK_MD_TABLE_SIZE
+	int i;
+	for(i=0;i<CLOCK_MD_TABLE_SIZE;i++) {
+		if(clock_md_table[i].pixel_clock == pixel_clock) {
+			*m = clock_md_table[i].m;
+			*d = clock_md_table[i].d;
+			*divide = clock_md_table[i].divide;
+			return 1;
+		}
+	}
+#endif
+	return 0;
+}
+
 // Work out the multiplier and divider values for a given pixel clock.
-static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsigned int *best_d)
+static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsigned int *best_d, unsigned int *best_divide)
 {
 	unsigned int max_m, max_d;
 	unsigned int ideal_m, ideal_d;
@@ -459,6 +485,10 @@ static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsi
 	unsigned int diff_current;
 	unsigned int diff_tested;
 
+	if(fb_lookup_clock_md(pixel_clock, &bm, &bd, best_divide))
+		goto found;
+
+	/* Custom mode, search at runtime */
 	ideal_m = pixel_clock;
 
 	bm = 1;
@@ -469,12 +499,14 @@ static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsi
 	ideal_d = 5000;
 	max_d = 256;
 	max_m = 256;
+	*best_divide = 1;
 #elif CSR_HDMI_OUT0_DRIVER_CLOCKING_MMCM_RESET_ADDR
 	// Artix 7
 	pixel_clock = pixel_clock * 10;
 	ideal_d = 1000;
 	max_d = 128;
 	max_m = 128;
+	*best_divide = 10;
 #else
 	assert(false);
 	return;
@@ -490,6 +522,7 @@ static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsi
 				bd = d;
 			}
 		}
+found:
 	*best_m = bm;
 	*best_d = bd;
 
@@ -507,9 +540,9 @@ static void fb_get_clock_md(unsigned int pixel_clock, unsigned int *best_m, unsi
 
 static void fb_set_clock(unsigned int pixel_clock)
 {
-	unsigned int clock_m, clock_d;
+	unsigned int clock_m, clock_d, clock_divide;
 
-	fb_get_clock_md(pixel_clock, &clock_m, &clock_d);
+	fb_get_clock_md(pixel_clock, &clock_m, &clock_d, &clock_divide);
 
 #ifdef CSR_HDMI_OUT0_DRIVER_CLOCKING_PLL_RESET_ADDR
 	fb_clkgen_write(0x1, clock_d-1);
@@ -518,7 +551,7 @@ static void fb_set_clock(unsigned int pixel_clock)
 	while(!(hdmi_out0_driver_clocking_status_read() & CLKGEN_STATUS_PROGDONE));
 	while(!(hdmi_out0_driver_clocking_status_read() & CLKGEN_STATUS_LOCKED));
 #elif CSR_HDMI_OUT0_DRIVER_CLOCKING_MMCM_RESET_ADDR
-	fb_clkgen_write(clock_m, clock_d);
+	fb_clkgen_write(clock_m, clock_d, clock_divide);
 #endif
 }
 
@@ -569,19 +602,26 @@ static void fb_set_mode(const struct video_timing *mode)
 	fb_set_clock(mode->pixel_clock);
 }
 
-static void edid_set_mode(const struct video_timing *mode, const struct video_timing *sec_mode)
+// The EDIDs of the modes come from edid_table.h, custom modes are generated
+static void edid_set_mode(int mode, int sec, const struct video_timing *m, const struct video_timing *sec_mode)
 {
 #if defined(CSR_HDMI_IN0_BASE) || defined(CSR_HDMI_IN1_BASE)
 	unsigned char edid[128];
 	int i;
 #endif
 #ifdef CSR_HDMI_IN0_BASE
-	generate_edid(&edid, "OHW", "TV", 2015, "HDMI2USB-1", mode, sec_mode);
+	if(mode == PROCESSOR_MODE_CUSTOM)
+		generate_edid(&edid, "OHW", "TV", 2015, "HDMI2USB-1", m, sec_mode);
+	else
+		edid_table_get(edid, mode, sec, 0);
 	for(i=0;i<sizeof(edid);i++)
 		MMPTR(CSR_HDMI_IN0_EDID_MEM_BASE+4*i) = edid[i];
 #endif
 #ifdef CSR_HDMI_IN1_BASE
-	generate_edid(&edid, "OHW", "TV", 2015, "HDMI2USB-2", mode, sec_mode);
+	if(mode == PROCESSOR_MODE_CUSTOM)
+		generate_edid(&edid, "OHW", "TV", 2015, "HDMI2USB-2", m, sec_mode);
+	else
+		edid_table_get(edid, mode, sec, 1);
 	for(i=0;i<sizeof(edid);i++)
 		MMPTR(CSR_HDMI_IN1_EDID_MEM_BASE+4*i) = edid[i];
 #endif
@@ -607,9 +647,13 @@ void processor_start(int mode)
 {
 	const struct video_timing *m;
 	const struct video_timing *sec_mode = NULL;
+	// Index of the secondary mode in edid_table.h, the mode itself for none
+	int sec = mode;
 	if (processor_secondary_mode != EDID_SECONDARY_MODE_OFF &&
-			processor_secondary_mode != mode)
+			processor_secondary_mode != mode) {
 		sec_mode = &video_modes[processor_secondary_mode];
+		sec = processor_secondary_mode;
+	}
 
 	if (mode == PROCESSOR_MODE_CUSTOM) {
 		m = &custom_modes[0];
@@ -621,7 +665,10 @@ void processor_start(int mode)
 
 	processor_h_active = m->h_active;
 	processor_v_active = m->v_active;
-	processor_refresh = calculate_refresh_rate(m);
+	if (mode == PROCESSOR_MODE_CUSTOM)
+		processor_refresh = calculate_refresh_rate(m);
+	else
+		processor_refresh = video_mode_refresh_rates[mode];
 
 #ifdef CSR_HDMI_OUT0_BASE
 	hdmi_out0_core_initiator_enable_write(0);
@@ -661,7 +708,7 @@ void processor_start(int mode)
 #endif
 
 	fb_set_mode(m);
-	edid_set_mode(m, sec_mode);
+	edid_set_mode(mode, sec, m, sec_mode);
 
 #ifdef CSR_HDMI_IN0_BASE
 	hdmi_in0_init_video(m->h_active, m->v_active);
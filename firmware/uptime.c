@@ -9,13 +9,36 @@
 #include "stdio_wrap.h"
 
 static int uptime_seconds = 0;
-void uptime_service(void)
+static unsigned long long uptime_cycles_total = 0;
+static unsigned int uptime_subsecond = 0;
+
+/* timer0 counts down from its reload value since time_init(), accumulate
+ * the cycles it counted since the last call. Called often enough to never
+ * miss a timer wrap. */
+unsigned long long uptime_cycles(void)
 {
-	static int last_event;
+	static int last_t;
+	int t, dt;
+
+	timer0_update_value_write(1);
+	t = timer0_reload_read() - timer0_value_read();
+	dt = t - last_t;
+	if(dt < 0)
+		dt += timer0_reload_read();
+	last_t = t;
 
-	if(elapsed(&last_event, CONFIG_CLOCK_FREQUENCY)) {
+	uptime_cycles_total += dt;
+	uptime_subsecond += dt;
+	while(uptime_subsecond >= CONFIG_CLOCK_FREQUENCY) {
+		uptime_subsecond -= CONFIG_CLOCK_FREQUENCY;
 		uptime_seconds++;
 	}
+	return uptime_cycles_total;
+}
+
+void uptime_service(void)
+{
+	uptime_cycles();
 }
 
 int uptime(void)
@@ -28,6 +51,14 @@ void uptime_print(void)
 	wprintf("uptime: %s\n", uptime_str());
 }
 
+void uptime_cycles_print(void)
+{
+	unsigned long long cycles = uptime_cycles();
+
+	wprintf("cycles: 0x%08x%08x\n",
+		(unsigned int)(cycles >> 32), (unsigned int)cycles);
+}
+
 const char* uptime_str(void)
 {
 	static char buffer[9];
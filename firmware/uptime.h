@@ -3,8 +3,10 @@
 
 void uptime_service(void);
 int uptime(void);
+unsigned long long uptime_cycles(void);
 
 void uptime_print(void);
+void uptime_cycles_print(void);
 const char* uptime_str(void);
 
 #endif /* __CONFIG_H */
@@ -0,0 +1,221 @@
+import contextlib
+import filecmp
+import hashlib
+import os
+import os.path as Path
+import shutil
+import tempfile
+
+
+# Python sources which the SoC elaboration in make.py depends on,
+# relative to the repository root.
+SOC_SOURCE_DIRS = [
+    "scripts",
+    "third_party/migen",
+    "third_party/litex",
+    "third_party/litedram",
+    "third_party/liteeth",
+    "third_party/litepcie",
+    "third_party/litesata",
+    "third_party/litescope",
+    "third_party/liteusb",
+    "third_party/litevideo",
+]
+
+# Sources of the LiteX software packages (libbase, the BIOS...), which
+# are built with the generated headers of the SoC.
+SOC_SOFTWARE_DIRS = [
+    "third_party/litex/litex/soc/software",
+]
+
+
+def default_cache_dir(kind):
+    """
+    Returns the directory for the `kind` cache, shared by all build dirs.
+    BUILDENV_CACHE_DIR takes precedence over the default under BUILD_DIR.
+    """
+    base = os.environ.get("BUILDENV_CACHE_DIR")
+    if not base:
+        base = Path.join(os.environ.get("BUILD_DIR", "build"), "cache")
+    return Path.join(base, kind)
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Holds an exclusive lock on `filename` in the context, for the caches
+    which parallel builds (e.g. the matrix) share.
+    """
+    os.makedirs(Path.dirname(Path.abspath(filename)), exist_ok=True)
+    with open(filename, "w") as f:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows
+            import msvcrt
+            while True:
+                try:
+                    # Gives up with an OSError after 10 attempts
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Digest:
+    """
+    Content address of a set of build inputs.
+    Every entry is hashed together with its name and length, so moving data
+    between entries always changes the resulting digest.
+    """
+
+    def __init__(self):
+        self._sha = hashlib.sha256()
+
+    def add(self, name, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        for chunk in (name.encode("utf-8"), data):
+            self._sha.update(len(chunk).to_bytes(8, "little"))
+            self._sha.update(chunk)
+
+    def add_file(self, filename, name=None):
+        if name is None:
+            name = filename
+        sha = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self.add(name, sha.digest())
+
+    def add_tree(self, directory, suffixes=(".py",), contents=False):
+        """
+        Adds the path, size and mtime of every file under `directory` whose
+        name ends with one of `suffixes` (all files for None). Much cheaper
+        than hashing contents, at the cost of a spurious miss when files
+        are touched. With `contents`, the contents are hashed instead.
+        """
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if suffixes is not None and not name.endswith(suffixes):
+                    continue
+                filename = Path.join(root, name)
+                if contents:
+                    self.add_file(filename, Path.relpath(filename, directory))
+                    continue
+                st = os.stat(filename)
+                self.add(Path.relpath(filename, directory),
+                         f"{st.st_size}:{st.st_mtime_ns}")
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+
+def soc_inputs_digest(base_path, args):
+    """
+    Digest of everything the SoC elaboration depends on: the make.py
+    arguments and the Python sources of the buildenv, Migen and LiteX,
+    and the contents of the LiteX software sources.
+    """
+    digest = Digest()
+    digest.add("args", repr(list(args)))
+    for directory in SOC_SOURCE_DIRS:
+        digest.add_tree(Path.join(base_path, directory))
+    for directory in SOC_SOFTWARE_DIRS:
+        digest.add_tree(Path.join(base_path, directory), suffixes=None, contents=True)
+    return digest.hexdigest()
+
+
+def _copy_if_changed(source, destination):
+    # Keeps the mtime of unchanged files, so make doesn't rebuild their users
+    if Path.isfile(destination) and filecmp.cmp(source, destination, shallow=False):
+        return
+    os.makedirs(Path.dirname(destination) or ".", exist_ok=True)
+    shutil.copyfile(source, destination)
+    # Cached executables have to stay executable
+    shutil.copymode(source, destination)
+
+
+class BuildCache:
+    """
+    Directory of build products, one subdirectory per input digest.
+    Entries are written to a temporary directory and renamed into place, so
+    concurrent builds never observe a partially stored entry.
+    File names are relative paths and may contain subdirectories.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def entry(self, key):
+        return Path.join(self.directory, key[:2], key)
+
+    def has(self, key):
+        return Path.isdir(self.entry(key))
+
+    def read(self, key, name):
+        """
+        Returns the contents of a single cached file, or None on a miss.
+        """
+        filename = Path.join(self.entry(key), name)
+        if not Path.isfile(filename):
+            return None
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def restore(self, key, destination, names=None):
+        """
+        Copies the cached files into `destination`.
+        Returns the list of restored names, or None on a cache miss.
+        """
+        entry = self.entry(key)
+        if not Path.isdir(entry):
+            return None
+        if names is None:
+            names = []
+            for root, _, files in os.walk(entry):
+                names += [Path.relpath(Path.join(root, f), entry) for f in files]
+            names.sort()
+        if not all(Path.isfile(Path.join(entry, name)) for name in names):
+            return None
+        for name in names:
+            _copy_if_changed(Path.join(entry, name), Path.join(destination, name))
+        return names
+
+    def store(self, key, source, names, data=None):
+        """
+        Stores the files from `source` that exist, and the `data` dict of
+        name to bytes, under `key`.
+        Returns the list of stored names.
+        """
+        names = [name for name in names if Path.isfile(Path.join(source, name))]
+        data = data or {}
+        entry = self.entry(key)
+        if not (names or data) or Path.isdir(entry):
+            return names
+        os.makedirs(Path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=Path.dirname(entry))
+        try:
+            for name in names:
+                _copy_if_changed(Path.join(source, name), Path.join(tmp, name))
+            for name, contents in data.items():
+                with open(Path.join(tmp, name), "wb") as f:
+                    f.write(contents)
+            os.rename(tmp, entry)
+        except OSError:
+            # Another build stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not Path.isdir(entry):
+                raise
+        return names
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Checks that starting litex_buildenv_ng.py stays fast: the CLI must not
+import any of the heavy modules its subcommands use, and its total import
+time must stay under the budget.
+"""
+
+import argparse
+import os.path as Path
+import re
+import subprocess
+import sys
+
+# Modules only the subcommands may load
+HEAVY_MODULES = ["git", "requests", "migen", "litex", "prepare", "firmware", "gateware_build", "matrix", "sim"]
+
+_IMPORT_TIME = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)$")
+
+
+def get_import_times(args):
+    """
+    Runs the CLI with `args` under -X importtime.
+    Returns a list of (cumulative_us, module, top_level) tuples.
+    """
+    cli = Path.join(Path.dirname(Path.abspath(__file__)), "litex_buildenv_ng.py")
+    result = subprocess.run([sys.executable, "-X", "importtime", cli] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = []
+    for line in result.stderr.decode("utf-8", "replace").splitlines():
+        m = _IMPORT_TIME.match(line)
+        if m:
+            # nested imports are indented by two more spaces per level
+            times.append((int(m.group(2)), m.group(4), len(m.group(3)) == 1))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=250, help="maximal total import time in ms")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to print")
+    parser.add_argument("args", nargs="*", default=["--help"], help="CLI arguments to start with")
+    args = parser.parse_args()
+
+    times = get_import_times(args.args)
+    if not times:
+        print("No import times reported, did the CLI start at all?")
+        sys.exit(1)
+
+    total = sum(t for t, _, top_level in times if top_level) / 1000
+    print(f"Total import time: {total:.1f} ms (budget {args.budget:.1f} ms)")
+    for t, name, _ in sorted(((t, n, l) for t, n, l in times if l), reverse=True)[:args.top]:
+        print(f"  {t / 1000:8.1f} ms  {name}")
+
+    failed = False
+    imported = set(name for _, name, _ in times)
+    for name in HEAVY_MODULES:
+        if any(m == name or m.startswith(name + ".") for m in imported):
+            print(f"Module '{name}' is imported on startup")
+            failed = True
+    if total > args.budget:
+        print("Import time over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import os.path as Path
+import platform
+import shutil
+import subprocess
+import cache
+from log import Log
+
+# Size of the chunks downloaded and hashed at once
+CHUNK_SIZE = 1024 * 1024
+# Seconds without data after which a download is aborted
+TIMEOUT = 60
+
+
+def _sha256(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class DownloadCache:
+    """
+    Downloaded files shared by all build dirs, stored by content:
+    - sha256/<digest>: complete, verified files,
+    - partial/<url hash>: interrupted downloads, resumed with HTTP ranges,
+      locked with partial/<url hash>.lock while downloading,
+    - urls/<url hash>: digest of the file last downloaded from the URL.
+    Files are placed in build dirs as hardlinks where possible.
+    """
+
+    def _blob(self, digest):
+        return Path.join(self.directory, "sha256", digest)
+
+    def _index(self, url):
+        return Path.join(self.directory, "urls", _url_key(url))
+
+    def _partial(self, url):
+        return Path.join(self.directory, "partial", _url_key(url))
+
+    def _lookup(self, url):
+        try:
+            with open(self._index(url), "r") as f:
+                digest = f.read().strip()
+        except OSError:
+            return None
+        return digest if Path.isfile(self._blob(digest)) else None
+
+    def _cached(self, url, sha256):
+        if sha256:
+            return self._blob(sha256) if Path.isfile(self._blob(sha256)) else None
+        digest = self._lookup(url)
+        return self._blob(digest) if digest else None
+
+    def _download(self, url, filename):
+        import requests
+
+        offset = Path.getsize(filename) if Path.isfile(filename) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=TIMEOUT) as r:
+            if offset and r.status_code == 416:
+                # The range starts at the end: the previous run was only
+                # interrupted before the file was moved into place.
+                return
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                Log.log(f"Server doesn't support resuming, restarting {url}")
+                offset = 0
+            elif offset:
+                Log.log(f"Resuming {url} at {offset} bytes")
+            with open(filename, "ab" if offset else "wb") as f:
+                f.truncate(offset)
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+
+    def fetch(self, url, sha256=None):
+        """
+        Returns the path of the cached file downloaded from `url`,
+        downloading it first if needed. If `sha256` is given, the file
+        must have that digest.
+        """
+        if sha256:
+            sha256 = sha256.lower()
+        blob = self._cached(url, sha256)
+        if blob:
+            return blob
+
+        partial = self._partial(url)
+        for d in (Path.dirname(partial), Path.dirname(self._index(url)),
+                  Path.dirname(self._blob("0"))):
+            os.makedirs(d, exist_ok=True)
+
+        # Parallel builds (e.g. the matrix) may download the same URL, and
+        # would append to the same partial file
+        with cache.file_lock(partial + ".lock"):
+            blob = self._cached(url, sha256)
+            if blob:
+                return blob
+
+            Log.log(f"Downloading {url} ...")
+            self._download(url, partial)
+            digest = _sha256(partial)
+            if sha256 and digest != sha256:
+                os.remove(partial)
+                raise Exception(f"Checksum mismatch for {url}: expected "
+                                f"{sha256}, got {digest}")
+
+            os.chmod(partial, 0o444)
+            os.replace(partial, self._blob(digest))
+            with open(self._index(url) + ".tmp", "w") as f:
+                f.write(digest)
+            os.replace(self._index(url) + ".tmp", self._index(url))
+        return self._blob(digest)
+
+    def install(self, url, destination, sha256=None, writable=False):
+        """
+        Places the file from `url` at `destination`. Files which are
+        modified in place by the build should be `writable`, so they get
+        their own copy instead of a hardlink into the cache.
+        """
+        blob = self.fetch(url, sha256)
+        if Path.exists(destination):
+            if Path.samefile(blob, destination):
+                return destination
+            os.remove(destination)
+        os.makedirs(Path.dirname(Path.abspath(destination)), exist_ok=True)
+
+        if not writable:
+            try:
+                os.link(blob, destination)
+                return destination
+            except OSError:
+                pass
+        if platform.system() == "Linux":
+            # Copy-on-write clone where the filesystem supports it
+            subprocess.check_call(["cp", "--reflink=auto", blob, destination])
+        else:
+            shutil.copyfile(blob, destination)
+        os.chmod(destination, 0o644)
+        return destination
+
+    def __init__(self, directory=None):
+        self.directory = directory or cache.default_cache_dir("downloads")
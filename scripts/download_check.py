@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Checks DownloadCache against a local HTTP server with Range support:
+caching, resuming an interrupted download, restarting it on a server
+without ranges, rejecting a file with the wrong SHA-256, and installing
+files as hardlinks or as writable copies.
+"""
+
+import argparse
+import hashlib
+import os
+import os.path as Path
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from download import DownloadCache
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        offset = 0
+        m = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        server.requests.append((self.path, int(m.group(1)) if m else None))
+        if m and self.path not in server.no_ranges:
+            offset = int(m.group(1))
+            if offset >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.end_headers()
+        # Interrupted downloads send only part of the body
+        end = server.interrupt.pop(self.path, len(data))
+        self.wfile.write(data[offset:end])
+        server.sent += end - offset
+
+
+class LocalServer(ThreadingHTTPServer):
+    """
+    Serves `files` (path: bytes) on 127.0.0.1.
+    """
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.files = files
+        # Paths answered without ranges, and the offsets of the paths to
+        # cut off there on the next request
+        self.no_ranges = set()
+        self.interrupt = {}
+        # (path, range offset) of each request
+        self.requests = []
+        self.sent = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def check_cache(server, directory):
+    errors = []
+    data = server.files["/cached"]
+    downloads = DownloadCache(directory)
+    blob = downloads.fetch(server.url("/cached"), _digest(data))
+    requests = len(server.requests)
+    if _read(blob) != data:
+        errors.append("downloaded file differs")
+    if downloads.fetch(server.url("/cached"), _digest(data)) != blob or downloads.fetch(server.url("/cached")) != blob:
+        errors.append("cached file not returned")
+    if len(server.requests) != requests:
+        errors.append("cached file downloaded again")
+    return f"{len(data)} bytes in {requests} request", errors
+
+
+def check_resume(server, directory):
+    errors = []
+    data = server.files["/resume"]
+    downloads = DownloadCache(directory)
+    url = server.url("/resume")
+    server.interrupt["/resume"] = len(data) // 3
+    try:
+        downloads.fetch(url, _digest(data))
+        errors.append("interrupted download succeeded")
+    except Exception:
+        pass
+    # What was written of the last chunk before the interruption
+    resumed = Path.getsize(downloads._partial(url))
+    if not resumed:
+        errors.append("nothing kept of the interrupted download")
+    server.requests.clear()
+    server.sent = 0
+    blob = downloads.fetch(url, _digest(data))
+    if _read(blob) != data:
+        errors.append("resumed file differs")
+    if server.requests != [("/resume", resumed)]:
+        errors.append(f"not resumed at {resumed}: {server.requests}")
+    if server.sent != len(data) - resumed:
+        errors.append(f"{server.sent} bytes sent to resume, expected {len(data) - resumed}")
+
+    # A complete partial file, interrupted before it was moved into place
+    data = server.files["/complete"]
+    url = server.url("/complete")
+    with open(downloads._partial(url), "wb") as f:
+        f.write(data)
+    server.requests.clear()
+    server.sent = 0
+    if _read(downloads.fetch(url, _digest(data))) != data:
+        errors.append("complete partial file differs")
+    if server.requests != [("/complete", len(data))] or server.sent:
+        errors.append(f"complete partial file downloaded again: {server.requests}")
+
+    # A server without ranges sends the whole file again
+    data = server.files["/restart"]
+    url = server.url("/restart")
+    server.no_ranges.add("/restart")
+    with open(downloads._partial(url), "wb") as f:
+        f.write(data[:len(data) // 2])
+    server.sent = 0
+    if _read(downloads.fetch(url, _digest(data))) != data:
+        errors.append("restarted file differs")
+    if server.sent != len(data):
+        errors.append(f"{server.sent} bytes sent to restart, expected {len(data)}")
+    return f"resumed at {resumed} of {len(data)} bytes", errors
+
+
+def check_mismatch(server, directory):
+    errors = []
+    data = server.files["/mismatch"]
+    downloads = DownloadCache(directory)
+    url = server.url("/mismatch")
+    try:
+        downloads.fetch(url, _digest(data + b"x"))
+        errors.append("file with the wrong SHA-256 accepted")
+    except Exception as e:
+        if "Checksum mismatch" not in str(e):
+            errors.append(f"unexpected error {e}")
+    if Path.exists(downloads._partial(url)):
+        errors.append("partial file of the mismatch kept")
+    if downloads._cached(url, None) or Path.exists(downloads._blob(_digest(data))):
+        errors.append("file with the wrong SHA-256 cached")
+    return "rejected", errors
+
+
+def check_install(server, directory):
+    errors = []
+    data = server.files["/cached"]
+    downloads = DownloadCache(directory)
+    url = server.url("/cached")
+    blob = downloads.fetch(url, _digest(data))
+    installed = Path.join(directory, "install", "linked")
+    downloads.install(url, installed, _digest(data))
+    if not Path.samefile(installed, blob):
+        errors.append("read-only install isn't a hardlink")
+    if downloads.install(url, installed, _digest(data)) != installed or not Path.samefile(installed, blob):
+        errors.append("installing the hardlink again replaced it")
+    copied = Path.join(directory, "install", "copied")
+    downloads.install(url, copied, _digest(data), writable=True)
+    if Path.samefile(copied, blob):
+        errors.append("writable install is a hardlink")
+    if not os.access(copied, os.W_OK):
+        errors.append("writable install isn't writable")
+    with open(copied, "ab") as f:
+        f.write(b"modified")
+    if _read(blob) != data:
+        errors.append("modifying the writable install changed the cache")
+    return "hardlink and copy", errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=3*1024*1024 + 17, help="bytes per test file")
+    args = parser.parse_args()
+
+    # Different contents for each path, the cache stores files by digest
+    paths = ["/cached", "/resume", "/complete", "/restart", "/mismatch"]
+    server = LocalServer({path: os.urandom(args.size) for path in paths})
+    failed = False
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, check in (("cache", check_cache), ("resume", check_resume),
+                                ("mismatch", check_mismatch), ("install", check_install)):
+                summary, errors = check(server, directory)
+                print(f"{name:8} {'fail' if errors else 'pass':5} {summary}")
+                for error in errors:
+                    print(f"         {error}")
+                failed |= bool(errors)
+    finally:
+        server.shutdown()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
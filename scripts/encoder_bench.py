@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the encoder pipeline of gateware/encoder/core.py.
+
+EncoderDMAReader and EncoderBuffer run in a migen simulation, reading a
+frame from a DRAM port model with a fixed latency and a penalty for
+opening a new row. Their DRAM reads and output pixels are compared with
+the reference model of gateware/encoder/model.py, and the achieved
+pixels per cycle and DRAM efficiency are measured.
+
+The model then encodes the whole frame at each quality level of
+firmware/encoder.c and reports the compressed bytes per frame.
+"""
+
+import argparse
+import collections
+import json
+import os
+import time
+
+import numpy as np
+
+from migen import *
+from migen.sim import run_simulation, passive
+
+from litedram.common import LiteDRAMNativePort
+
+from log import Log
+from gateware.encoder import model
+from gateware.encoder.core import EncoderDMAReader, EncoderBuffer
+
+
+DW = 128  # EncoderBuffer takes 128-bit DRAM words
+AW = 24
+
+
+class EncoderFrontend(Module):
+    """
+    EncoderDMAReader feeding EncoderBuffer, as in the video targets.
+    """
+
+    def __init__(self):
+        self.port = LiteDRAMNativePort("read", AW, DW)
+        self.submodules.reader = EncoderDMAReader(self.port)
+        self.submodules.buffer = EncoderBuffer()
+        self.comb += self.reader.source.connect(self.buffer.sink)
+
+
+def dram_model(port, words, base_word, stats, latency, row_miss, row_bytes):
+    """
+    Serves the reads of `port` from `words`, in order, `latency` cycles
+    after their command. A command to another row than the previous one
+    takes `row_miss` more cycles and stalls the following commands.
+    """
+    pending = collections.deque()
+    current = None
+    open_row = None
+    busy_until = 0
+    cycle = 0
+    yield port.cmd.ready.eq(1)
+    while True:
+        if current is not None and (yield port.rdata.ready):
+            current = None
+        if (yield port.cmd.valid) and (yield port.cmd.ready):
+            address = yield port.cmd.addr
+            stats["addresses"].append(address)
+            row = address*(DW//8)//row_bytes
+            extra = 0 if row == open_row else row_miss
+            if row != open_row:
+                stats["row_misses"] += 1
+            open_row = row
+            busy_until = cycle + 1 + extra
+            ready = max(cycle + latency + extra, pending[-1][0] + 1 if pending else 0)
+            pending.append((ready, words[address - base_word]))
+        if current is None and pending and pending[0][0] <= cycle:
+            current = pending.popleft()[1]
+        yield port.rdata.valid.eq(current is not None)
+        if current is not None:
+            yield port.rdata.data.eq(current)
+        yield port.cmd.ready.eq(cycle + 1 >= busy_until)
+        yield
+        cycle += 1
+
+
+def run_frontend(frame, base=0x01000000, latency=8, row_miss=6, row_bytes=2048, max_cycles=None):
+    """
+    Simulates the reading of `frame` (lines of 16-bit pixels) and returns
+    the pixels EncoderBuffer output and the statistics of the run.
+    """
+    height, width = frame.shape
+    dut = EncoderFrontend()
+    words = model.pack_words(frame, DW)
+    stats = {"addresses": [], "row_misses": 0, "cycles": None}
+    pixels = []
+    max_cycles = max_cycles or 20*width*height + 1000
+
+    def control():
+        yield dut.reader.base.storage.eq(base)
+        yield dut.reader.h_width.storage.eq(width)
+        yield dut.reader.v_width.storage.eq(height)
+        yield dut.reader.start.r.eq(1)
+        yield dut.reader.start.re.eq(1)
+        yield
+        yield dut.reader.start.re.eq(0)
+
+    def sink():
+        source = dut.buffer.source
+        yield source.ready.eq(1)
+        cycle = 0
+        while len(pixels) < width*height:
+            if (yield source.valid):
+                pixels.append((yield source.data))
+            yield
+            cycle += 1
+            if cycle > max_cycles:
+                raise Exception("Encoder front end stalled after {} of {} pixels".format(len(pixels), width*height))
+        stats["cycles"] = cycle
+
+    dram = passive(dram_model)(dut.port, words, base*8//DW, stats, latency, row_miss, row_bytes)
+    run_simulation(dut, [control(), sink(), dram])
+    return np.array(pixels, dtype=np.uint16), stats
+
+
+def get_frame(args):
+    width, height = (int(v) for v in args.mode.lower().split("x"))
+    if args.input:
+        with open(args.input, "rb") as f:
+            raw = f.read()
+        if len(raw) != width*height*2:
+            raise Exception("{} has {} bytes, a {}x{} frame {}".format(args.input, len(raw), width, height, width*height*2))
+        return model.frame_from_raw(raw, width, height)
+
+    rng = np.random.default_rng(0)
+    columns = np.arange(width)
+    rows = np.arange(height)[:, None]
+    if args.pattern == "noise":
+        y = rng.integers(16, 236, (height, width), dtype=np.uint8)
+        cb, cr = rng.integers(16, 241, (2, height, width//2), dtype=np.uint8)
+    else:
+        # Eight vertical color bars over a luma ramp, as the firmware pattern
+        bars = np.array([[235, 128, 128], [210, 16, 146], [170, 166, 16], [145, 54, 34],
+                         [106, 202, 222], [81, 90, 240], [41, 240, 110], [16, 128, 128]])
+        bar = bars[columns*8//width]
+        y = np.clip(bar[:, 0] + (rows*32//height) - 16, 0, 255).astype(np.uint8)
+        cb = np.broadcast_to(bar[::2, 1], (height, width//2)).astype(np.uint8)
+        cr = np.broadcast_to(bar[::2, 2], (height, width//2)).astype(np.uint8)
+    raw = np.stack([y[:, ::2], cr, y[:, 1::2], cb], axis=-1).tobytes()
+    return model.frame_from_raw(raw, width, height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encoder pipeline benchmark against its reference model")
+    parser.add_argument("--mode", default="1280x720", help="WIDTHxHEIGHT of the frame")
+    parser.add_argument("--input", default=None, help="raw frame, as framebuffer.py saves it")
+    parser.add_argument("--pattern", choices=["bars", "noise"], default="bars", help="generated frame without --input")
+    parser.add_argument("--sim-size", default="64x32", help="WIDTHxHEIGHT of the top left part of the frame to simulate")
+    parser.add_argument("--no-sim", action="store_true", help="only run the model")
+    parser.add_argument("--latency", type=int, default=8, help="DRAM read latency in cycles")
+    parser.add_argument("--row-miss", type=int, default=6, help="DRAM row miss penalty in cycles")
+    parser.add_argument("--row-bytes", type=int, default=2048, help="DRAM row size")
+    parser.add_argument("--qualities", default=",".join(str(q) for q in model.QUALITIES), help="quality levels to encode")
+    parser.add_argument("--jpeg-prefix", default=None, help="save the JPEGs of the model as <prefix><quality>.jpg")
+    parser.add_argument("--report", default=None, help="JSON report")
+    args = parser.parse_args()
+
+    y, cb, cr, pixels = get_frame(args)
+    height, width = pixels.shape
+    addresses = model.dma_read_addresses(width, height, dw=DW)
+    sequential, row_hits = model.dram_efficiency(addresses, DW, args.row_bytes)
+    report = {
+        "frame": {"width": width, "height": height, "source": args.input or args.pattern},
+        "model": {"dram_reads": len(addresses), "dram_sequential": round(sequential, 4), "dram_row_hits": round(row_hits, 4)},
+        "jpeg": [],
+    }
+    lines = ["Encoder benchmark, {}x{} frame:".format(width, height),
+             "  model DRAM reads: {}, sequential {:.1%}, row hits {:.1%}".format(len(addresses), sequential, row_hits)]
+
+    if not args.no_sim:
+        sim_width, sim_height = (int(v) for v in args.sim_size.lower().split("x"))
+        part = pixels[:sim_height, :sim_width]
+        with Log.stage("encoder-sim"):
+            start = time.monotonic()
+            output, stats = run_frontend(part, latency=args.latency, row_miss=args.row_miss, row_bytes=args.row_bytes)
+            duration = time.monotonic() - start
+        expected_addresses = model.dma_read_addresses(sim_width, sim_height, base=0x01000000, dw=DW)
+        bit_exact = np.array_equal(output, model.reorder(part)) and np.array_equal(stats["addresses"], expected_addresses)
+        sim_sequential, sim_row_hits = model.dram_efficiency(stats["addresses"], DW, args.row_bytes)
+        report["sim"] = {
+            "width": sim_width, "height": sim_height,
+            "cycles": stats["cycles"],
+            "pixels_per_cycle": round(sim_width*sim_height/stats["cycles"], 4),
+            "dram_reads": len(stats["addresses"]),
+            "dram_busy": round(len(stats["addresses"])/stats["cycles"], 4),
+            "dram_sequential": round(sim_sequential, 4),
+            "dram_row_misses": stats["row_misses"],
+            "bit_exact": bool(bit_exact),
+            "seconds": round(duration, 2),
+        }
+        lines.append("  sim {}x{}: {} cycles, {:.3f} pixels/cycle, DRAM busy {:.1%}, {} row misses, {}".format(
+            sim_width, sim_height, stats["cycles"], report["sim"]["pixels_per_cycle"],
+            report["sim"]["dram_busy"], stats["row_misses"], "matches the model" if bit_exact else "DIFFERS FROM THE MODEL"))
+
+    jpeg = model.JpegModel()
+    for quality in (int(q) for q in args.qualities.split(",")):
+        with Log.stage("encoder-model-q{}".format(quality)):
+            data, psnr = jpeg.encode(y, cb, cr, quality)
+        if args.jpeg_prefix:
+            with open("{}{}.jpg".format(args.jpeg_prefix, quality), "wb") as f:
+                f.write(data)
+        report["jpeg"].append({"quality": quality, "bytes": len(data),
+                               "bits_per_pixel": round(len(data)*8/(width*height), 3), "psnr": round(psnr, 2)})
+        lines.append("  quality {:3}: {:8} bytes/frame, {:.3f} bits/pixel, PSNR {:.2f} dB".format(
+            quality, len(data), len(data)*8/(width*height), psnr))
+
+    if args.report:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    Log.log("\n".join(lines))
+    if not args.no_sim and not report["sim"]["bit_exact"]:
+        raise Exception("The encoder front end differs from its model")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+Host access to the CSRs and memories of a SoC over Etherbone.
+
+Reads and writes are queued and coalesced into records (consecutive writes
+into one write record, any reads into one read record, up to 255 words
+each), which are sent without waiting for the replies of the previous
+ones, up to `window` read packets in flight. Replies are matched to their
+records by the return address, so they may arrive in any order.
+
+Two transports are supported:
+- "udp": LiteEth's hardware Etherbone core (e.g. the mimas_a7 bridge_net
+  target). Lost read packets are resent; writes aren't answered, so a
+  lost write can't be noticed.
+- "tcp": firmware/etherbone.c. It only handles one record per packet and
+  reassembles the stream in a 1512 byte buffer, so records are kept small
+  and only a few are in flight. The firmware reads the packet fields as
+  native words, so it only works on big-endian CPUs (lm32, mor1kx).
+
+The register map is taken from the csr.json or csr.py make.py writes to
+the test directory of the build.
+"""
+
+import argparse
+import json
+import os
+import runpy
+import select
+import socket
+import struct
+import time
+import types
+from collections import deque
+
+from log import Log
+
+
+ETHERBONE_MAGIC = 0x4e6f
+ETHERBONE_VERSION = 1
+ETHERBONE_PORT = 1234
+# Size of the packet header and of a record header with its base address
+PACKET_HEADER_LENGTH = 8
+RECORD_HEADER_LENGTH = 8
+# wcount and rcount are 8-bit fields
+MAX_RECORD_WORDS = 255
+
+# (words per record, read packets in flight, bytes in flight) of each
+# transport. The firmware processes the stream in a 1512 byte buffer, which
+# overflows if more is sent before it catches up.
+TRANSPORT_DEFAULTS = {
+    "udp": (MAX_RECORD_WORDS, 16, 64*1024),
+    "tcp": (64, 8, 1512),
+}
+
+
+def encode_packet_header():
+    # No probe flags; 32-bit addresses and data
+    return struct.pack(">HBBxxxx", ETHERBONE_MAGIC, ETHERBONE_VERSION << 4, 0x44)
+
+
+def encode_write_record(base_addr, payload):
+    """
+    A record writing `payload` (big-endian words) from `base_addr` up.
+    """
+    wcount = len(payload) // 4
+    return struct.pack(">BBBBI", 0, 0x0f, wcount, 0, base_addr) + bytes(payload)
+
+
+def encode_read_record(ret_addr, addrs):
+    """
+    A record reading `addrs`, the reply writes the values to `ret_addr`.
+    """
+    return struct.pack(">BBBBI{}I".format(len(addrs)), 0, 0x0f, 0, len(addrs), ret_addr, *addrs)
+
+
+def decode_records(data, offset=0, max_records=None):
+    """
+    Decodes the packet at `offset` of `data`. Returns its write records as
+    (base address, payload) and the offset after the packet, or None if
+    `data` doesn't hold the complete packet yet. Without `max_records` the
+    packet extends to the end of `data`, as a UDP datagram does.
+    """
+    view = memoryview(data)
+    if len(view) - offset < PACKET_HEADER_LENGTH:
+        return None
+    magic, _, sizes = struct.unpack_from(">HBB", view, offset)
+    if magic != ETHERBONE_MAGIC:
+        raise Exception("Bad Etherbone magic 0x{:04x}".format(magic))
+    if sizes != 0x44:
+        raise Exception("Unsupported Etherbone address/data size 0x{:02x}".format(sizes))
+    pos = offset + PACKET_HEADER_LENGTH
+    records = []
+    while max_records is None or len(records) < max_records:
+        if max_records is None and pos >= len(view):
+            break
+        if len(view) - pos < 4:
+            return None
+        _, _, wcount, rcount = struct.unpack_from(">BBBB", view, pos)
+        length = 4 + (4 + 4*wcount if wcount else 0) + (4 + 4*rcount if rcount else 0)
+        if len(view) - pos < length:
+            return None
+        if wcount:
+            base_addr, = struct.unpack_from(">I", view, pos + 4)
+            records.append((base_addr, view[pos + RECORD_HEADER_LENGTH:pos + RECORD_HEADER_LENGTH + 4*wcount]))
+        pos += length
+    return records, pos
+
+
+class _ReadRecord:
+    def __init__(self):
+        self.addrs = []
+        # (index of the first word, number of words, callback)
+        self.sinks = []
+
+
+class _Packet:
+    def __init__(self, data, tags, writes):
+        self.data = data
+        self.tags = tags
+        self.writes = writes
+        self.sent = 0
+        self.cost = 0
+        self.retries = 0
+
+
+class Pending:
+    """
+    The result of a queued read, available after the queue was flushed.
+    """
+
+    @property
+    def value(self):
+        if not self.done:
+            raise Exception("Read not completed, flush the queue first")
+        return self._value
+
+    def _set(self, value):
+        self._value = value
+        self.done = True
+
+    def __init__(self):
+        self.done = False
+        self._value = None
+
+
+class EtherboneClient:
+    """
+    Queues reads and writes and sends them as pipelined Etherbone packets.
+    """
+
+    def _new_tag(self):
+        self._seq = (self._seq + 1) & 0x3fffffff
+        return self._seq << 2
+
+    def _close_record(self):
+        if self._open is not None:
+            self._records.append(self._open)
+            self._open = None
+            self._send_ready()
+
+    def queue_write_bytes(self, addr, payload):
+        """
+        Queues writing `payload`, big-endian 32-bit words, from `addr` up.
+        """
+        payload = memoryview(payload).cast("B")
+        if len(payload) % 4:
+            raise Exception("Etherbone writes are 32-bit words, got {} bytes".format(len(payload)))
+        pos = 0
+        while pos < len(payload):
+            record = self._open
+            if not (isinstance(record, tuple) and record[0] + len(record[1]) == addr
+                    and len(record[1]) < 4*self.burst):
+                self._close_record()
+                self._open = record = (addr, bytearray())
+            n = min(len(payload) - pos, 4*self.burst - len(record[1]))
+            record[1].extend(payload[pos:pos + n])
+            pos += n
+            addr += n
+            if len(record[1]) == 4*self.burst:
+                self._close_record()
+
+    def queue_write(self, addr, values):
+        """
+        Queues writing the 32-bit `values` to consecutive words from `addr`.
+        """
+        if isinstance(values, int):
+            values = [values]
+        self.queue_write_bytes(addr, struct.pack(">{}I".format(len(values)), *values))
+
+    def queue_read_callback(self, addrs, callback):
+        """
+        Queues reading the words at `addrs`. `callback` gets the index of
+        the first word and the big-endian bytes of consecutive chunks of
+        them, in the order the replies arrive.
+        """
+        addrs = list(addrs)
+        pos = 0
+        while pos < len(addrs):
+            if not isinstance(self._open, _ReadRecord):
+                self._close_record()
+                self._open = _ReadRecord()
+            record = self._open
+            n = min(len(addrs) - pos, self.burst - len(record.addrs))
+            record.addrs.extend(addrs[pos:pos + n])
+            record.sinks.append((pos, n, callback))
+            pos += n
+            if len(record.addrs) == self.burst:
+                self._close_record()
+
+    def queue_read(self, addrs, convert=list):
+        """
+        Queues reading the words at `addrs`. Returns a Pending list of their
+        values, or what `convert` makes of it.
+        """
+        addrs = list(addrs)
+        pending = Pending()
+        data = bytearray(4*len(addrs))
+        received = [0]
+
+        def collect(index, chunk):
+            data[4*index:4*index + len(chunk)] = chunk
+            received[0] += len(chunk)
+            if received[0] == len(data):
+                pending._set(convert(struct.unpack(">{}I".format(len(addrs)), data)))
+        if not addrs:
+            pending._set(convert(()))
+        self.queue_read_callback(addrs, collect)
+        return pending
+
+    def queue_read_into(self, addr, buffer):
+        """
+        Queues a burst read from `addr` into the writable `buffer`, which
+        receives the big-endian words as they arrive.
+        """
+        view = memoryview(buffer).cast("B")
+        if len(view) % 4:
+            raise Exception("Etherbone reads are 32-bit words, got {} bytes".format(len(view)))
+
+        def store(index, chunk):
+            view[4*index:4*index + len(chunk)] = chunk
+        self.queue_read_callback(range(addr, addr + len(view), 4), store)
+
+    def _pack(self, records):
+        data = bytearray(encode_packet_header())
+        tags = []
+        writes = False
+        for record in records:
+            if isinstance(record, _ReadRecord):
+                tag = self._new_tag()
+                self._reads[tag] = record
+                tags.append(tag)
+                data += encode_read_record(tag, record.addrs)
+            else:
+                writes = True
+                base_addr, payload = record
+                self._last_write = base_addr + len(payload) - 4
+                data += encode_write_record(base_addr, payload)
+        return _Packet(bytes(data), tags, writes)
+
+    def _send(self, packet):
+        self._socket.sendall(packet.data)
+        packet.sent = time.monotonic()
+
+    def _send_packet(self, packet):
+        self._send(packet)
+        self._in_flight_bytes += len(packet.data)
+        self._unacked_bytes += len(packet.data)
+        if packet.tags:
+            # Once answered, the target has processed all bytes up to here
+            packet.cost = self._unacked_bytes
+            self._unacked_bytes = 0
+            self._in_flight.add(packet)
+            for tag in packet.tags:
+                self._packets[tag] = packet
+
+    def _wait_for_room(self, length):
+        while len(self._in_flight) >= self.window or \
+                (self._in_flight_bytes and self._in_flight_bytes + length > self.max_in_flight_bytes):
+            if not self._in_flight:
+                # Only writes are in flight, which aren't answered. Read back
+                # the last word written, once the reply arrived the target
+                # has processed them.
+                barrier = _ReadRecord()
+                barrier.addrs.append(self._last_write)
+                barrier.sinks.append((0, 1, lambda index, data: None))
+                self._send_packet(self._pack([barrier]))
+            self._receive()
+
+    def _send_ready(self, flush=False):
+        """
+        Sends the queued records, only in full packets unless `flush`.
+        """
+        while self._records and (flush or len(self._records) >= self.records_per_packet):
+            records = []
+            while self._records and len(records) < self.records_per_packet:
+                records.append(self._records.popleft())
+            packet = self._pack(records)
+            self._wait_for_room(len(packet.data))
+            self._send_packet(packet)
+
+    def _complete(self, tag, payload):
+        record = self._reads.pop(tag, None)
+        if record is None:
+            # Reply to a resent packet which was already answered
+            return
+        if len(payload) != 4*len(record.addrs):
+            raise Exception("Etherbone reply has {} words, expected {}".format(len(payload) // 4, len(record.addrs)))
+        pos = 0
+        for index, n, callback in record.sinks:
+            callback(index, payload[pos:pos + 4*n])
+            pos += 4*n
+        packet = self._packets.pop(tag)
+        if all(t not in self._reads for t in packet.tags):
+            self._in_flight.discard(packet)
+            self._in_flight_bytes -= packet.cost
+
+    def _timeout(self):
+        now = time.monotonic()
+        for packet in list(self._in_flight):
+            if now - packet.sent < self.timeout:
+                continue
+            if self.transport == "tcp" or packet.writes or packet.retries >= self.retries:
+                raise Exception("Etherbone: no reply from {}:{} within {}s".format(self.host, self.port, self.timeout))
+            packet.retries += 1
+            self._send(packet)
+
+    def _receive(self):
+        """
+        Waits for and dispatches the next replies.
+        """
+        oldest = min(packet.sent for packet in self._in_flight)
+        ready, _, _ = select.select([self._socket], [], [], max(0, oldest + self.timeout - time.monotonic()))
+        if not ready:
+            self._timeout()
+            return
+        if self.transport == "udp":
+            decoded = decode_records(self._socket.recv(65536))
+            records = decoded[0] if decoded else []
+        else:
+            data = self._socket.recv(65536)
+            if not data:
+                raise Exception("Etherbone: {}:{} closed the connection".format(self.host, self.port))
+            self._rx += data
+            data = bytes(self._rx)
+            records = []
+            pos = 0
+            while True:
+                # The firmware replies with one record per packet
+                decoded = decode_records(data, pos, max_records=1)
+                if decoded is None:
+                    break
+                records += decoded[0]
+                pos = decoded[1]
+            del self._rx[:pos]
+        for base_addr, payload in records:
+            self._complete(base_addr, payload)
+
+    def flush(self):
+        """
+        Sends everything queued and waits for all replies.
+        """
+        self._close_record()
+        self._send_ready(flush=True)
+        while self._in_flight:
+            self._receive()
+
+    def read(self, addr, count=None):
+        """
+        Reads the word at `addr`, or a list of `count` words from `addr` up.
+        """
+        pending = self.queue_read(range(addr, addr + 4*(count or 1), 4))
+        self.flush()
+        return pending.value if count is not None else pending.value[0]
+
+    def write(self, addr, values):
+        self.queue_write(addr, values)
+        self.flush()
+
+    def read_into(self, addr, buffer):
+        self.queue_read_into(addr, buffer)
+        self.flush()
+
+    def close(self):
+        if self._socket is not None:
+            self.flush()
+            self._socket.close()
+            self._socket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __init__(self, host, port=ETHERBONE_PORT, transport="udp", burst=None, window=None,
+                 records_per_packet=1, timeout=1.0, retries=2):
+        """
+        `burst` is the number of words per record, `window` the number of
+        read packets in flight. Packets carry one record unless the target
+        handles several (`records_per_packet`). Writes aren't answered, after
+        too many bytes of writes a read of the last word written waits for
+        the target to catch up.
+        """
+        if transport not in TRANSPORT_DEFAULTS:
+            raise Exception("Unknown Etherbone transport {}".format(transport))
+        default_burst, default_window, self.max_in_flight_bytes = TRANSPORT_DEFAULTS[transport]
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.burst = max(1, min(MAX_RECORD_WORDS, burst or default_burst))
+        self.window = max(1, window or default_window)
+        self.records_per_packet = 1 if transport == "tcp" else max(1, records_per_packet)
+        self.timeout = timeout
+        self.retries = retries
+
+        self._seq = 0
+        self._open = None
+        self._records = deque()
+        self._reads = {}
+        self._packets = {}
+        self._in_flight = set()
+        self._in_flight_bytes = 0
+        self._unacked_bytes = 0
+        self._last_write = 0
+        self._rx = bytearray()
+        if transport == "udp":
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.connect((host, port))
+        else:
+            self._socket = socket.create_connection((host, port), timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def load_csr_map(filename):
+    """
+    Loads the register map from a csr.json or a csr.py file.
+    """
+    if filename.endswith(".py"):
+        module = runpy.run_path(filename)
+        return {name: module.get(name, {}) for name in ("csr_bases", "csr_registers", "constants", "memories")}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+class Register:
+    """
+    A CSR of `size` bus words of `busword` bits, the most significant one
+    first.
+    """
+
+    def _combine(self, words):
+        value = 0
+        mask = (1 << self.busword) - 1
+        for word in words:
+            value = value << self.busword | (word & mask)
+        return value
+
+    def _split(self, value):
+        mask = (1 << self.busword) - 1
+        return [(value >> (self.busword*(self.size - 1 - i))) & mask for i in range(self.size)]
+
+    def queue_read(self):
+        """
+        Queues reading the register, returns a Pending value.
+        """
+        return self._client.queue_read(range(self.addr, self.addr + 4*self.size, 4), self._combine)
+
+    def queue_write(self, value):
+        if self.readonly:
+            raise Exception("CSR {} is read-only".format(self.name))
+        self._client.queue_write(self.addr, self._split(value))
+
+    def read(self):
+        pending = self.queue_read()
+        self._client.flush()
+        return pending.value
+
+    def write(self, value):
+        self.queue_write(value)
+        self._client.flush()
+
+    def __repr__(self):
+        return "<Register {} @0x{:08x}, {} {}>".format(self.name, self.addr, self.size, self.type)
+
+    def __init__(self, client, name, addr, size, type, busword):
+        self._client = client
+        self.name = name
+        self.addr = addr
+        self.size = size
+        self.type = type
+        self.readonly = type == "ro"
+        self.busword = busword
+
+
+class RemoteSoC:
+    """
+    The register map of a SoC, accessed through an EtherboneClient. The
+    registers are attributes of `regs`, e.g. soc.regs.hdmi_in0_resdetection_hres.
+    """
+
+    def registers(self, prefix=""):
+        return [reg for name, reg in sorted(self._registers.items()) if name.startswith(prefix)]
+
+    def read_registers(self, registers):
+        """
+        Reads `registers` in one batch, returns their values by name.
+        """
+        pending = [(reg.name, reg.queue_read()) for reg in registers]
+        self.client.flush()
+        return {name: p.value for name, p in pending}
+
+    def __init__(self, client, csr_map, busword=None):
+        self.client = client
+        self.bases = csr_map.get("csr_bases", {})
+        self.constants = csr_map.get("constants", {})
+        self.memories = csr_map.get("memories", {})
+        busword = busword or self.constants.get("config_csr_data_width") or 8
+        self._registers = {name: Register(client, name, reg["addr"], reg["size"], reg["type"], busword)
+                           for name, reg in csr_map.get("csr_registers", {}).items()}
+        self.regs = types.SimpleNamespace(**self._registers)
+
+
+def get_client_args(parser):
+    parser.add_argument("--csr", default=None, help="csr.json or csr.py (default: from the test directory of the build)")
+    parser.add_argument("--host", default=None, help="address of the SoC (default: <iprange>.50)")
+    parser.add_argument("--port", type=int, default=ETHERBONE_PORT)
+    parser.add_argument("--transport", choices=sorted(TRANSPORT_DEFAULTS), default="udp",
+                        help="udp for LiteEth's Etherbone core, tcp for the firmware")
+    parser.add_argument("--burst", type=int, default=None, help="words per Etherbone record")
+    parser.add_argument("--window", type=int, default=None, help="read packets in flight")
+    parser.add_argument("--records-per-packet", type=int, default=1, help="records per UDP packet, if the SoC handles several")
+    parser.add_argument("--busword", type=int, default=None, help="CSR data width (default: from the register map, or 8)")
+
+
+def open_soc(args):
+    from make import get_testdir
+    csr = args.csr or os.path.join(get_testdir(args), "csr.json")
+    host = args.host or "{}.50".format(args.iprange)
+    client = EtherboneClient(host, args.port, args.transport, args.burst, args.window, args.records_per_packet)
+    return RemoteSoC(client, load_csr_map(csr), args.busword)
+
+
+def main():
+    from make import get_args
+    parser = argparse.ArgumentParser(description="CSR access over Etherbone")
+    get_args(parser)
+    get_client_args(parser)
+    parser.add_argument("--count", type=int, default=1, help="number of times to read")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between reads")
+    parser.add_argument("command", choices=["list", "read", "write"])
+    parser.add_argument("names", nargs="*", help="registers or register prefixes (read), register and value (write)")
+    args = parser.parse_args()
+
+    soc = open_soc(args)
+    with soc.client:
+        if args.command == "list":
+            Log.log("\n".join(repr(reg) for reg in soc.registers()))
+        elif args.command == "write":
+            if len(args.names) != 2:
+                raise Exception("write takes a register and a value")
+            getattr(soc.regs, args.names[0]).write(int(args.names[1], 0))
+        else:
+            registers = [reg for prefix in args.names or [""] for reg in soc.registers(prefix)]
+            for i in range(args.count):
+                if i:
+                    time.sleep(args.interval)
+                values = soc.read_registers(registers)
+                Log.log("\n".join("{:48} 0x{:x}".format(name, value) for name, value in values.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Checks EtherboneClient against a loopback UDP Etherbone target: the data
+read and written, that reads and writes are coalesced into full records
+and multi-record packets, that no more than `window` read packets are in
+flight, and that a lost read packet is resent.
+
+The target answers the read records of a packet with one reply packet, as
+LiteEth's Etherbone core does, but holds the replies until the client has
+stopped sending for `--latency` seconds, so the client fills its window.
+"""
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+from select import select
+
+from etherbone import EtherboneClient, ETHERBONE_MAGIC, PACKET_HEADER_LENGTH, encode_packet_header
+
+
+class LoopbackTarget:
+    """
+    An Etherbone target on 127.0.0.1 with a word-addressed memory.
+    """
+
+    def _decode(self, data):
+        magic, = struct.unpack_from(">H", data)
+        if magic != ETHERBONE_MAGIC:
+            raise Exception("Bad Etherbone magic 0x{:04x}".format(magic))
+        pos = PACKET_HEADER_LENGTH
+        writes = []
+        reads = []
+        while pos < len(data):
+            _, _, wcount, rcount = struct.unpack_from(">BBBB", data, pos)
+            pos += 4
+            if wcount:
+                base_addr, = struct.unpack_from(">I", data, pos)
+                writes.append((base_addr, struct.unpack_from(">{}I".format(wcount), data, pos + 4)))
+                pos += 4 + 4*wcount
+            if rcount:
+                ret_addr, = struct.unpack_from(">I", data, pos)
+                reads.append((ret_addr, struct.unpack_from(">{}I".format(rcount), data, pos + 4)))
+                pos += 4 + 4*rcount
+        return writes, reads
+
+    def _handle(self, data, client):
+        writes, reads = self._decode(data)
+        self.packets.append((len(writes), len(reads)))
+        self.record_words += [len(words) for _, words in writes] + [len(addrs) for _, addrs in reads]
+        if reads and self.drop_reads:
+            self.drop_reads -= 1
+            self.dropped += 1
+            return
+        for base_addr, words in writes:
+            for i, word in enumerate(words):
+                self.memory[base_addr + 4*i] = word
+        if reads:
+            reply = bytearray(encode_packet_header())
+            for ret_addr, addrs in reads:
+                reply += struct.pack(">BBBBI", 0, 0x0f, len(addrs), 0, ret_addr)
+                reply += struct.pack(">{}I".format(len(addrs)), *(self.memory.get(addr, 0) for addr in addrs))
+            self.replies.append((bytes(reply), client))
+            self.max_in_flight = max(self.max_in_flight, len(self.replies))
+
+    def _run(self):
+        while not self._stop:
+            ready, _, _ = select([self.socket], [], [], self.latency)
+            if ready:
+                data, client = self.socket.recvfrom(65536)
+                self._handle(data, client)
+            else:
+                for reply, client in self.replies:
+                    self.socket.sendto(reply, client)
+                self.replies = []
+
+    def reset_stats(self):
+        # (write records, read records) of each packet received
+        self.packets = []
+        self.record_words = []
+        self.max_in_flight = 0
+        self.dropped = 0
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+        self.socket.close()
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.memory = {}
+        self.replies = []
+        self.drop_reads = 0
+        self.reset_stats()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+def check_writes(target, args):
+    errors = []
+    words = [(i*0x9e3779b1) & 0xffffffff for i in range(args.words)]
+    target.reset_stats()
+    with EtherboneClient("127.0.0.1", target.port, burst=args.burst, window=args.window,
+                         records_per_packet=args.records_per_packet) as client:
+        client.queue_write(0x1000, words)
+        client.flush()
+        # Writes aren't answered, once this read is the target has them all
+        client.read(0x1000)
+    written = [target.memory.get(0x1000 + 4*i) for i in range(args.words)]
+    if written != words:
+        errors.append("written words differ")
+    write_packets = [w for w, r in target.packets if not r]
+    write_records = target.record_words[:sum(write_packets)]
+    expected_records = -(-args.words // args.burst)
+    if len(write_records) != expected_records:
+        errors.append("{} write records for {} words, expected {}".format(len(write_records), args.words, expected_records))
+    if any(n != args.burst for n in write_records[:-1]):
+        errors.append("write records not filled to {} words: {}".format(args.burst, write_records))
+    if any(n != args.records_per_packet for n in write_packets[:-1]):
+        errors.append("write records not packed {} per packet: {}".format(args.records_per_packet, write_packets))
+    return "{} words in {} packets".format(args.words, len(write_packets)), errors
+
+
+def check_reads(target, args):
+    errors = []
+    # Scattered addresses, as a register dump reads them
+    addrs = [0x1000 + 4*((i*7) % args.words) for i in range(args.words)]
+    target.reset_stats()
+    with EtherboneClient("127.0.0.1", target.port, burst=args.burst, window=args.window,
+                         records_per_packet=args.records_per_packet) as client:
+        pending = [client.queue_read([addr]) for addr in addrs]
+        client.flush()
+    values = [p.value[0] for p in pending]
+    if values != [target.memory.get(addr, 0) for addr in addrs]:
+        errors.append("read words differ")
+    expected_records = -(-args.words // args.burst)
+    if sum(r for _, r in target.packets) != expected_records:
+        errors.append("{} read records for {} single-word reads, expected {}".format(
+            sum(r for _, r in target.packets), args.words, expected_records))
+    read_packets = [r for _, r in target.packets]
+    if any(n != args.records_per_packet for n in read_packets[:-1]):
+        errors.append("read records not packed {} per packet: {}".format(args.records_per_packet, read_packets))
+    if target.max_in_flight > args.window:
+        errors.append("{} read packets in flight, window is {}".format(target.max_in_flight, args.window))
+    if len(read_packets) > args.window and target.max_in_flight < args.window:
+        errors.append("only {} of {} read packets in flight".format(target.max_in_flight, args.window))
+    return "{} reads in {} packets, up to {} in flight".format(args.words, len(read_packets), target.max_in_flight), errors
+
+
+def check_resend(target, args):
+    errors = []
+    target.reset_stats()
+    target.drop_reads = 1
+    with EtherboneClient("127.0.0.1", target.port, burst=args.burst, window=args.window,
+                         records_per_packet=args.records_per_packet, timeout=0.2) as client:
+        value = client.read(0x1000)
+    if value != target.memory.get(0x1000, 0):
+        errors.append("read after a lost packet returned 0x{:08x}".format(value))
+    if target.dropped != 1:
+        errors.append("no read packet was lost")
+    return "{} lost packet resent".format(target.dropped), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=4000, help="words written and read")
+    parser.add_argument("--burst", type=int, default=255, help="words per Etherbone record")
+    parser.add_argument("--window", type=int, default=4, help="read packets in flight")
+    parser.add_argument("--records-per-packet", type=int, default=3, help="records per UDP packet")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the target holds its replies")
+    args = parser.parse_args()
+
+    target = LoopbackTarget(args.latency)
+    failed = False
+    try:
+        for name, check in (("writes", check_writes), ("reads", check_reads), ("resend", check_resend)):
+            summary, errors = check(target, args)
+            print("{:8} {:5} {}".format(name, "fail" if errors else "pass", summary))
+            for error in errors:
+                print("         {}".format(error))
+            failed |= bool(errors)
+    finally:
+        target.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,36 @@
 import config
+import download
+import git_cache
 import sys
 import os
 import os.path as Path
-import git
 import re
 import subprocess
-import requests
 import shutil
 from log import Log
 
 
-class Progress(git.remote.RemoteProgress):
-    def update(self, op_code, cur_count, max_count=None, message=''):
-        if len(message) == 0:
-            Log.log('update(%s, %s)' % (cur_count, max_count))
-        else:
-            Log.log('update(%s, %s, %s)' % (cur_count, max_count, message))
+def get_soc_args(cfg):
+    """
+    make.py options of the configured SoC. The scripts using a built SoC
+    (patch_bitstream.py, sim.py...) need the same ones as the build, as
+    some of them select the build dir.
+    """
+    section = cfg._config[cfg._default_section]
+    arg_list = ['--platform', cfg.platform(),
+                '--target', cfg.target(),
+                '--cpu-type', cfg.cpu(),
+                '--iprange', section.get(
+                    'tftp-iprange',
+                    FirmwareManager.BUILD_FIRMWARE_DEFAULT['tftp-iprange'])]
+    if cfg.cpu_variant():
+        arg_list += ['--cpu-variant', cfg.cpu_variant()]
+    # "<name> <value>", e.g. target-option = tofe_board lowspeedio
+    for opt, flag in (('platform-option', '-Op'), ('target-option', '-Ot')):
+        values = section.get(opt, '').split()
+        if len(values) > 1:
+            arg_list += [flag] + values
+    return arg_list
 
 
 class FirmwareManager:
@@ -59,7 +74,10 @@ class FirmwareManager:
         'rootfs-url': ROOTFS,
         'dtb-url': DTB,
         'buildroot-url': BUILDROOT,
-        'llv-url': LLV
+        'llv-url': LLV,
+        'linux-config-sha256': {},
+        'rootfs-sha256': {},
+        'dtb-sha256': {},
     }
 
     # Zephyr defaults:
@@ -84,6 +102,7 @@ class FirmwareManager:
         'firmware-branch': ZEPHYR_BRANCH,
         'zephyr-sdk-url': ZEPHYR_SDK,
         'zephyr-sdk-dir': ZEPHYR_SDK_DIR,
+        'zephyr-sdk-sha256': {},
         'zephyr-app': {},
     }
 
@@ -108,8 +127,33 @@ class FirmwareManager:
     # Build low-level firmware + LiteX defaults:
     BUILD_FIRMWARE_DEFAULT = {
         'tftp-iprange': '192.168.100',
+        'firmware-fast-path': 'yes',
+    }
+
+    # Source checkouts:
+    # git-cache: clone through the shared mirror cache (yes/no)
+    # git-depth, git-filter: shallow/partial clones when not using the cache
+    GIT_DEFAULT = {
+        'git-cache': 'yes',
+        'git-depth': '',
+        'git-filter': '',
     }
 
+    def clone(self, url, destination, branch=None, submodules=False):
+        if self.ADDITIONAL_OPT['git-cache'] == 'yes':
+            ignored = [opt for opt in ('git-depth', 'git-filter')
+                       if self.ADDITIONAL_OPT[opt]]
+            if ignored:
+                Log.log(f"Ignoring {', '.join(ignored)} with git-cache=yes,"
+                        " the checkout borrows all the objects of the mirror")
+            git_cache.GitMirrorCache(jobs=self.ADDITIONAL_OPT['jobs']) \
+                .checkout(url, destination, branch, submodules)
+        else:
+            git_cache.clone(url, destination, branch, submodules,
+                            self.ADDITIONAL_OPT['jobs'],
+                            self.ADDITIONAL_OPT['git-depth'],
+                            self.ADDITIONAL_OPT['git-filter'])
+
     # This builds low-level firmware and sets up LiteX stuff in build dir
     def build_firmware(self):
         for opt in self.BUILD_FIRMWARE_DEFAULT.keys():
@@ -119,34 +163,20 @@ class FirmwareManager:
                 self.ADDITIONAL_OPT[opt] = \
                     self.cfg._config[self.cfg._default_section][opt]
 
-        arg_list = ['python', 'scripts/make.py',
-                    '--platform',
-                    self.cfg.platform(),
-                    '--target',
-                    self.cfg.target(),
-                    '--cpu-type',
-                    self.cfg.cpu(),
-                    '--iprange',
-                    self.ADDITIONAL_OPT["tftp-iprange"],
-                    '--no-compile-gateware']
-
-        if not self.cfg.cpu_variant() == None:
-            arg_list.append('--cpu-variant')
-            arg_list.append(self.cfg.cpu_variant())
-
-        if len(self.ADDITIONAL_OPT["platform-option"]) > 1:
-            arg_list.append('-Op')
-            for arg in self.ADDITIONAL_OPT["platform-option"]:
-                arg_list.append(arg)
-        if len(self.ADDITIONAL_OPT["target-option"]) > 1:
-            arg_list.append('-Ot')
-            for arg in self.ADDITIONAL_OPT["target-option"]:
-                arg_list.append(arg)
+        arg_list = ['python', 'scripts/make.py'] + get_soc_args(self.cfg) + \
+            ['--no-compile-gateware']
+
         if len(self.ADDITIONAL_OPT["build-option"]) > 1:
             arg_list.append('-Ob')
             for arg in self.ADDITIONAL_OPT["build-option"]:
                 arg_list.append(arg)
 
+        # The SoC only has to be elaborated again if its inputs changed,
+        # otherwise make.py restores the generated headers from its
+        # elaboration cache and only rebuilds the software packages.
+        if self.ADDITIONAL_OPT['firmware-fast-path'] != 'yes':
+            arg_list.append('--no-elaboration-cache')
+
         subprocess.check_call(arg_list)
 
     def build_micropython(self):
@@ -178,13 +208,8 @@ class FirmwareManager:
         # Download Micro Python
         if not os.path.exists(self.FIRMWARE_DIR):
             Log.log(f"Cloning into {self.FIRMWARE_DIR} ...")
-            r = git.Repo.clone_from(self.ADDITIONAL_OPT['firmware-url'],
-                                    self.FIRMWARE_DIR,
-                                    branch=self.ADDITIONAL_OPT['firmware-branch'],
-                                    progress=Progress())
-
-            for submodule in r.submodules:
-                submodule.update(init=True)
+            self.clone(self.ADDITIONAL_OPT['firmware-url'], self.FIRMWARE_DIR,
+                       self.ADDITIONAL_OPT['firmware-branch'], submodules=True)
 
         micropython_build_dir = Path.join(self.target_dir, 'software', 'micropython')
         micropython_inc_dir = Path.join(self.target_dir, 'software', 'include')
@@ -204,6 +229,8 @@ class FirmwareManager:
                                '-C', f'{Path.join(self.FIRMWARE_DIR, "ports", "fupy")}'])
 
     def build_zephyr(self):
+        import requests
+
         supported_variants = ['lite', 'full', 'standard', 'linux']
         if not self.cfg.cpu() == "vexriscv":
             raise Exception(f'Unsupported CPU: {self.cfg.cpu()} '
@@ -264,10 +291,10 @@ class FirmwareManager:
                 sdk_version = url.split('/')[-1][1:]
                 sdk_url = f'{url.replace("tag", "download")}/zephyr-sdk-{sdk_version}-setup.run'
                 Log.log(f"Downloading Zephyr SDK {sdk_version} to {self.THIRD_PARTY_DIR} ...")
-                subprocess.check_call(['wget', '-nc', '-P',
-                                       self.THIRD_PARTY_DIR, sdk_url])
                 sdk = Path.join(self.THIRD_PARTY_DIR,
                                 f'zephyr-sdk-{sdk_version}-setup.run')
+                download.DownloadCache().install(
+                    sdk_url, sdk, self.ADDITIONAL_OPT['zephyr-sdk-sha256'])
                 subprocess.check_call(['chmod', 'u+x', sdk])
                 subprocess.check_call([sdk, '--', '-y', '-d', zephyr_sdk_dir])
             else:
@@ -375,23 +402,19 @@ class FirmwareManager:
         # Download data
         if not os.path.exists(self.FIRMWARE_DIR):
             Log.log(f"Cloning into {self.FIRMWARE_DIR} ...")
-            git.Repo.clone_from(self.ADDITIONAL_OPT['firmware-url'],
-                                self.FIRMWARE_DIR,
-                                branch=self.ADDITIONAL_OPT['firmware-branch'],
-                                progress=Progress())
+            self.clone(self.ADDITIONAL_OPT['firmware-url'], self.FIRMWARE_DIR,
+                       self.ADDITIONAL_OPT['firmware-branch'])
 
         if not os.path.exists(BUILDROOT_DIR) \
                 and 'buildroot' in self.firmware_target:
             Log.log(f"Cloning into {self.BUILDROOT_DIR} ...")
-            git.Repo.clone_from(self.ADDITIONAL_OPT['buildroot-url'],
-                                BUILDROOT_DIR, progress=Progress())
+            self.clone(self.ADDITIONAL_OPT['buildroot-url'], BUILDROOT_DIR)
 
         if not os.path.exists(LLV_DIR) \
                 and self.cfg.cpu() == "vexriscv" \
                 and 'buildroot' in self.firmware_target:
             Log.log(f"Cloning into {self.LLV_DIR} ...")
-            git.Repo.clone_from(self.ADDITIONAL_OPT['llv-url'],
-                                LLV_DIR, progress=Progress())
+            self.clone(self.ADDITIONAL_OPT['llv-url'], LLV_DIR)
 
         if self.cfg.cpu() == "vexriscv" \
                 and 'buildroot' in self.firmware_target:
@@ -400,20 +423,29 @@ class FirmwareManager:
             sys.exit(-1)
         else:
             Log.log("Linux-LiteX")
-            subprocess.check_call(['wget', '-nc', '-P', self.FIRMWARE_DIR,
-                                   self.ADDITIONAL_OPT['rootfs-url']])
+            downloads = download.DownloadCache()
+            rootfs_url = self.ADDITIONAL_OPT['rootfs-url']
+            downloads.install(rootfs_url,
+                              Path.join(self.FIRMWARE_DIR,
+                                        Path.basename(rootfs_url)),
+                              self.ADDITIONAL_OPT['rootfs-sha256'])
             if not self.ADDITIONAL_OPT['linux-config-url'] == '':
-                subprocess.check_call(['wget', '-nc', '-P',
-                                       Path.join(self.FIRMWARE_DIR, '.config'),
-                                       self.ADDITIONAL_OPT['linux-config-url']])
+                # olddefconfig rewrites .config, so it needs its own copy
+                downloads.install(self.ADDITIONAL_OPT['linux-config-url'],
+                                  Path.join(self.FIRMWARE_DIR, '.config'),
+                                  self.ADDITIONAL_OPT['linux-config-sha256'],
+                                  writable=True)
                 subprocess.check_call(['make', 'olddefconfig'],
                                       cwd=self.FIRMWARE_DIR)
             else:
                 subprocess.check_call(['make', 'litex_defconfig'],
                                       cwd=self.FIRMWARE_DIR)
             if not self.ADDITIONAL_OPT['dtb-url'] == '':
-                subprocess.check_call(['wget', '-nc', '-P', self.FIRMWARE_DIR,
-                                       self.ADDITIONAL_OPT['dtb-url']])
+                dtb_url = self.ADDITIONAL_OPT['dtb-url']
+                downloads.install(dtb_url,
+                                  Path.join(self.FIRMWARE_DIR,
+                                            Path.basename(dtb_url)),
+                                  self.ADDITIONAL_OPT['dtb-sha256'])
 
             if self.cfg.cpu() == "mor1kx":
                 os.environ["KERNEL_BINARY"] = "vmlinux.bin"
@@ -452,13 +484,21 @@ class FirmwareManager:
             'dtb-url': str(),
             'buildroot-url': str(),
             'llv-url': str(),
+            'linux-config-sha256': str(),
+            'rootfs-sha256': str(),
+            'dtb-sha256': str(),
             'tftp-iprange': str(),
+            'firmware-fast-path': str(),
+            'git-cache': str(),
+            'git-depth': str(),
+            'git-filter': str(),
             'platform-option': list(),
             'target-option': list(),
             'build-option': list(),
             'zephyr-sdk-url': str(),
             'zephyr-sdk-dir': str(),
             'zephyr-sdk-local': str(),
+            'zephyr-sdk-sha256': str(),
             'zephyr-app': str(),
             'jobs': int(),
         }
@@ -485,6 +525,13 @@ class FirmwareManager:
         else:
             self.ADDITIONAL_OPT['jobs'] = 1
 
+        for opt in self.GIT_DEFAULT.keys():
+            if opt not in self.cfg._config[self.cfg._default_section].keys():
+                self.ADDITIONAL_OPT[opt] = self.GIT_DEFAULT[opt]
+            else:
+                self.ADDITIONAL_OPT[opt] = \
+                    self.cfg._config[self.cfg._default_section][opt]
+
         # Base firmware_target
         self.firmware_target = f"{self.firmware}-{self.cfg.cpu()}"
 
@@ -509,16 +556,17 @@ def firmware():
     cfg = config.ConfigManager()
     fm = FirmwareManager(cfg.firmware(), cfg)
 
-    try:
-        if not cfg.firmware() == 'zephyr':
-            fm.build_firmware()
-    except Exception as e:
-        Log.log(e)
-        sys.exit(-1)
-
-    try:
-        if not cfg.firmware() == 'hdmi2usb' and not cfg.firmware() == 'stub':
-            fm.run()
-    except Exception as e:
-        Log.log(e)
-        sys.exit(-1)
+    with Log.stage("firmware"):
+        try:
+            if not cfg.firmware() == 'zephyr':
+                fm.build_firmware()
+        except Exception as e:
+            Log.log(e)
+            sys.exit(-1)
+
+        try:
+            if not cfg.firmware() == 'hdmi2usb' and not cfg.firmware() == 'stub':
+                fm.run()
+        except Exception as e:
+            Log.log(e)
+            sys.exit(-1)
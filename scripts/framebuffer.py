@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Reads or writes a video framebuffer of a running SoC over Etherbone.
+
+The framebuffers are laid out in main RAM as in firmware/framebuffer.h.
+Each 32-bit word holds two YCbCr 4:2:2 pixels, packed as in
+firmware/pattern.py: Y0 | Cr << 8 | Y1 << 16 | Cb << 24. Raw files hold
+these words in little-endian order, which is the YVYU pixel format
+(e.g. ffmpeg -f rawvideo -pix_fmt yvyu422).
+
+The frame is read with pipelined Etherbone bursts straight into one
+buffer. NumPy, if installed, speeds up the conversion to PNG.
+"""
+
+import argparse
+import os
+import struct
+import time
+import zlib
+
+from log import Log
+from etherbone import get_client_args, open_soc
+
+
+# As in firmware/framebuffer.h
+FRAMEBUFFER_OFFSET = 0x01000000
+FRAMEBUFFER_PATTERNS = 1
+FRAMEBUFFER_SIZE = 0x400000
+FRAMEBUFFER_COUNT = 4
+
+
+def framebuffer_base(source, index=0):
+    """
+    Offset in main RAM of framebuffer `index` of `source`, "pattern" or
+    "hdmi_in<n>".
+    """
+    if source == "pattern":
+        return FRAMEBUFFER_OFFSET
+    if source.startswith("hdmi_in"):
+        if not 0 <= index < FRAMEBUFFER_COUNT:
+            raise Exception("{} has framebuffers 0 to {}".format(source, FRAMEBUFFER_COUNT - 1))
+        n = int(source[len("hdmi_in"):])
+        return (n + FRAMEBUFFER_PATTERNS + 1)*FRAMEBUFFER_OFFSET + index*FRAMEBUFFER_SIZE
+    raise Exception("Unknown framebuffer source {}".format(source))
+
+
+def get_frame(soc, source, index=0):
+    """
+    Returns the main RAM offset, width and height of the frame of `source`.
+    For "hdmi_out<n>", it's the frame the output currently shows.
+    """
+    def reg(name):
+        if not hasattr(soc.regs, name):
+            raise Exception("The SoC has no CSR {}".format(name))
+        return getattr(soc.regs, name)
+
+    if source.startswith("hdmi_out"):
+        prefix = source + "_core_initiator_"
+        values = soc.read_registers([reg(prefix + "base"), reg(prefix + "hres"), reg(prefix + "vres")])
+        return values[prefix + "base"], values[prefix + "hres"], values[prefix + "vres"]
+    if source.startswith("hdmi_in"):
+        prefix = source + "_resdetection_"
+    else:
+        # The pattern is drawn in the resolution of the outputs
+        prefix = "hdmi_out0_core_initiator_"
+    values = soc.read_registers([reg(prefix + "hres"), reg(prefix + "vres")])
+    return framebuffer_base(source, index), values[prefix + "hres"], values[prefix + "vres"]
+
+
+def words_to_raw(data):
+    """
+    Converts big-endian words, as Etherbone reads them, to a raw frame.
+    """
+    if len(data) % 4:
+        raise Exception("Frame data of {} bytes isn't made of 32-bit words".format(len(data)))
+    # Reverses the bytes of every word, whatever the byte order of the host
+    raw = bytearray(len(data))
+    for i in range(4):
+        raw[i::4] = data[3 - i::4]
+    return bytes(raw)
+
+
+def raw_to_words(data):
+    # The conversion is its own inverse
+    return words_to_raw(data)
+
+
+def _rgb_rows_numpy(raw, width, height):
+    import numpy as np
+    pixels = np.frombuffer(raw, dtype=np.uint8).reshape(height, width // 2, 4).astype(np.float32)
+    y = pixels[:, :, [0, 2]]
+    cr = pixels[:, :, 1:2] - 128
+    cb = pixels[:, :, 3:4] - 128
+    rgb = np.stack([y + 1.402*cr, y - 0.344136*cb - 0.714136*cr, y + 1.772*cb], axis=-1)
+    rgb = np.clip(rgb + 0.5, 0, 255).astype(np.uint8).reshape(height, width*3)
+    # Filter type 0 (None) in front of every row
+    return np.hstack([np.zeros((height, 1), dtype=np.uint8), rgb]).tobytes()
+
+
+def _rgb_rows_python(raw, width, height):
+    clip = bytes(min(255, max(0, v)) for v in range(-512, 768))
+
+    def c(v):
+        return clip[int(v + 512.5)]
+    rows = bytearray()
+    stride = width*2
+    for row in range(height):
+        rows.append(0)
+        for y0, cr, y1, cb in struct.iter_unpack("4B", raw[row*stride:(row + 1)*stride]):
+            cr -= 128
+            cb -= 128
+            dr, dg, db = 1.402*cr, -0.344136*cb - 0.714136*cr, 1.772*cb
+            rows += bytes((c(y0 + dr), c(y0 + dg), c(y0 + db), c(y1 + dr), c(y1 + dg), c(y1 + db)))
+    return bytes(rows)
+
+
+def write_png(filename, raw, width, height):
+    """
+    Converts the raw frame to RGB and writes it as PNG.
+    """
+    try:
+        rows = _rgb_rows_numpy(raw, width, height)
+    except ImportError:
+        Log.log("NumPy not found, converting the frame in Python, this takes a few seconds")
+        rows = _rgb_rows_python(raw, width, height)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows, 1)))
+        f.write(chunk(b"IEND", b""))
+
+
+def main():
+    from make import get_args
+    parser = argparse.ArgumentParser(description="Read or write a framebuffer over Etherbone")
+    get_args(parser)
+    get_client_args(parser)
+    parser.add_argument("--source", default="hdmi_out0",
+                        help="hdmi_out<n> (the frame shown), hdmi_in<n> or pattern")
+    parser.add_argument("--index", type=int, default=0, help="framebuffer of an hdmi_in<n> source")
+    parser.add_argument("--mode", default=None, help="WIDTHxHEIGHT, instead of the resolution of the source")
+    parser.add_argument("--write", default=None, help="raw frame to write to the framebuffer")
+    parser.add_argument("output", nargs="?", default="frame.png", help="read frame, .png or raw")
+    args = parser.parse_args()
+
+    soc = open_soc(args)
+    if "main_ram" not in soc.memories:
+        raise Exception("The SoC has no main RAM")
+    with soc.client:
+        offset, width, height = get_frame(soc, args.source, args.index)
+        if args.mode:
+            width, height = (int(v) for v in args.mode.lower().split("x"))
+        if not width or not height or width % 2:
+            raise Exception("Bad resolution {}x{} of {}, set it with --mode".format(width, height, args.source))
+        length = width*height*2
+        if length > FRAMEBUFFER_SIZE:
+            raise Exception("{}x{} doesn't fit in a framebuffer".format(width, height))
+        address = soc.memories["main_ram"]["base"] + (offset & 0x0fffffff)
+
+        start = time.monotonic()
+        if args.write:
+            with open(args.write, "rb") as f:
+                raw = f.read()
+            if len(raw) != length:
+                raise Exception("{} has {} bytes, a {}x{} frame {}".format(args.write, len(raw), width, height, length))
+            soc.client.queue_write_bytes(address, raw_to_words(raw))
+            soc.client.flush()
+            action = "Wrote"
+        else:
+            data = bytearray(length)
+            soc.client.read_into(address, data)
+            action = "Read"
+        duration = time.monotonic() - start
+        Log.log("{} {}x{} frame at 0x{:08x} in {:.2f}s ({:.1f} MB/s)".format(
+            action, width, height, address, duration, length / duration / 1e6))
+
+    if not args.write:
+        raw = words_to_raw(data)
+        if args.output.lower().endswith(".png"):
+            write_png(args.output, raw, width, height)
+        else:
+            with open(args.output, "wb") as f:
+                f.write(raw)
+        Log.log("Saved {}".format(os.path.abspath(args.output)))
+
+
+if __name__ == "__main__":
+    main()
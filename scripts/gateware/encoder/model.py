@@ -0,0 +1,297 @@
+"""
+Reference model of the encoder pipeline of core.py, for checking the
+gateware in simulation and estimating throughput and frame sizes without
+synthesis.
+
+- dma_read_addresses(): the DRAM reads of EncoderDMAReader, in order.
+- reorder(): the pixel order EncoderBuffer outputs.
+- JpegModel: the 4:2:2 baseline JPEG of the JpegEnc core, with its header
+  and Huffman tables (vhdl/header.hex) and the quantization tables of
+  firmware/encoder.c.
+
+The frame and pixel order parts are bit-exact. JpegEnc's fixed-point DCT
+isn't, the model uses a floating-point one, so the JPEG sizes are close
+but not identical to the core's.
+"""
+
+import os
+
+import numpy as np
+
+
+PIXEL_BITS = 16  # ycbcr 4:2:2
+BLOCK = 8
+HEADER_HEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vhdl", "header.hex")
+
+# Quantization tables of firmware/encoder.c, in zigzag order
+QUANTIZATION_TABLES = {
+    100: ([1]*64, [1]*64),
+    85: ([
+        0x05, 0x03, 0x04, 0x04, 0x04, 0x03, 0x05, 0x04, 0x04, 0x04, 0x05, 0x05, 0x05, 0x06, 0x07, 0x0C,
+        0x08, 0x07, 0x07, 0x07, 0x07, 0x0F, 0x0B, 0x0B, 0x09, 0x0C, 0x11, 0x0F, 0x12, 0x12, 0x11, 0x0F,
+        0x11, 0x11, 0x13, 0x16, 0x1C, 0x17, 0x13, 0x14, 0x1A, 0x15, 0x11, 0x11, 0x18, 0x21, 0x18, 0x1A,
+        0x1D, 0x1D, 0x1F, 0x1F, 0x1F, 0x13, 0x17, 0x22, 0x24, 0x22, 0x1E, 0x24, 0x1C, 0x1E, 0x1F, 0x1E,
+    ], [
+        0x08, 0x06, 0x06, 0x07, 0x06, 0x05, 0x08, 0x07, 0x07, 0x07, 0x09, 0x09, 0x08, 0x0A, 0x0C, 0x14,
+        0x0D, 0x0C, 0x0B, 0x0B, 0x0C, 0x19, 0x12, 0x13, 0x0F, 0x14, 0x1D, 0x1A, 0x1F, 0x1E, 0x1D, 0x1A,
+        0x1C, 0x1C, 0x20, 0x24, 0x2E, 0x27, 0x20, 0x22, 0x2C, 0x23, 0x1C, 0x1C, 0x28, 0x37, 0x29, 0x2C,
+        0x30, 0x31, 0x34, 0x34, 0x34, 0x1F, 0x27, 0x39, 0x3D, 0x38, 0x32, 0x3C, 0x2E, 0x33, 0x34, 0x32,
+    ]),
+    75: ([
+        0x08, 0x06, 0x06, 0x07, 0x06, 0x05, 0x08, 0x07, 0x07, 0x07, 0x09, 0x09, 0x08, 0x0A, 0x0C, 0x14,
+        0x0D, 0x0C, 0x0B, 0x0B, 0x0C, 0x19, 0x12, 0x13, 0x0F, 0x14, 0x1D, 0x1A, 0x1F, 0x1E, 0x1D, 0x1A,
+        0x1C, 0x1C, 0x20, 0x24, 0x2E, 0x27, 0x20, 0x22, 0x2C, 0x23, 0x1C, 0x1C, 0x28, 0x37, 0x29, 0x2C,
+        0x30, 0x31, 0x34, 0x34, 0x34, 0x1F, 0x27, 0x39, 0x3D, 0x38, 0x32, 0x3C, 0x2E, 0x33, 0x34, 0x32,
+    ], [
+        0x09, 0x09, 0x09, 0x0C, 0x0B, 0x0C, 0x18, 0x0D, 0x0D, 0x18, 0x32, 0x21, 0x1C, 0x21, 0x32, 0x32,
+    ] + [0x32]*48),
+    50: ([
+        0x10, 0x0B, 0x0C, 0x0E, 0x0C, 0x0A, 0x10, 0x0E, 0x0D, 0x0E, 0x12, 0x11, 0x10, 0x13, 0x18, 0x28,
+        0x1A, 0x18, 0x16, 0x16, 0x18, 0x31, 0x23, 0x25, 0x1D, 0x28, 0x3A, 0x33, 0x3D, 0x3C, 0x39, 0x33,
+        0x38, 0x37, 0x40, 0x48, 0x5C, 0x4E, 0x40, 0x44, 0x57, 0x45, 0x37, 0x38, 0x50, 0x6D, 0x51, 0x57,
+        0x5F, 0x62, 0x67, 0x68, 0x67, 0x3E, 0x4D, 0x71, 0x79, 0x70, 0x64, 0x78, 0x5C, 0x65, 0x67, 0x63,
+    ], [
+        0x11, 0x12, 0x12, 0x18, 0x15, 0x18, 0x2F, 0x1A, 0x1A, 0x2F, 0x63, 0x42, 0x38, 0x42, 0x63, 0x63,
+    ] + [0x63]*48),
+}
+QUALITIES = sorted(QUANTIZATION_TABLES, reverse=True)
+
+
+def _zigzag():
+    order = sorted(((x, y) for y in range(BLOCK) for x in range(BLOCK)),
+                   key=lambda p: (p[0] + p[1], p[1] if (p[0] + p[1]) % 2 else p[0]))
+    return np.array([y*BLOCK + x for x, y in order])
+
+
+# Natural (row-major) index of each zigzag position
+ZIGZAG = _zigzag()
+
+
+def dma_read_addresses(h_width, v_width, base=0, dw=128):
+    """
+    Addresses of the reads EncoderDMAReader issues on a `dw`-bit DRAM port
+    for a frame at byte address `base`: 8 lines of a column of 8 pixels,
+    column after column, then the next 8 lines.
+    """
+    burst_pixels = dw//PIXEL_BITS
+    if h_width % BLOCK or v_width % BLOCK or BLOCK % burst_pixels:
+        raise Exception("Frames are read in blocks of {0}x{0} pixels with {1}-pixel bursts".format(BLOCK, burst_pixels))
+    band, column, line, burst = np.meshgrid(
+        np.arange(v_width//BLOCK), np.arange(h_width//BLOCK), np.arange(BLOCK), np.arange(BLOCK//burst_pixels),
+        indexing="ij")
+    pixels = (band*BLOCK + line)*h_width + column*BLOCK + burst*burst_pixels
+    return (base*8//dw + pixels*PIXEL_BITS//dw).reshape(-1)
+
+
+def pack_words(frame, dw=128):
+    """
+    Packs the 16-bit pixels of `frame` into the `dw`-bit words of the DRAM,
+    the first pixel in the most significant bits as EncoderBuffer reads it.
+    """
+    per_word = dw//PIXEL_BITS
+    pixels = np.asarray(frame, dtype=np.uint16).reshape(-1, per_word)
+    words = []
+    for row in pixels.tolist():
+        word = 0
+        for pixel in row:
+            word = (word << PIXEL_BITS) | pixel
+        words.append(word)
+    return words
+
+
+def reorder(frame):
+    """
+    The pixels of `frame` (lines of 16-bit pixels) in the order
+    EncoderBuffer outputs them: 8x8 blocks, line by line inside a block.
+    """
+    v, h = frame.shape
+    return frame.reshape(v//BLOCK, BLOCK, h//BLOCK, BLOCK).transpose(0, 2, 1, 3).reshape(-1)
+
+
+def dram_efficiency(addresses, dw=128, row_bytes=2048):
+    """
+    Returns the fraction of reads that continue the previous one (and could
+    be in the same DRAM burst) and the fraction that stay in its DRAM row.
+    """
+    addresses = np.asarray(addresses, dtype=np.int64)
+    if len(addresses) < 2:
+        return 1.0, 1.0
+    sequential = np.count_nonzero(np.diff(addresses) == 1)
+    rows = addresses*(dw//8)//row_bytes
+    row_hits = np.count_nonzero(np.diff(rows) == 0)
+    return sequential/(len(addresses) - 1), row_hits/(len(addresses) - 1)
+
+
+def frame_from_raw(raw, width, height):
+    """
+    Splits a raw frame, as framebuffer.py saves it (Y0 Cr Y1 Cb), into
+    its Y, Cb and Cr planes and its 16-bit pixels (Y | C << 8).
+    """
+    data = np.frombuffer(raw, dtype=np.uint8).reshape(height, width//2, 4)
+    y = data[:, :, [0, 2]].reshape(height, width)
+    pixels = np.frombuffer(raw, dtype="<u2").reshape(height, width)
+    return y, data[:, :, 3], data[:, :, 1], pixels
+
+
+def _dct_matrix():
+    k = np.arange(BLOCK)
+    c = np.cos((2*k[None, :] + 1)*k[:, None]*np.pi/(2*BLOCK))*np.sqrt(2/BLOCK)
+    c[0] /= np.sqrt(2)
+    return c
+
+
+class JpegModel:
+    """
+    Baseline JPEG of the JpegEnc core: 4:2:2 sampling (MCUs of two Y blocks,
+    a Cb and a Cr block), the standard Huffman tables of header.hex, no
+    restart markers.
+    """
+
+    def _parse_header(self):
+        with open(HEADER_HEX, "r") as f:
+            header = bytes(int(b, 16) for b in f.read().split())
+        tables = {}
+        pos = 2
+        while pos < len(header):
+            marker = header[pos + 1]
+            length = int.from_bytes(header[pos + 2:pos + 4], "big")
+            segment = header[pos + 4:pos + 2 + length]
+            if marker == 0xc0:
+                self._sof = pos
+            elif marker == 0xdb:
+                self._dqt.append(pos + 5)
+            elif marker == 0xc4:
+                while segment:
+                    counts = segment[1:17]
+                    values = segment[17:17 + sum(counts)]
+                    tables[segment[0]] = self._huffman_codes(counts, values)
+                    segment = segment[17 + sum(counts):]
+            pos += 2 + length
+        self.header = header
+        # (DC, AC) tables of luma and chroma
+        self.huffman = [(tables[0x00], tables[0x10]), (tables[0x01], tables[0x11])]
+
+    @staticmethod
+    def _huffman_codes(counts, values):
+        codes = {}
+        code = 0
+        i = 0
+        for length, count in enumerate(counts, 1):
+            for _ in range(count):
+                codes[values[i]] = (code, length)
+                code += 1
+                i += 1
+            code <<= 1
+        return codes
+
+    def get_header(self, width, height, quality):
+        header = bytearray(self.header)
+        header[self._sof + 5:self._sof + 9] = height.to_bytes(2, "big") + width.to_bytes(2, "big")
+        for pos, table in zip(self._dqt, QUANTIZATION_TABLES[quality]):
+            header[pos:pos + 64] = bytes(table)
+        return bytes(header)
+
+    def blocks(self, y, cb, cr):
+        """
+        Returns the 8x8 blocks of the planes in the order the core codes them,
+        with the component of each block (0 luma, 1 chroma).
+        """
+        height, width = y.shape
+        if width % 16 or height % BLOCK:
+            raise Exception("JpegEnc codes frames of 16x8 pixel MCUs, not {}x{}".format(width, height))
+
+        def split(plane, columns):
+            return plane.reshape(height//BLOCK, BLOCK, plane.shape[1]//(BLOCK*columns), columns, BLOCK) \
+                        .transpose(0, 2, 3, 1, 4).reshape(-1, columns, BLOCK, BLOCK)
+        mcus = np.concatenate([split(y, 2), split(cb, 1), split(cr, 1)], axis=1)
+        return mcus.reshape(-1, BLOCK, BLOCK), np.tile([0, 0, 1, 1], len(mcus))
+
+    def quantize(self, blocks, components, quality):
+        """
+        DCT and quantization of the blocks, coefficients in zigzag order.
+        """
+        c = _dct_matrix()
+        coefficients = np.einsum("ij,njk,lk->nil", c, blocks.astype(np.float64) - 128, c).reshape(-1, 64)[:, ZIGZAG]
+        tables = np.array(QUANTIZATION_TABLES[quality], dtype=np.float64)[components]
+        return np.rint(coefficients/tables).astype(np.int32), tables
+
+    def reconstruct(self, quantized, tables):
+        c = _dct_matrix()
+        coefficients = np.empty(quantized.shape)
+        coefficients[:, ZIGZAG] = quantized*tables
+        blocks = np.einsum("ji,njk,kl->nil", c, coefficients.reshape(-1, BLOCK, BLOCK), c) + 128
+        return np.clip(np.rint(blocks), 0, 255)
+
+    def entropy_code(self, quantized, components):
+        """
+        Huffman codes the quantized blocks, returns the scan data with
+        0xFF bytes stuffed.
+        """
+        out = bytearray()
+        acc = 0
+        nbits = 0
+        predictors = [0, 0, 0]
+        # Y, Y, Cb, Cr: DC predictors per component
+        predictor_index = np.tile([0, 0, 1, 2], len(quantized)//4)
+        block_index, positions = np.nonzero(quantized[:, 1:])
+        values = quantized[:, 1:][block_index, positions].tolist()
+        starts = np.searchsorted(block_index, np.arange(len(quantized) + 1)).tolist()
+        positions = positions.tolist()
+        dcs = quantized[:, 0].tolist()
+
+        def bits(v):
+            size = abs(v).bit_length()
+            return size, (v if v >= 0 else v + (1 << size) - 1)
+
+        for n, (component, predictor) in enumerate(zip(components.tolist(), predictor_index.tolist())):
+            dc_codes, ac_codes = self.huffman[component]
+            symbols = []
+            size, amplitude = bits(dcs[n] - predictors[predictor])
+            predictors[predictor] = dcs[n]
+            symbols.append(dc_codes[size] + (amplitude, size))
+            last = -1
+            for i in range(starts[n], starts[n + 1]):
+                run = positions[i] - last - 1
+                while run > 15:
+                    symbols.append(ac_codes[0xf0] + (0, 0))
+                    run -= 16
+                size, amplitude = bits(values[i])
+                symbols.append(ac_codes[(run << 4) | size] + (amplitude, size))
+                last = positions[i]
+            if last != 62:
+                symbols.append(ac_codes[0x00] + (0, 0))
+            for code, length, amplitude, size in symbols:
+                acc = (acc << (length + size)) | (code << size) | amplitude
+                nbits += length + size
+                while nbits >= 8:
+                    nbits -= 8
+                    byte = (acc >> nbits) & 0xff
+                    out.append(byte)
+                    if byte == 0xff:
+                        out.append(0)
+            acc &= (1 << nbits) - 1
+        if nbits:
+            # Pad with ones
+            byte = ((acc << (8 - nbits)) | ((1 << (8 - nbits)) - 1)) & 0xff
+            out.append(byte)
+            if byte == 0xff:
+                out.append(0)
+        return bytes(out)
+
+    def encode(self, y, cb, cr, quality):
+        """
+        Returns the JPEG of the frame and the PSNR of its decoded planes.
+        """
+        height, width = y.shape
+        blocks, components = self.blocks(y, cb, cr)
+        quantized, tables = self.quantize(blocks, components, quality)
+        error = self.reconstruct(quantized, tables) - blocks
+        mse = np.mean(error**2)
+        psnr = float("inf") if mse == 0 else 10*np.log10(255**2/mse)
+        jpeg = self.get_header(width, height, quality) + self.entropy_code(quantized, components) + b"\xff\xd9"
+        return jpeg, psnr
+
+    def __init__(self):
+        self._sof = None
+        self._dqt = []
+        self._parse_header()
@@ -1,5 +1,7 @@
+import array
+import mmap
 import os
-import struct
+import sys
 
 from migen import *
 from litex.soc.interconnect import wishbone
@@ -12,16 +14,36 @@ class MemoryMustHaveContents(Memory):
         return Memory.emit_verilog(memory, ns, add_data_file)
 
 
+# 32-bit unsigned array type code, "I" is only 16-bit on some platforms
+_WORD = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def read_firmware_words(filename, endianness="big"):
+    """
+    Returns the contents of filename as a list of 32-bit words, as a CPU
+    with `endianness` reads them from memory, the last word zero-padded.
+    """
+    with open(filename, "rb") as firmware_file:
+        size = os.fstat(firmware_file.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(firmware_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as image:
+            words = array.array(_WORD)
+            tail = size % 4
+            with memoryview(image) as view:
+                words.frombytes(view[:size - tail])
+            if tail:
+                words.frombytes(image[size - tail:] + bytes(4 - tail))
+    if sys.byteorder != endianness:
+        words.byteswap()
+    return words.tolist()
+
+
 class FirmwareROM(wishbone.SRAM):
     def __init__(self, size, filename):
         if os.path.exists(filename):
-            data = []
-            with open(filename, "rb") as firmware_file:
-                while True:
-                    w = firmware_file.read(4)
-                    if not w:
-                        break
-                    data.append(struct.unpack(">I", w)[0])
+            data = read_firmware_words(filename)
             data_size = len(data)*4
             assert data_size > 0
             assert data_size < size, (
@@ -0,0 +1,191 @@
+"""
+Read cache for executing in place from SPI flash.
+"""
+
+from migen import *
+from migen.genlib.fsm import FSM, NextState, NextValue
+
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import AutoCSR, CSR
+
+
+class FlashCache(Module, AutoCSR):
+    """
+    Direct-mapped (`ways`=1) or 2-way set associative read cache of `size`
+    bytes in front of the Wishbone bus of a flash controller, `slave`.
+
+    Misses refill a line of `line_size` bytes from the flash with an
+    incrementing burst, which SpiFlashDualQuad streams with `with_burst`.
+    The least recently used way of a set is replaced. Hits take two
+    cycles. Writes go to the flash controller uncached.
+
+    The flash is read-only for the bus, but reprogramming it through the
+    bitbang CSRs makes the cache stale: write to `invalidate` afterwards.
+    """
+
+    def __init__(self, slave, size=2048, ways=1, line_size=16):
+        if ways not in (1, 2):
+            raise ValueError("Unsupported value '{}' for ways of the flash cache, 1 or 2".format(ways))
+        line_words = line_size//4
+        lines = size//(line_size*ways)
+        if line_words < 2 or lines < 1 or 2**log2_int(line_words, False) != line_words or 2**log2_int(lines, False) != lines:
+            raise ValueError("Unsupported flash cache of {} bytes in {}-byte lines".format(size, line_size))
+
+        self.bus = bus = wishbone.Interface()
+        self.invalidate = CSR()
+
+        # # #
+
+        offset_bits = log2_int(line_words)
+        index_bits = log2_int(lines)
+        tag_bits = len(bus.adr) - offset_bits - index_bits
+
+        index = bus.adr[offset_bits:offset_bits + index_bits]
+        tag = bus.adr[offset_bits + index_bits:]
+
+        valid = [Signal(lines) for w in range(ways)]
+        # Way to replace next in each set
+        lru = Signal(lines)
+        hits = Signal(ways)
+        victim = Signal(max=max(ways, 2))
+        count = Signal(offset_bits)
+        last = Signal()
+
+        data_ports = []
+        tag_ports = []
+        for w in range(ways):
+            data = Memory(32, lines*line_words)
+            tags = Memory(tag_bits, lines)
+            data_port = data.get_port(write_capable=True)
+            tag_port = tags.get_port(write_capable=True)
+            self.specials += data, tags, data_port, tag_port
+            data_ports.append(data_port)
+            tag_ports.append(tag_port)
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        for w in range(ways):
+            self.comb += [
+                # Read during IDLE, compared during LOOKUP
+                data_ports[w].adr.eq(Mux(fsm.ongoing("REFILL"), Cat(count, index), bus.adr[:offset_bits + index_bits])),
+                data_ports[w].dat_w.eq(slave.dat_r),
+                data_ports[w].we.eq(fsm.ongoing("REFILL") & slave.ack & (victim == w)),
+                tag_ports[w].adr.eq(index),
+                tag_ports[w].dat_w.eq(tag),
+                tag_ports[w].we.eq(fsm.ongoing("REFILL") & slave.ack & last & (victim == w)),
+                hits[w].eq((valid[w] >> index)[0] & (tag_ports[w].dat_r == tag)),
+            ]
+        self.comb += last.eq(count == line_words - 1)
+
+        write = fsm.ongoing("WRITE")
+        self.comb += [
+            slave.cyc.eq(fsm.ongoing("REFILL") | write),
+            slave.stb.eq(fsm.ongoing("REFILL") | write),
+            slave.we.eq(write),
+            If(write,
+                slave.adr.eq(bus.adr),
+                slave.sel.eq(bus.sel),
+                slave.cti.eq(0)
+            ).Else(
+                slave.adr.eq(Cat(count, bus.adr[offset_bits:])),
+                slave.sel.eq(2**len(slave.sel) - 1),
+                slave.cti.eq(Mux(last, 0b111, 0b010))
+            ),
+            slave.bte.eq(0),
+            slave.dat_w.eq(bus.dat_w),
+        ]
+
+        self.sync += [
+            If(self.invalidate.re,
+                [v.eq(0) for v in valid]
+            ).Elif(fsm.ongoing("REFILL") & slave.ack & last,
+                [If(victim == w, v.eq(v | (1 << index))) for w, v in enumerate(valid)]
+            )
+        ]
+
+        fsm.act("IDLE",
+            If(bus.cyc & bus.stb,
+                If(bus.we,
+                    NextState("WRITE")
+                ).Else(
+                    NextState("LOOKUP")
+                )
+            )
+        )
+        fsm.act("LOOKUP",
+            If(hits != 0,
+                bus.ack.eq(1),
+                NextState("IDLE")
+            ).Else(
+                NextValue(count, 0),
+                NextState("REFILL")
+            )
+        )
+        if ways == 2:
+            self.comb += [
+                bus.dat_r.eq(Mux(hits[1], data_ports[1].dat_r, data_ports[0].dat_r)),
+                victim.eq((lru >> index)[0]),
+            ]
+            self.sync += If(fsm.ongoing("LOOKUP") & (hits != 0),
+                # The other way is now the least recently used
+                lru.eq((lru & ~(1 << index)) | (hits[0] << index))
+            )
+        else:
+            self.comb += bus.dat_r.eq(data_ports[0].dat_r)
+        fsm.act("REFILL",
+            If(slave.ack,
+                NextValue(count, count + 1),
+                If(last,
+                    # Looked up again, it's a hit now
+                    NextState("IDLE")
+                )
+            )
+        )
+        fsm.act("WRITE",
+            If(slave.ack,
+                bus.ack.eq(1),
+                NextState("IDLE")
+            )
+        )
+
+
+def pop_flash_cache_args(kwargs):
+    """
+    Pops the flash cache options of the targets from their keyword
+    arguments, given as -Ot spiflash_cache_size 4096, -Ot spiflash_cache_ways 2
+    and -Ot spiflash_cache_line_size 32. Returns the FlashCache arguments,
+    or None without a cache (spiflash_cache_size 0, the default).
+    """
+    args = {}
+    for name, key, default in (("spiflash_cache_size", "size", 0),
+                               ("spiflash_cache_ways", "ways", 1),
+                               ("spiflash_cache_line_size", "line_size", 16)):
+        value = kwargs.pop(name, default)
+        if isinstance(value, str):
+            value = int(value, 0)
+        args[key] = value
+    if not args["size"]:
+        return None
+    return args
+
+
+def spi_flash_args(cache, pads):
+    """
+    Keyword arguments of spi_flash.SpiFlash on `pads` behind the `cache`
+    of pop_flash_cache_args: with a cache, SpiFlashDualQuad streams its
+    line refills in the burst mode.
+    """
+    if cache is None or hasattr(pads, "mosi"):
+        return {}
+    return {"with_burst": True}
+
+
+def add_flash_cache(soc, bus, cache):
+    """
+    Adds the `cache` of pop_flash_cache_args in front of the flash `bus`,
+    as the spiflash_cache submodule of `soc`. Returns the bus to register
+    for the flash.
+    """
+    if cache is None:
+        return bus
+    soc.submodules.spiflash_cache = FlashCache(bus, **cache)
+    return soc.spiflash_cache.bus
@@ -1,6 +1,10 @@
 from migen import *
+from migen.genlib.fifo import SyncFIFO
+from migen.genlib.fsm import FSM, NextState, NextValue
 from migen.genlib.misc import timeline
 
+from migen.genlib.io import DDROutput
+
 from litex.gen import *
 
 from litex.soc.interconnect import wishbone
@@ -27,12 +31,62 @@ def _format_cmd(cmd, spi_width):
     return c
 
 
+def _add_ddr_clock(module, pad, level, enable):
+    """
+    Drives the SPI clock `pad` from a DDR output register (ODDR2 on
+    Spartan-6, ODDR on 7-series): at `level` (for bitbanging), or low in
+    the first half and high in the second half of the sys clock cycles
+    after the ones where `enable` is set, as the register outputs its
+    inputs one cycle later. The other outputs go through
+    `_add_pad_outputs`, which delays them by the same cycle. The flash
+    samples the outputs in the middle of the cycle, so reads transfer one
+    bit per line and sys clock cycle.
+
+    The flash outputs its data after the falling edge, at the end of the
+    cycle, and the core samples it with an input register, `sample_delay`
+    cycles after the clock: 1 when the flash clock to output time and the
+    board delays fit in a cycle, more at higher sys clock rates. Calibrate
+    it with the *_ddr benchmarks of gateware_bench.py and the flash
+    datasheet. The pad must be a regular I/O: the CCLK of the 7-series
+    (STARTUPE2 USRCCLKO) can't be driven from an ODDR.
+    """
+    module.specials.ddr_clk = DDROutput(level, level | enable, pad)
+
+
+# Cycles from the inputs of the DDR output register to the SPI clock
+_DDR_CLOCK_LATENCY = 1
+
+
+def _add_pad_outputs(module, div, outputs):
+    """
+    Drives the pads of the (pad, signal) `outputs`. With `div`=1 they're
+    registered, to reach the pads in the same cycle as the SPI clock from
+    `_add_ddr_clock`.
+    """
+    for pad, signal in outputs:
+        if div == 1:
+            q = Signal(len(signal), reset=signal.reset)
+            module.sync += q.eq(signal)
+            signal = q
+        module.comb += pad.eq(signal)
+
+
 class SpiFlashDualQuad(Module, AutoCSR):
-    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big"):
+    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big",
+                 with_burst=False, prefetch_words=4, sample_delay=1):
         """
         Simple SPI flash.
         Supports multi-bit pseudo-parallel reads (aka Dual or Quad I/O Fast
         Read). Only supports mode0 (cpol=0, cpha=0).
+
+        With `with_burst`, a read keeps CS asserted and streams the
+        following words into a prefetch buffer of `prefetch_words`, pausing
+        the SPI clock when it's full. Sequential reads, and Wishbone
+        incrementing bursts, are served from the buffer without a new
+        command; any other address restarts the stream.
+
+        With `div`=1, the SPI clock runs at the sys clock rate, see
+        `_add_ddr_clock`.
         """
         self.bus = bus = wishbone.Interface()
         spi_width = len(pads.dq)
@@ -47,9 +101,13 @@ class SpiFlashDualQuad(Module, AutoCSR):
 
         cs_n = Signal(reset=1)
         clk = Signal()
+        clk_o = pads.clk if div > 1 else Signal()
+        clk_en = Signal(reset=int(not with_burst and div > 1))
         dq_oe = Signal()
         wbone_width = len(bus.dat_r)
-
+        cs_n_o = Signal(reset=1)
+        dq_o = Signal(spi_width)
+        dq_oe_o = Signal()
 
         read_cmd_params = {
             4: (_format_cmd(_QIOFR, 4), 4*8),
@@ -62,22 +120,25 @@ class SpiFlashDualQuad(Module, AutoCSR):
         self.specials.dq = dq.get_tristate(pads.dq)
 
         sr = Signal(max(cmd_width, addr_width, wbone_width))
+        dat_r = Signal(wbone_width) if with_burst else sr
         if endianness == "big":
-            self.comb += bus.dat_r.eq(sr)
+            self.comb += bus.dat_r.eq(dat_r)
         else:
-            self.comb += bus.dat_r.eq(reverse_bytes(sr))
+            self.comb += bus.dat_r.eq(reverse_bytes(dat_r))
+
+        _add_pad_outputs(self, div, [(pads.cs_n, cs_n_o), (dq.o, dq_o), (dq.oe, dq_oe_o)])
 
         hw_read_logic = [
-            pads.clk.eq(clk),
-            pads.cs_n.eq(cs_n),
-            dq.o.eq(sr[-spi_width:]),
-            dq.oe.eq(dq_oe)
+            clk_o.eq(clk),
+            cs_n_o.eq(cs_n),
+            dq_o.eq(sr[-spi_width:]),
+            dq_oe_o.eq(dq_oe)
         ]
 
         if with_bitbang:
             bitbang_logic = [
-                pads.clk.eq(self.bitbang.storage[1]),
-                pads.cs_n.eq(self.bitbang.storage[2]),
+                clk_o.eq(self.bitbang.storage[1]),
+                cs_n_o.eq(self.bitbang.storage[2]),
 
                 # In Dual/Quad mode, no single data pin is consistently
                 # an input or output thanks to dual/quad reads, so we need a bit
@@ -86,14 +147,14 @@ class SpiFlashDualQuad(Module, AutoCSR):
                 # and dq[1] is miso, meaning remaining data pin values don't
                 # appear in CSR registers.
                 If(self.bitbang.storage[3],
-                    dq.oe.eq(0)
+                    dq_oe_o.eq(0)
                 ).Else(
-                    dq.oe.eq(1)
+                    dq_oe_o.eq(1)
                 ),
                 If(self.bitbang.storage[1], # CPOL=0/CPHA=0 or CPOL=1/CPHA=1 only.
                     self.miso.status.eq(dq.i[1])
                 ),
-                dq.o.eq(Cat(self.bitbang.storage[0], Replicate(1, spi_width-1)))
+                dq_o.eq(Cat(self.bitbang.storage[0], Replicate(1, spi_width-1)))
             ]
 
             self.comb += [
@@ -107,20 +168,32 @@ class SpiFlashDualQuad(Module, AutoCSR):
         else:
             self.comb += hw_read_logic
 
-        if div < 2:
+        if div < 1:
             raise ValueError("Unsupported value \'{}\' for div parameter for SpiFlash core".format(div))
+        elif div == 1:
+            if with_burst:
+                raise ValueError("The burst mode of the SpiFlash core needs div >= 2")
+            i = Signal()
+            dqi = Signal(spi_width)
+            _add_ddr_clock(self, pads.clk, clk_o, clk_en)
+            self.sync += [
+                dqi.eq(dq.i),
+                sr.eq(Cat(dqi, sr[:-spi_width])),
+            ]
         else:
             i = Signal(max=div)
             dqi = Signal(spi_width)
             self.sync += [
                 If(i == div//2 - 1,
-                    clk.eq(1),
+                    clk.eq(clk_en),
                     dqi.eq(dq.i),
                 ),
                 If(i == div - 1,
                     i.eq(0),
                     clk.eq(0),
-                    sr.eq(Cat(dqi, sr[:-spi_width]))
+                    If(clk_en,
+                        sr.eq(Cat(dqi, sr[:-spi_width]))
+                    )
                 ).Else(
                     i.eq(i + 1),
                 ),
@@ -129,20 +202,45 @@ class SpiFlashDualQuad(Module, AutoCSR):
         # spi is byte-addressed, prefix by zeros
         z = Replicate(0, log2_int(wbone_width//8))
 
-        seq = [
-            (cmd_width//spi_width*div,
-                [dq_oe.eq(1), cs_n.eq(0), sr[-cmd_width:].eq(read_cmd)]),
-            (addr_width//spi_width*div,
-                [sr[-addr_width:].eq(Cat(z, bus.adr))]),
-            ((dummy + wbone_width//spi_width)*div,
-                [dq_oe.eq(0)]),
-            (1,
-                [bus.ack.eq(1), cs_n.eq(1)]),
-            (div, # tSHSL!
-                [bus.ack.eq(0)]),
-            (0,
-                []),
-        ]
+        if with_burst:
+            self.add_burst_read(bus, sr, dat_r, clk_en, cs_n, dq_oe, dqi, i == div - 1,
+                read_cmd, cmd_width, addr_width, z, spi_width, dummy, prefetch_words)
+            return
+
+        if div == 1:
+            # The last clock reaches the pad _DDR_CLOCK_LATENCY cycles
+            # after clk_en, and its data is in sr sample_delay cycles later
+            seq = [
+                (cmd_width//spi_width,
+                    [dq_oe.eq(1), cs_n.eq(0), clk_en.eq(1), sr[-cmd_width:].eq(read_cmd)]),
+                (addr_width//spi_width,
+                    [sr[-addr_width:].eq(Cat(z, bus.adr))]),
+                (dummy + wbone_width//spi_width,
+                    [dq_oe.eq(0)]),
+                (_DDR_CLOCK_LATENCY + sample_delay,
+                    [clk_en.eq(0)]),
+                (1,
+                    [bus.ack.eq(1), cs_n.eq(1)]),
+                (2, # tSHSL!
+                    [bus.ack.eq(0)]),
+                (0,
+                    []),
+            ]
+        else:
+            seq = [
+                (cmd_width//spi_width*div,
+                    [dq_oe.eq(1), cs_n.eq(0), sr[-cmd_width:].eq(read_cmd)]),
+                (addr_width//spi_width*div,
+                    [sr[-addr_width:].eq(Cat(z, bus.adr))]),
+                ((dummy + wbone_width//spi_width)*div,
+                    [dq_oe.eq(0)]),
+                (1,
+                    [bus.ack.eq(1), cs_n.eq(1)]),
+                (div, # tSHSL!
+                    [bus.ack.eq(0)]),
+                (0,
+                    []),
+            ]
 
         # accumulate timeline deltas
         t, tseq = 0, []
@@ -152,12 +250,175 @@ class SpiFlashDualQuad(Module, AutoCSR):
 
         self.sync += timeline(bus.cyc & bus.stb & (i == div - 1), tseq)
 
+    def add_burst_read(self, bus, sr, dat_r, clk_en, cs_n, dq_oe, dqi, tick,
+                       read_cmd, cmd_width, addr_width, z, spi_width, dummy, depth):
+        """
+        Streaming reads: the flash side keeps reading the words following
+        `fetch_adr` into the prefetch FIFO, the bus side acks the reads of
+        the word at its head (`head_adr`) and restarts the stream at any
+        address which isn't in the FIFO or being read.
+        """
+        wbone_width = len(dat_r)
+        self.submodules.prefetch = prefetch = ResetInserter()(
+            SyncFIFO(wbone_width, depth))
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+
+        # Bus side
+        head_adr = Signal(len(bus.adr))
+        fetch_adr = Signal(len(bus.adr))
+        restart = Signal()
+        pending = Signal()
+        burst = Signal()
+        streaming = Signal()
+        ahead = Signal(len(bus.adr))
+        skip = Signal()
+        next_adr = Signal(len(bus.adr))
+        wrap = Signal(len(bus.adr))
+        self.comb += [
+            # Next address of an incrementing burst, wrapping at 4, 8 or
+            # 16 words for the wrap burst types
+            Case(bus.bte, {
+                0: wrap.eq(0),
+                1: wrap.eq(2**2 - 1),
+                2: wrap.eq(2**3 - 1),
+                3: wrap.eq(2**4 - 1),
+            }),
+            If(wrap == 0,
+                next_adr.eq(bus.adr + 1)
+            ).Else(
+                next_adr.eq((bus.adr & ~wrap) | ((bus.adr + 1) & wrap))
+            ),
+            burst.eq(bus.ack & (bus.cti == 0b010)),
+            streaming.eq(pending | ~fsm.ongoing("IDLE")),
+            ahead.eq(bus.adr - head_adr),
+            # Drop the words before the address. When the FIFO is full,
+            # the flash clock is paused before the word following it:
+            # drop the head word to resume it.
+            skip.eq(prefetch.readable & ((ahead < prefetch.level) |
+                (streaming & (ahead == prefetch.level) & (prefetch.level == depth)))),
+        ]
+        self.sync += [
+            restart.eq(0),
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~restart,
+                If(burst,
+                    # Registered feedback: ack the next word of the burst
+                    # in the following cycle if it's at the head
+                    If(prefetch.readable & (next_adr == head_adr),
+                        bus.ack.eq(1),
+                        dat_r.eq(prefetch.dout),
+                        head_adr.eq(head_adr + 1)
+                    )
+                ).Elif(~bus.ack,
+                    If(prefetch.readable & (ahead == 0),
+                        bus.ack.eq(1),
+                        dat_r.eq(prefetch.dout),
+                        head_adr.eq(head_adr + 1)
+                    ).Elif(skip,
+                        head_adr.eq(head_adr + 1)
+                    ).Elif(~streaming | (ahead != prefetch.level),
+                        # Not in the FIFO and not being read
+                        restart.eq(1),
+                        fetch_adr.eq(bus.adr),
+                        head_adr.eq(bus.adr)
+                    )
+                )
+            )
+        ]
+        self.comb += [
+            prefetch.re.eq(bus.cyc & bus.stb & ~restart & prefetch.readable &
+                Mux(burst, next_adr == head_adr, ~bus.ack & ((ahead == 0) | skip))),
+            prefetch.reset.eq(restart),
+        ]
+
+        # Flash side, advancing on the SPI clock ticks
+        cmd_clocks = cmd_width//spi_width
+        addr_clocks = addr_width//spi_width
+        data_clocks = wbone_width//spi_width
+        n = Signal(max=max(cmd_clocks, addr_clocks, dummy, data_clocks) + 1)
+        stop = Signal()
+        self.comb += [
+            stop.eq(restart | pending),
+            prefetch.din.eq(Cat(dqi, sr[:-spi_width])),
+        ]
+        self.sync += [
+            If(restart,
+                pending.eq(1)
+            ).Elif(fsm.ongoing("IDLE") & tick,
+                pending.eq(0)
+            )
+        ]
+        self.sync += If(tick,
+            If(fsm.ongoing("IDLE"),
+                If(pending & ~restart,
+                    cs_n.eq(0),
+                    clk_en.eq(1),
+                    dq_oe.eq(1),
+                    sr[-cmd_width:].eq(read_cmd)
+                )
+            ).Elif(stop,
+                # Keep CS high for a clock (tSHSL) before the new command
+                cs_n.eq(1),
+                clk_en.eq(0),
+                dq_oe.eq(0)
+            ).Elif(fsm.ongoing("CMD") & (n == 0),
+                sr[-addr_width:].eq(Cat(z, fetch_adr))
+            ).Elif(fsm.ongoing("ADDR") & (n == 0),
+                dq_oe.eq(0)
+            ).Elif(fsm.ongoing("DATA"),
+                If(~clk_en,
+                    clk_en.eq(prefetch.level < depth)
+                ).Elif(n == 0,
+                    # Pause before the next word if the FIFO is full
+                    clk_en.eq(prefetch.level < depth - 1)
+                )
+            )
+        )
+
+        def phase(next_state, next_clocks):
+            return If(tick & stop,
+                NextState("IDLE")
+            ).Elif(tick & (n == 0),
+                NextValue(n, next_clocks - 1),
+                NextState(next_state)
+            ).Elif(tick,
+                NextValue(n, n - 1)
+            )
+        fsm.act("IDLE",
+            If(tick & pending & ~restart,
+                NextValue(n, cmd_clocks - 1),
+                NextState("CMD")
+            )
+        )
+        fsm.act("CMD", phase("ADDR", addr_clocks))
+        if dummy:
+            fsm.act("ADDR", phase("DUMMY", dummy))
+            fsm.act("DUMMY", phase("DATA", data_clocks))
+        else:
+            fsm.act("ADDR", phase("DATA", data_clocks))
+        fsm.act("DATA",
+            If(tick & stop,
+                NextState("IDLE")
+            ).Elif(tick & clk_en,
+                If(n == 0,
+                    prefetch.we.eq(1),
+                    NextValue(n, data_clocks - 1)
+                ).Else(
+                    NextValue(n, n - 1)
+                )
+            )
+        )
+
 
 class SpiFlashSingle(Module, AutoCSR):
-    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big"):
+    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big", sample_delay=1):
         """
         Simple SPI flash.
         Supports 1-bit reads. Only supports mode0 (cpol=0, cpha=0).
+
+        With `div`=1, the SPI clock runs at the sys clock rate, see
+        `_add_ddr_clock`.
         """
         self.bus = bus = wishbone.Interface()
 
@@ -176,7 +437,11 @@ class SpiFlashSingle(Module, AutoCSR):
 
         cs_n = Signal(reset=1)
         clk = Signal()
+        clk_o = pads.clk if div > 1 else Signal()
+        clk_en = Signal()
         wbone_width = len(bus.dat_r)
+        cs_n_o = Signal(reset=1)
+        mosi_o = Signal()
 
         read_cmd = _FAST_READ
         cmd_width = 8
@@ -188,20 +453,22 @@ class SpiFlashSingle(Module, AutoCSR):
         else:
             self.comb += bus.dat_r.eq(reverse_bytes(sr))
 
+        _add_pad_outputs(self, div, [(pads.cs_n, cs_n_o), (pads.mosi, mosi_o)])
+
         hw_read_logic = [
-            pads.clk.eq(clk),
-            pads.cs_n.eq(cs_n),
-            pads.mosi.eq(sr[-1:])
+            clk_o.eq(clk),
+            cs_n_o.eq(cs_n),
+            mosi_o.eq(sr[-1:])
         ]
 
         if with_bitbang:
             bitbang_logic = [
-                pads.clk.eq(self.bitbang.storage[1]),
-                pads.cs_n.eq(self.bitbang.storage[2]),
+                clk_o.eq(self.bitbang.storage[1]),
+                cs_n_o.eq(self.bitbang.storage[2]),
                 If(self.bitbang.storage[1], # CPOL=0/CPHA=0 or CPOL=1/CPHA=1 only.
                     self.miso.status.eq(pads.miso)
                 ),
-                pads.mosi.eq(self.bitbang.storage[0])
+                mosi_o.eq(self.bitbang.storage[0])
             ]
 
             self.comb += [
@@ -215,8 +482,16 @@ class SpiFlashSingle(Module, AutoCSR):
         else:
             self.comb += hw_read_logic
 
-        if div < 2:
+        if div < 1:
             raise ValueError("Unsupported value \'{}\' for div parameter for SpiFlash core".format(div))
+        elif div == 1:
+            i = Signal()
+            miso = Signal()
+            _add_ddr_clock(self, pads.clk, clk_o, clk_en)
+            self.sync += [
+                miso.eq(pads.miso),
+                sr.eq(Cat(miso, sr[:-1])),
+            ]
         else:
             i = Signal(max=div)
             miso = Signal()
@@ -237,20 +512,40 @@ class SpiFlashSingle(Module, AutoCSR):
         # spi is byte-addressed, prefix by zeros
         z = Replicate(0, log2_int(wbone_width//8))
 
-        seq = [
-            (cmd_width*div,
-                [cs_n.eq(0), sr[-cmd_width:].eq(read_cmd)]),
-            (addr_width*div,
-                [sr[-addr_width:].eq(Cat(z, bus.adr))]),
-            ((dummy + wbone_width)*div,
-                []),
-            (1,
-                [bus.ack.eq(1), cs_n.eq(1)]),
-            (div, # tSHSL!
-                [bus.ack.eq(0)]),
-            (0,
-                []),
-        ]
+        if div == 1:
+            # The last clock reaches the pad _DDR_CLOCK_LATENCY cycles
+            # after clk_en, and its data is in sr sample_delay cycles later
+            seq = [
+                (cmd_width,
+                    [cs_n.eq(0), clk_en.eq(1), sr[-cmd_width:].eq(read_cmd)]),
+                (addr_width,
+                    [sr[-addr_width:].eq(Cat(z, bus.adr))]),
+                (dummy + wbone_width,
+                    []),
+                (_DDR_CLOCK_LATENCY + sample_delay,
+                    [clk_en.eq(0)]),
+                (1,
+                    [bus.ack.eq(1), cs_n.eq(1)]),
+                (2, # tSHSL!
+                    [bus.ack.eq(0)]),
+                (0,
+                    []),
+            ]
+        else:
+            seq = [
+                (cmd_width*div,
+                    [cs_n.eq(0), sr[-cmd_width:].eq(read_cmd)]),
+                (addr_width*div,
+                    [sr[-addr_width:].eq(Cat(z, bus.adr))]),
+                ((dummy + wbone_width)*div,
+                    []),
+                (1,
+                    [bus.ack.eq(1), cs_n.eq(1)]),
+                (div, # tSHSL!
+                    [bus.ack.eq(0)]),
+                (0,
+                    []),
+            ]
 
         # accumulate timeline deltas
         t, tseq = 0, []
@@ -1,6 +1,14 @@
 # RTP Proof of concept, metadata informations are missing (Sync, ...)
 # but this can be used as a basis to implement real RTP
 
+from migen import *
+from migen.genlib.misc import WaitTimer
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.packet import Header, HeaderField, Packetizer
+
+from liteeth.common import eth_udp_user_description
+
 rtp_header_length = 12
 rtp_header_fields = {
     "ver":              HeaderField(0,  6,  2),
@@ -24,7 +32,7 @@ def eth_rtp_description(dw):
         ("data", dw),
         ("error", dw//8)
     ]
-    return EndpointDescription(payload_layout, param_layout, packetized=True)
+    return stream.EndpointDescription(payload_layout, param_layout)
 
 
 def eth_rtp_user_description(dw):
@@ -38,60 +46,58 @@ def eth_rtp_user_description(dw):
         ("data", dw),
         ("error", dw//8)
     ]
-    return EndpointDescription(payload_layout, param_layout, packetized=True)
+    return stream.EndpointDescription(payload_layout, param_layout)
 
 
 class EncoderRTPGenerator(Module):
     def __init__(self, ip_address, udp_port, fifo_depth=1024):
-        self.sink = sink = Sink([("data", 8)])
-        self.source = source = Source(eth_rtp_user_description(8))
+        self.sink = sink = stream.Endpoint([("data", 8)])
+        self.source = source = stream.Endpoint(eth_rtp_user_description(8))
 
         # # #
 
-        self.submodules.fifo = fifo = SyncFIFO([("data", 8)], fifo_depth)
-        self.comb += Record.connect(sink, fifo.sink)
-
-        self.submodules.level = level = FlipFlop(max=fifo_depth+1)
-        self.comb += level.d.eq(fifo.fifo.level)
+        self.submodules.fifo = fifo = stream.SyncFIFO([("data", 8)], fifo_depth)
+        self.comb += sink.connect(fifo.sink)
 
-        self.submodules.counter = counter = Counter(max=fifo_depth)
+        level = Signal(max=fifo_depth+1)
+        counter = Signal(max=fifo_depth)
 
         self.submodules.flush_timer = WaitTimer(10000)
         flush = Signal()
         self.comb += [
-            flush.eq((fifo.fifo.level > 0) & self.flush_timer.done)
+            flush.eq((fifo.level > 0) & self.flush_timer.done)
         ]
 
         self.submodules.fsm = fsm = FSM(reset_state="IDLE")
         fsm.act("IDLE",
-          self.flush_timer.wait.eq(fifo.fifo.level > 0),
-            If((fifo.fifo.level >= 256) | flush,
-                level.ce.eq(1),
-                counter.reset.eq(1),
+            self.flush_timer.wait.eq(fifo.level > 0),
+            If((fifo.level >= 256) | flush,
+                NextValue(level, fifo.level),
+                NextValue(counter, 0),
                 NextState("SEND")
             )
         )
         fsm.act("SEND",
-            source.stb.eq(fifo.source.stb),
-            source.sop.eq(counter.value == 0),
-            If(level.q == 0,
-                source.eop.eq(1),
+            source.valid.eq(fifo.source.valid),
+            source.first.eq(counter == 0),
+            If(level == 0,
+                source.last.eq(1),
             ).Else(
-                source.eop.eq(counter.value == (level.q-1)),
+                source.last.eq(counter == (level-1)),
             ),
             source.src_port.eq(udp_port),
             source.dst_port.eq(udp_port),
             source.ip_address.eq(ip_address),
-            If(level.q == 0,
+            If(level == 0,
                 source.length.eq(1),
             ).Else(
-                source.length.eq(level.q),
+                source.length.eq(level),
             ),
             source.data.eq(fifo.source.data),
-            fifo.source.ack.eq(source.ack),
-            If(source.stb & source.ack,
-                counter.ce.eq(1),
-                If(source.eop,
+            fifo.source.ready.eq(source.ready),
+            If(source.valid & source.ready,
+                NextValue(counter, counter + 1),
+                If(source.last,
                     NextState("IDLE")
                 )
             )
@@ -108,51 +114,47 @@ class EncoderRTPPacketizer(Packetizer):
 
 class EncoderRTPSender(Module):
     def __init__(self):
-        self.sink = sink = Sink(eth_rtp_user_description(8))
-        self.source = source = Source(eth_udp_user_description(8))
+        self.sink = sink = stream.Endpoint(eth_rtp_user_description(8))
+        self.source = source = stream.Endpoint(eth_udp_user_description(8))
 
         # # #
 
         timestamp = Signal(32)
         self.sync += timestamp.eq(timestamp+1)
 
-        sequence_number = Counter(16)
-        self.submodules += sequence_number
+        sequence_number = Signal(16)
+        first = Signal(reset=1)
 
         self.submodules.packetizer = packetizer = EncoderRTPPacketizer()
         self.comb += [
-            packetizer.sink.stb.eq(sink.stb),
-            packetizer.sink.sop.eq(sink.sop),
-            packetizer.sink.eop.eq(sink.eop),
-            sink.ack.eq(packetizer.sink.ack),
+            packetizer.sink.valid.eq(sink.valid),
+            packetizer.sink.last.eq(sink.last),
+            sink.ready.eq(packetizer.sink.ready),
             packetizer.sink.ver.eq(0x2),
             packetizer.sink.p.eq(0),
             packetizer.sink.x.eq(0),
             packetizer.sink.cc.eq(0),
             packetizer.sink.m.eq(0),
             packetizer.sink.pt.eq(26), #JPEG
-            packetizer.sink.sequence_number.eq(sequence_number.value),
+            packetizer.sink.sequence_number.eq(sequence_number),
             packetizer.sink.timestamp.eq(timestamp),
             packetizer.sink.ssrc.eq(1),
             packetizer.sink.data.eq(sink.data)
         ]
 
-        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
-        fsm.act("IDLE",
-            packetizer.source.ack.eq(1),
-            If(packetizer.source.stb & packetizer.source.sop,
-                packetizer.source.ack.eq(0),
-                NextState("SEND")
-            )
-        )
-        fsm.act("SEND",
-            Record.connect(packetizer.source, source),
+        # The packetizer holds the parameters of sink until the last byte
+        # of the packet, so they stay valid for the whole UDP packet.
+        self.comb += [
+            packetizer.source.connect(source, omit={"first", "src_port", "dst_port", "ip_address", "length"}),
+            source.first.eq(first),
             source.src_port.eq(sink.src_port),
             source.dst_port.eq(sink.dst_port),
             source.ip_address.eq(sink.ip_address),
             source.length.eq(sink.length + rtp_header.length),
-            If(source.stb & source.eop & source.ack,
-                sequence_number.ce.eq(1),
-                NextState("IDLE"),
+        ]
+        self.sync += If(source.valid & source.ready,
+            first.eq(source.last),
+            If(source.last,
+                sequence_number.eq(sequence_number + 1)
             )
-        )
\ No newline at end of file
+        )
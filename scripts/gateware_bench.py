@@ -0,0 +1,905 @@
+#!/usr/bin/env python3
+"""
+Runs the gateware cores in migen simulations against behavioral models of
+the parts they talk to, checks their results and measures them.
+
+Each benchmark reports:
+- "status": "pass", "fail" (wrong results) or "error" (the core can't be
+  simulated),
+- "metrics": latencies in cycles per transaction and sustained throughput,
+- "resources": register, combinational and memory bits of the core, from
+  its migen fragment.
+
+The report is written as JSON. With --baseline, the metrics and resources
+are compared with an earlier report and changes beyond --tolerance in the
+wrong direction are regressions: lower is better, except for the metrics
+ending in "_per_cycle", the hit rates and speedups. The run fails on wrong
+results, errors and regressions; --allow-error lists the benchmarks whose
+errors are only reported.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+from migen import *
+from migen.fhdl.specials import Tristate
+from migen.fhdl.tools import list_targets
+from migen.genlib.io import DDROutput
+from migen.sim import run_simulation, passive
+
+from litex.soc.interconnect.csr import _CompoundCSR
+
+from log import Log
+
+
+class _NoIO:
+    """
+    Lowers the I/O specials to nothing in simulations: the models read the
+    outputs (o and oe of a Tristate, i1 and i2 of a DDROutput, with the
+    latency of the output register) and drive the inputs.
+    """
+
+    @staticmethod
+    def lower(special):
+        return Module()
+
+
+def simulate(dut, generators, **kwargs):
+    """
+    Runs the simulation and returns the resources of `dut`.
+    """
+    fragment = dut.get_fragment()
+    resources = get_resources(fragment)
+    run_simulation(fragment, generators, special_overrides={Tristate: _NoIO, DDROutput: _NoIO}, **kwargs)
+    return resources
+
+
+def with_csrs(dut, busword=32):
+    """
+    Adds the CSRs of `dut` to it, as the CSR bank of a SoC does, for the
+    cores which update their CSRStorages.
+    """
+    top = Module()
+    top.submodules.dut = dut
+    for csr in dut.get_csrs():
+        if isinstance(csr, _CompoundCSR):
+            csr.finalize(busword, "big")
+            top.submodules += csr
+    return top
+
+
+def get_resources(f):
+    return {
+        "register_bits": sum(len(s) for statements in f.sync.values() for s in list_targets(statements)),
+        "comb_bits": sum(len(s) for s in list_targets(f.comb)),
+        "memory_bits": sum(m.width*m.depth for m in f.specials if isinstance(m, Memory)),
+    }
+
+
+# SPI flash
+
+def spi_flash_model(clk, cs_n, dq_o, dq_i, data, width, addr_lanes, dummy, stats):
+    """
+    SPI flash in mode 0, executing read commands from `data`: an 8-bit
+    command on dq0, a 24-bit address on `addr_lanes` lines, `dummy` clocks,
+    then data on `width` lines until cs_n rises. dq_o/dq_i are the lines
+    from/to the flash (mosi/miso for single lines).
+    """
+    mask = 2**width - 1
+    last_clk = 0
+    edges = 0
+    cmd = addr = 0
+    cmd_clocks = 8
+    addr_clocks = 24//addr_lanes
+    data_start = cmd_clocks + addr_clocks + dummy
+    while True:
+        if (yield cs_n):
+            edges = cmd = addr = 0
+            last_clk = 0
+            yield
+            continue
+        c = yield clk
+        if c and not last_clk:
+            o = yield dq_o
+            if edges < cmd_clocks:
+                cmd = (cmd << 1) | (o & 1)
+                if edges == cmd_clocks - 1:
+                    stats["commands"].append(cmd)
+            elif edges < cmd_clocks + addr_clocks:
+                addr = (addr << addr_lanes) | (o & (2**addr_lanes - 1))
+            edges += 1
+            # Data for the next rising edge
+            bit = (edges - data_start)*width
+            if bit >= 0:
+                byte = data[(addr + bit//8) % len(data)]
+                yield dq_i.eq((byte >> (8 - width - bit % 8)) & mask)
+        last_clk = c
+        yield
+
+
+def spi_flash_ddr_model(ddr_clk, cs_n, dq_o, dq_i, data, width, addr_lanes, dummy, delay, stats):
+    """
+    spi_flash_model for a clock from a DDR output, `ddr_clk`: the SPI clock
+    rises in the middle of the cycles after the ones where i2 is high and
+    i1 low, as the ODDR registers them before driving the pad. The
+    flash outputs the data after the falling edge, at the end of the cycle,
+    which reaches dq_i `delay` cycles later (clock to output and board
+    delays).
+    """
+    mask = 2**width - 1
+    edges = 0
+    cmd = addr = 0
+    cmd_clocks = 8
+    addr_clocks = 24//addr_lanes
+    data_start = cmd_clocks + addr_clocks + dummy
+    cycle = 0
+    outputs = {}
+    rising = False
+    while True:
+        if (yield cs_n):
+            edges = cmd = addr = 0
+        elif rising:
+            o = yield dq_o
+            if edges < cmd_clocks:
+                cmd = (cmd << 1) | (o & 1)
+                if edges == cmd_clocks - 1:
+                    stats["commands"].append(cmd)
+            elif edges < cmd_clocks + addr_clocks:
+                addr = (addr << addr_lanes) | (o & (2**addr_lanes - 1))
+            edges += 1
+            bit = (edges - data_start)*width
+            if bit >= 0:
+                byte = data[(addr + bit//8) % len(data)]
+                outputs[cycle + 1 + delay] = (byte >> (8 - width - bit % 8)) & mask
+        rising = (yield ddr_clk.i2) and not (yield ddr_clk.i1)
+        # Written values are seen in the next cycle
+        if cycle + 1 in outputs:
+            yield dq_i.eq(outputs.pop(cycle + 1))
+        cycle += 1
+        yield
+
+
+def wishbone_reads(bus, addresses, results, cti=None, idle=1):
+    """
+    Reads the words at `addresses` one by one, with `idle` cycles in between.
+    Appends (data, cycles from request to ack) to `results`.
+    """
+    for adr in addresses:
+        yield bus.adr.eq(adr)
+        yield bus.we.eq(0)
+        yield bus.sel.eq(2**len(bus.sel) - 1)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        if cti is not None:
+            yield bus.cti.eq(cti)
+        yield
+        cycles = 1
+        while not (yield bus.ack):
+            yield
+            cycles += 1
+        results.append(((yield bus.dat_r), cycles))
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        for _ in range(idle):
+            yield
+
+
+def wishbone_burst_reads(bus, addresses, results, length=8):
+    """
+    Reads the words at `addresses` in incrementing bursts of `length`
+    words (registered feedback cycles, as the CPU caches refill lines).
+    Appends (data, cycles from request or previous ack to ack) to `results`.
+    """
+    for i in range(0, len(addresses), length):
+        burst = addresses[i:i + length]
+        yield bus.we.eq(0)
+        yield bus.sel.eq(2**len(bus.sel) - 1)
+        yield bus.bte.eq(0)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        for j, adr in enumerate(burst):
+            yield bus.adr.eq(adr)
+            # Incrementing burst, end of burst for the last word
+            yield bus.cti.eq(0b111 if j == len(burst) - 1 else 0b010)
+            yield
+            cycles = 1
+            while not (yield bus.ack):
+                yield
+                cycles += 1
+            results.append(((yield bus.dat_r), cycles))
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield bus.cti.eq(0)
+        yield
+
+
+def _flash_data(size=4096):
+    rng = random.Random(0)
+    return bytes(rng.randrange(256) for _ in range(size))
+
+
+def _expected_word(data, adr):
+    return int.from_bytes(bytes(data[(4*adr + i) % len(data)] for i in range(4)), "big")
+
+
+def _flash_traces(words, with_burst=False, depth=4, gap=256, seed=1):
+    rng = random.Random(seed)
+    traces = {
+        "sequential": (list(range(words)), wishbone_reads),
+        "random": ([rng.randrange(0, 1 << 20) for _ in range(words)], wishbone_reads),
+    }
+    if with_burst:
+        traces["burst"] = (list(range(words)), wishbone_burst_reads)
+        # Reads after the prefetch buffer filled up, jumping over it
+        jumps = [0]
+        while len(jumps) < words:
+            jumps.append(jumps[-1] + rng.choice((1, depth, depth + 1)))
+
+        def gap_reads(bus, addresses, results):
+            return wishbone_reads(bus, addresses, results, idle=gap)
+        traces["gaps"] = (jumps, gap_reads)
+    return traces
+
+
+def _bench_flash(create, words, with_burst=False, depth=4, gap=256):
+    data = _flash_data()
+    metrics = {}
+    errors = []
+    for name, (addresses, reads) in _flash_traces(words, with_burst, depth, gap).items():
+        dut, flash_model, cmd = create()
+        stats = {"commands": []}
+        results = []
+        timing = {}
+
+        def master():
+            yield
+            yield from reads(dut.bus, addresses, results)
+
+        def counter():
+            cycles = 0
+            progress = (0, 0)
+            while len(results) < len(addresses):
+                yield
+                cycles += 1
+                if len(results) != progress[0]:
+                    progress = (len(results), cycles)
+                elif cycles - progress[1] > 10000:
+                    raise Exception("{} read of 0x{:x} stalled".format(name, addresses[len(results)]))
+            timing["cycles"] = cycles
+
+        resources = simulate(dut, [master(), counter(), flash_model(data, stats)])
+        for adr, (value, _) in zip(addresses, results):
+            if value != _expected_word(data, adr):
+                errors.append("{} read of 0x{:x}: 0x{:08x}, expected 0x{:08x}".format(name, adr, value, _expected_word(data, adr)))
+                break
+        if any(c != cmd for c in stats["commands"]):
+            errors.append("unexpected flash commands {}".format(sorted(set(stats["commands"]))))
+        total = timing["cycles"]
+        metrics["{}_cycles_per_word".format(name)] = round(total/len(addresses), 3)
+        metrics["{}_latency_cycles".format(name)] = max(c for _, c in results)
+        metrics["{}_bytes_per_cycle".format(name)] = round(4*len(addresses)/total, 4)
+    return metrics, resources, errors
+
+
+def _flash_models(dut, pads, dq_o, dq_i, width, addr_lanes, dummy, board_delay):
+    def flash_model(data, stats):
+        if hasattr(dut, "ddr_clk"):
+            return passive(spi_flash_ddr_model)(dut.ddr_clk, pads.cs_n, dq_o, dq_i, data, width, addr_lanes, dummy,
+                                                board_delay, stats)
+        return passive(spi_flash_model)(pads.clk, pads.cs_n, dq_o, dq_i, data, width, addr_lanes, dummy, stats)
+    return flash_model
+
+
+def _create_spi_flash(kind, args, div, sample_delay=1, board_delay=0):
+    from gateware.spi_flash import SpiFlashDualQuad, SpiFlashSingle
+
+    if kind == "single":
+        pads = Record([("clk", 1), ("cs_n", 1), ("mosi", 1), ("miso", 1)])
+        dut = SpiFlashSingle(pads, dummy=8, div=div, with_bitbang=False, sample_delay=sample_delay)
+        return dut, _flash_models(dut, pads, pads.mosi, pads.miso, 1, 1, 8, board_delay), 0x0b
+    pads = Record([("clk", 1), ("cs_n", 1), ("dq", 4)])
+    dut = SpiFlashDualQuad(pads, dummy=args.flash_dummy, div=div, with_bitbang=False,
+                           with_burst=kind == "quad_burst", prefetch_words=args.prefetch_words,
+                           sample_delay=sample_delay)
+    return dut, _flash_models(dut, pads, dut.dq.o, dut.dq.i, 4, 4, args.flash_dummy, board_delay), 0xeb
+
+
+def bench_spi_flash_dual_quad(args, with_burst=False):
+    kind = "quad_burst" if with_burst else "quad"
+    return _bench_flash(lambda: _create_spi_flash(kind, args, args.flash_div), args.words, with_burst,
+                        args.prefetch_words, 128*args.flash_div)
+
+
+def bench_spi_flash_dual_quad_burst(args):
+    return bench_spi_flash_dual_quad(args, with_burst=True)
+
+
+def bench_spi_flash_single(args):
+    return _bench_flash(lambda: _create_spi_flash("single", args, args.flash_div), args.words)
+
+
+def bench_spi_flash_ddr(args, kind="quad"):
+    """
+    div=1: the SPI clock at the sys clock rate, with --flash-board-delay
+    cycles from the SPI clock to the data at the FPGA. Also sweeps the
+    sampling delays against the board delays, the calibration table of
+    the sample_delay parameter.
+    """
+    metrics, resources, errors = _bench_flash(
+        lambda: _create_spi_flash(kind, args, 1, args.flash_sample_delay, args.flash_board_delay), args.words)
+    data = _flash_data()
+    addresses = [0, 1, 0x1234, 0xfffff]
+    for board_delay in range(3):
+        passing = []
+        for sample_delay in range(1, 5):
+            dut, flash_model, _ = _create_spi_flash(kind, args, 1, sample_delay, board_delay)
+            results = []
+            simulate(dut, [wishbone_reads(dut.bus, addresses, results), flash_model(data, {"commands": []})])
+            if all(value == _expected_word(data, adr) for adr, (value, _) in zip(addresses, results)):
+                passing.append(sample_delay)
+        metrics["board_delay{}_sample_delays".format(board_delay)] = passing
+    return metrics, resources, errors
+
+
+def bench_spi_flash_single_ddr(args):
+    return bench_spi_flash_ddr(args, kind="single")
+
+
+# Flash cache
+
+def firmware_fetch_trace(accesses, seed=0, functions=64):
+    """
+    Instruction and data fetches (byte offsets in the flash) of a synthetic
+    firmware: a main loop calling functions with skewed frequencies, each
+    running straight-line code with short loops, and loading constants
+    from .rodata after the code.
+    """
+    rng = random.Random(seed)
+    sizes = [rng.choice((32, 64, 128, 256, 512, 1024)) for _ in range(functions)]
+    starts = [64 + sum(sizes[:f]) for f in range(functions)]
+    rodata = starts[-1] + sizes[-1]
+    weights = [1/(f + 1) for f in range(functions)]
+    trace = []
+    while len(trace) < accesses:
+        # The main loop, then a call
+        trace.extend(range(0, 64, 4))
+        f = rng.choices(range(functions), weights)[0]
+        for pc in range(starts[f], starts[f] + sizes[f], 4):
+            trace.append(pc)
+            if rng.random() < 0.1:
+                trace.append(rodata + 4*int(rng.expovariate(1/64)))
+            if pc - starts[f] >= 32 and rng.random() < 0.05:
+                body = list(range(pc - rng.randrange(8, 32, 4), pc + 4, 4))
+                trace.extend(body*rng.randint(2, 8))
+    return trace[:accesses]
+
+
+def load_fetch_trace(filename):
+    """
+    Reads a fetch trace: byte offsets in the flash, in hex, separated by
+    whitespace.
+    """
+    with open(filename, "r") as f:
+        return [int(v, 16) & ~3 for v in f.read().split()]
+
+
+def flash_cache_model(trace, size, ways, line_size):
+    """
+    Hits of `trace` in a cache of `size` bytes, with LRU replacement.
+    """
+    sets = [[] for _ in range(size//(line_size*ways))]
+    hits = 0
+    for offset in trace:
+        line = offset//line_size
+        lines = sets[line % len(sets)]
+        if line in lines:
+            hits += 1
+            lines.remove(line)
+        elif len(lines) == ways:
+            lines.pop(0)
+        lines.append(line)
+    return hits
+
+
+def bench_flash_cache(args, ways=1, kind=None):
+    from gateware.flash_cache import FlashCache
+
+    data = _flash_data()
+    if args.cache_trace:
+        trace = load_fetch_trace(args.cache_trace)
+    else:
+        trace = firmware_fetch_trace(args.cache_accesses)
+    addresses = [offset//4 for offset in trace]
+    errors = []
+
+    # Uncached latency
+    flash, flash_model, _ = _create_spi_flash(kind or args.cache_flash, args, args.flash_div)
+    uncached = []
+    simulate(flash, [wishbone_reads(flash.bus, addresses[:16], uncached),
+                     flash_model(data, {"commands": []})])
+
+    dut = Module()
+    flash, flash_model, _ = _create_spi_flash(kind or args.cache_flash, args, args.flash_div)
+    dut.submodules.flash = flash
+    dut.submodules.cache = FlashCache(flash.bus, args.cache_size, ways, args.cache_line_size)
+    results = []
+    resources = simulate(dut, [wishbone_reads(dut.cache.bus, addresses, results),
+                               flash_model(data, {"commands": []})])
+
+    for adr, (value, _) in zip(addresses, results):
+        if value != _expected_word(data, adr):
+            errors.append("read of 0x{:x}: 0x{:08x}, expected 0x{:08x}".format(adr, value, _expected_word(data, adr)))
+            break
+    # Hits take two cycles, from the request to the ack
+    hits = sum(1 for _, cycles in results if cycles == 2)
+    expected = flash_cache_model(trace, args.cache_size, ways, args.cache_line_size)
+    if hits != expected:
+        errors.append("{} hits, the LRU model has {}".format(hits, expected))
+    latency = sum(cycles for _, cycles in results)/len(results)
+    uncached_latency = sum(cycles for _, cycles in uncached)/len(uncached)
+    metrics = {
+        "hit_rate": round(hits/len(results), 4),
+        "average_latency_cycles": round(latency, 2),
+        "uncached_latency_cycles": round(uncached_latency, 2),
+        "speedup": round(uncached_latency/latency, 2),
+    }
+    return metrics, resources, errors
+
+
+def bench_flash_cache_2way(args):
+    return bench_flash_cache(args, ways=2)
+
+
+def bench_flash_cache_quad_burst(args):
+    # As in the targets with a quad flash and a cache
+    return bench_flash_cache(args, kind="quad_burst")
+
+
+# Frequency measurement
+
+def bench_frequency_measurement(args):
+    from gateware.freq_measurement import FrequencyMeasurement
+
+    period = 1000
+    # The simulator rounds the clock periods to even numbers
+    sys_period, measure_period = 10, 6
+    dut = FrequencyMeasurement(Signal(), period)
+    values = []
+
+    def sampler():
+        cycles = 0
+        first = None
+        while len(values) < 3:
+            value = yield dut.value.status
+            if value and (not values or value != values[-1][1]):
+                values.append((cycles, value))
+                if first is None:
+                    first = cycles
+            yield
+            cycles += 1
+
+    resources = simulate(dut, {"sys": [sampler()]}, clocks={"sys": sys_period, "measure": measure_period})
+    expected = (period + 1)*sys_period/measure_period
+    measured = values[-1][1]
+    error = abs(measured - expected)/expected
+    metrics = {
+        "latency_cycles": values[0][0],
+        "update_cycles": values[-1][0] - values[-2][0],
+        "error_ppm": round(error*1e6, 1),
+    }
+    errors = [] if error < 2/expected + 1e-3 else ["measured {}, expected {:.1f}".format(measured, expected)]
+    return metrics, resources, errors
+
+
+# Encoder
+
+def bench_encoder_buffer(args):
+    import numpy as np
+    from gateware.encoder.core import EncoderBuffer
+    from gateware.encoder import model
+
+    width, height = 64, 16
+    frame = np.random.default_rng(0).integers(0, 1 << 16, (height, width), dtype=np.uint16)
+    words = model.pack_words(frame)
+    stream = [words[a] for a in model.dma_read_addresses(width, height)]
+    dut = EncoderBuffer()
+    output = []
+    timing = {}
+
+    def sink():
+        cycle = 0
+        for word in stream:
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.data.eq(word)
+            yield
+            cycle += 1
+            while not (yield dut.sink.ready):
+                yield
+                cycle += 1
+        yield dut.sink.valid.eq(0)
+
+    def source():
+        yield dut.source.ready.eq(1)
+        cycle = 0
+        while len(output) < width*height:
+            if (yield dut.source.valid):
+                if not output:
+                    timing["first"] = cycle
+                output.append((yield dut.source.data))
+            yield
+            cycle += 1
+        timing["last"] = cycle
+
+    resources = simulate(dut, [sink(), source()])
+    metrics = {
+        "latency_cycles": timing["first"],
+        "pixels_per_cycle": round(width*height/timing["last"], 4),
+    }
+    errors = [] if np.array_equal(output, model.reorder(frame)) else ["pixel order differs from the model"]
+    return metrics, resources, errors
+
+
+def bench_encoder_frontend(args):
+    import numpy as np
+    from encoder_bench import EncoderFrontend, run_frontend
+    from gateware.encoder import model
+
+    width, height = 64, 32
+    frame = np.random.default_rng(0).integers(0, 1 << 16, (height, width), dtype=np.uint16)
+    resources = get_resources(EncoderFrontend().get_fragment())
+    output, stats = run_frontend(frame)
+    metrics = {
+        "pixels_per_cycle": round(width*height/stats["cycles"], 4),
+        "dram_busy_per_cycle": round(len(stats["addresses"])/stats["cycles"], 4),
+    }
+    errors = [] if np.array_equal(output, model.reorder(frame)) else ["pixel order differs from the model"]
+    return metrics, resources, errors
+
+
+def bench_encoder_rtp_generator(args):
+    from gateware.streamer.rtp import EncoderRTPGenerator
+
+    dut = EncoderRTPGenerator(0x7f000001, 8000, fifo_depth=256)
+    length = 600
+    received = []
+    timing = {}
+
+    def sink():
+        for i in range(length):
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.data.eq(i & 0xff)
+            yield
+            while not (yield dut.sink.ready):
+                yield
+        yield dut.sink.valid.eq(0)
+
+    def source():
+        yield dut.source.ready.eq(1)
+        cycle = 0
+        while len(received) < length:
+            if (yield dut.source.valid):
+                timing.setdefault("first", cycle)
+                received.append((yield dut.source.data))
+            yield
+            cycle += 1
+        timing["last"] = cycle
+
+    resources = simulate(dut, [sink(), source()])
+    metrics = {
+        "latency_cycles": timing["first"],
+        "bytes_per_cycle": round(length/timing["last"], 4),
+    }
+    errors = [] if received == [i & 0xff for i in range(length)] else ["packet data differs from the input"]
+    return metrics, resources, errors
+
+
+# I2C
+
+class _I2CPins:
+    def __init__(self):
+        self.w = Signal()
+        self.oe = Signal()
+        self.r = Signal(reset=1)
+
+
+def i2c_master(pads, half_period, operations, results, stats):
+    """
+    Bit-banged I2C master on the open-drain lines of `pads`, which the
+    slave drives through w/oe. Supports clock stretching by the slave.
+    `operations` are ("write", address, bytes) and ("read", address, count).
+    """
+    line = {"scl": 1, "sda": 1}
+
+    def tick(n=1):
+        for _ in range(n):
+            yield pads.scl.r.eq(line["scl"] & ~((yield pads.scl.oe) & ~(yield pads.scl.w)) & 1)
+            yield pads.sda.r.eq(line["sda"] & ~((yield pads.sda.oe) & ~(yield pads.sda.w)) & 1)
+            yield
+
+    def scl_high():
+        line["scl"] = 1
+        yield from tick()
+        while not (yield pads.scl.r):
+            stats["stretch_cycles"] += 1
+            yield from tick()
+
+    def bit(value):
+        line["sda"] = value
+        yield from tick(half_period)
+        yield from scl_high()
+        yield from tick(half_period//2)
+        sampled = yield pads.sda.r
+        yield from tick(half_period - half_period//2)
+        line["scl"] = 0
+        return sampled
+
+    def byte(value):
+        v = 0
+        for i in range(8):
+            v = (v << 1) | (yield from bit((value >> (7 - i)) & 1))
+        ack = not (yield from bit(1))
+        return v, ack
+
+    yield from tick(4*half_period)
+    for op, address, payload in operations:
+        start = stats["cycles"]
+        # start
+        line["sda"] = 0
+        yield from tick(half_period)
+        line["scl"] = 0
+        _, ack = yield from byte((address << 1) | (op == "read"))
+        if not ack:
+            results.append((op, None))
+        elif op == "write":
+            for value in payload:
+                _, ack = yield from byte(value)
+            results.append((op, ack))
+        else:
+            values = []
+            for i in range(payload):
+                v = 0
+                for _ in range(8):
+                    v = (v << 1) | (yield from bit(1))
+                values.append(v)
+                # ack all but the last byte
+                yield from bit(int(i == payload - 1))
+            results.append((op, values))
+        # stop
+        line["sda"] = 0
+        yield from tick(half_period)
+        yield from scl_high()
+        yield from tick(half_period)
+        line["sda"] = 1
+        yield from tick(2*half_period)
+        stats["transactions"].append(stats["cycles"] - start)
+
+
+def bench_i2c_shift_reg(args):
+    from gateware.opsis_i2c import I2CShiftReg
+
+    pads = Record([("scl", 1), ("sda", 1)])
+    pads.scl = _I2CPins()
+    pads.sda = _I2CPins()
+    dut = I2CShiftReg(pads)
+    address = 0x42
+    half_period = 64
+    results = []
+    received = []
+    stats = {"stretch_cycles": 0, "transactions": [], "cycles": 0}
+    operations = [("write", address, [0xa5]), ("read", address, 1), ("write", address + 1, [0x00])]
+
+    def cpu():
+        # The firmware side: empties the register after a write and fills it
+        # for the next read, polling the status every 256 cycles
+        yield dut.slave_addr.storage.eq(address)
+        while len(results) < len(operations):
+            status = yield dut.status.storage
+            if status == 1 and stats["cycles"] % 256 == 0:
+                received.append((yield dut.shift_reg.storage))
+                yield dut.shift_reg.storage.eq(0x3c)
+                yield dut.status.storage.eq(0)
+            yield
+            stats["cycles"] += 1
+
+    resources = simulate(with_csrs(dut), [cpu(), i2c_master(pads, half_period, operations, results, stats)])
+    metrics = {
+        "write_cycles": stats["transactions"][0],
+        "read_cycles": stats["transactions"][1],
+        "stretch_cycles": stats["stretch_cycles"],
+    }
+    expected = [("write", True), ("read", [0x3c]), ("write", None)]
+    errors = []
+    if received != [0xa5]:
+        errors.append("received {}, expected [0xa5]".format(received))
+    if results != expected:
+        errors.append("transactions {}, expected {}".format(results, expected))
+    return metrics, resources, errors
+
+
+# SPI master
+
+def spi_slave_model(pads, cpha, miso_data, received):
+    """
+    SPI slave shifting MSB first: captures mosi and drives `miso_data` on
+    the clock edges of mode (0, cpha).
+    """
+    last_clk = 0
+    bits = []
+    out = []
+    while True:
+        cs_n = yield pads.cs_n
+        clk = yield pads.clk
+        if cs_n:
+            if bits:
+                received.append(bits)
+                bits = []
+            out = list(miso_data)
+            if not cpha:
+                yield pads.miso.eq(out.pop(0) if out else 0)
+        else:
+            rising = clk and not last_clk
+            falling = last_clk and not clk
+            if (rising and not cpha) or (falling and cpha):
+                bits.append((yield pads.mosi))
+            if (falling and not cpha) or (rising and cpha):
+                yield pads.miso.eq(out.pop(0) if out else 0)
+        last_clk = clk
+        yield
+
+
+def bench_spi_master(args):
+    from gateware.oled import SPIMaster
+
+    width, length = 24, 24
+    metrics = {}
+    errors = []
+    for cpha in (0, 1):
+        pads = Record([("cs_n", 1), ("clk", 1), ("mosi", 1), ("miso", 1)])
+        dut = SPIMaster(pads, width, div=args.spi_div, cpha=cpha)
+        mosi = 0x5a3cc3
+        miso_bits = [(0x9617e8 >> (width - 1 - i)) & 1 for i in range(length)]
+        received = []
+        timing = {}
+
+        def control():
+            yield dut._length.storage.eq(length)
+            yield dut._mosi.storage.eq(mosi)
+            yield
+            yield dut._ctrl.r.eq(1)
+            yield dut._ctrl.re.eq(1)
+            yield
+            yield dut._ctrl.re.eq(0)
+            yield
+            cycles = 2
+            while not (yield dut._status.status):
+                yield
+                cycles += 1
+            timing["cycles"] = cycles
+            for _ in range(4*args.spi_div):
+                yield
+            timing["miso"] = yield dut._miso.status
+
+        resources = simulate(dut, [control(), passive(spi_slave_model)(pads, cpha, miso_bits, received)])
+        metrics["cpha{}_transfer_cycles".format(cpha)] = timing["cycles"]
+        metrics["cpha{}_bits_per_cycle".format(cpha)] = round(length/timing["cycles"], 4)
+        sent = [(mosi >> (width - 1 - i)) & 1 for i in range(length)]
+        if received != [sent]:
+            errors.append("cpha={}: slave received {}, expected {}".format(cpha, received, [sent]))
+        if timing["miso"] & (2**length - 1) != 0x9617e8 >> (width - length):
+            errors.append("cpha={}: master received 0x{:06x}".format(cpha, timing["miso"]))
+    return metrics, resources, errors
+
+
+BENCHMARKS = {
+    "spi_flash_dual_quad": bench_spi_flash_dual_quad,
+    "spi_flash_dual_quad_burst": bench_spi_flash_dual_quad_burst,
+    "spi_flash_single": bench_spi_flash_single,
+    "spi_flash_dual_quad_ddr": bench_spi_flash_ddr,
+    "spi_flash_single_ddr": bench_spi_flash_single_ddr,
+    "flash_cache": bench_flash_cache,
+    "flash_cache_2way": bench_flash_cache_2way,
+    "flash_cache_quad_burst": bench_flash_cache_quad_burst,
+    "frequency_measurement": bench_frequency_measurement,
+    "encoder_buffer": bench_encoder_buffer,
+    "encoder_frontend": bench_encoder_frontend,
+    "encoder_rtp_generator": bench_encoder_rtp_generator,
+    "i2c_shift_reg": bench_i2c_shift_reg,
+    "spi_master": bench_spi_master,
+}
+
+
+def run_benchmark(name, args):
+    start = time.monotonic()
+    result = {"status": "pass", "metrics": {}, "resources": {}, "errors": []}
+    try:
+        with Log.stage("bench-" + name):
+            metrics, resources, errors = BENCHMARKS[name](args)
+        result.update(metrics=metrics, resources=resources, errors=errors)
+        if errors:
+            result["status"] = "fail"
+    except Exception as e:
+        Log.write(traceback.format_exc())
+        result["status"] = "error"
+        result["errors"] = ["{}: {}".format(type(e).__name__, e)]
+    result["seconds"] = round(time.monotonic() - start, 2)
+    return result
+
+
+HIGHER_IS_BETTER = ("_per_cycle", "hit_rate", "speedup")
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, result in report["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if not old or result["status"] != "pass" or old["status"] != "pass":
+            continue
+        for group in ("metrics", "resources"):
+            for key, value in result[group].items():
+                before = old[group].get(key)
+                if not isinstance(before, (int, float)) or not before:
+                    continue
+                change = (value - before)/abs(before)
+                worse = -change if key.endswith(HIGHER_IS_BETTER) else change
+                if worse > tolerance:
+                    regressions.append("{} {}: {} -> {} ({:+.1%})".format(name, key, before, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulation benchmarks of the gateware cores")
+    parser.add_argument("--words", type=int, default=64, help="words read per SPI flash trace")
+    parser.add_argument("--flash-div", type=int, default=2, help="SPI flash clock divider")
+    parser.add_argument("--flash-dummy", type=int, default=15, help="SPI flash dummy clocks")
+    parser.add_argument("--flash-sample-delay", type=int, default=1, help="SPI flash sampling delay of the DDR mode")
+    parser.add_argument("--flash-board-delay", type=int, default=0,
+                        help="cycles from the SPI clock to the flash data at the FPGA in the DDR benchmarks")
+    parser.add_argument("--prefetch-words", type=int, default=4, help="SPI flash prefetch buffer of the burst mode")
+    parser.add_argument("--cache-size", type=int, default=2048, help="flash cache size")
+    parser.add_argument("--cache-line-size", type=int, default=16, help="flash cache line size")
+    parser.add_argument("--cache-flash", choices=["single", "quad", "quad_burst"], default="single",
+                        help="SPI flash controller behind the flash cache")
+    parser.add_argument("--cache-accesses", type=int, default=3000, help="length of the synthetic fetch trace")
+    parser.add_argument("--cache-trace", default=None, help="fetch trace to replay instead, hex byte offsets")
+    parser.add_argument("--spi-div", type=int, default=4, help="SPI master clock divider")
+    parser.add_argument("--report", default=os.path.join("build", "gateware-bench.json"), help="JSON report")
+    parser.add_argument("--baseline", default=None, help="earlier JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="relative change of a regression")
+    parser.add_argument("--allow-error", default=[], action="append", metavar="BENCHMARK",
+                        help="don't fail the run when BENCHMARK can't be simulated")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run (default: all): {}".format(", ".join(BENCHMARKS)))
+    args = parser.parse_args()
+
+    for name in args.benchmarks + args.allow_error:
+        if name not in BENCHMARKS:
+            raise Exception("Unknown benchmark {}".format(name))
+    report = {"benchmarks": {name: run_benchmark(name, args) for name in args.benchmarks or BENCHMARKS}}
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    lines = ["Gateware benchmarks:"]
+    for name, result in report["benchmarks"].items():
+        lines.append("  {:5}  {:22} {}".format(result["status"], name,
+                     ", ".join("{} {}".format(k, v) for k, v in result["metrics"].items())))
+        for error in result["errors"]:
+            lines.append("         {}".format(error))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        lines += ["Regression: " + r for r in regressions] or ["No regressions against {}".format(args.baseline)]
+    Log.log("\n".join(lines))
+    failed = any(r["status"] == "fail" or (r["status"] == "error" and name not in args.allow_error)
+                 for name, r in report["benchmarks"].items())
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,52 @@
+import subprocess
+import sys
+import config
+import firmware
+
+
 def gateware():
     print("Hello")
+
+
+def patch_bitstream(data=None, meminfo=None):
+    """
+    Patches the BIOS (or DATA) into the ROM of the already built bitstream,
+    without running synthesis and place and route again.
+    """
+    cfg = config.ConfigManager()
+    arg_list = [sys.executable, 'scripts/patch_bitstream.py'] + firmware.get_soc_args(cfg)
+    if data:
+        arg_list += ['--data', data]
+    if meminfo:
+        arg_list += ['--meminfo', meminfo]
+    subprocess.check_call(arg_list)
+
+
+def sim(threads=1, no_run=False):
+    """
+    Builds the firmware and runs it on the configured sim platform SoC.
+    The Verilator model is only compiled when the SoC changes.
+    """
+    cfg = config.ConfigManager()
+    if cfg.platform() != 'sim':
+        raise Exception(f'sim needs the sim platform, not {cfg.platform()}')
+    arg_list = [sys.executable, 'scripts/sim.py'] + firmware.get_soc_args(cfg) + \
+        ['--threads', str(threads)]
+    if no_run:
+        arg_list.append('--no-run')
+    subprocess.check_call(arg_list)
+
+
+def framebuffer(output='frame.png', source='hdmi_out0', index=0, write=None,
+                host=None, transport='udp'):
+    """
+    Reads or writes a framebuffer of the running SoC over Etherbone.
+    """
+    cfg = config.ConfigManager()
+    arg_list = [sys.executable, 'scripts/framebuffer.py'] + firmware.get_soc_args(cfg) + \
+        ['--source', source, '--index', str(index), '--transport', transport]
+    if host:
+        arg_list += ['--host', host]
+    if write:
+        arg_list += ['--write', write]
+    subprocess.check_call(arg_list + [output])
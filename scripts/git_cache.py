@@ -0,0 +1,102 @@
+import hashlib
+import os
+import os.path as Path
+import re
+import shutil
+import tempfile
+import cache
+import utils
+from log import Log
+
+
+def _git(*args):
+    utils.run_process_log_output(['git'] + list(args))
+
+
+def _mirror_name(url):
+    # Readable, but unique per URL
+    name = re.sub(r'\.git$', '', url.rstrip('/').split('/')[-1])
+    name = re.sub(r'[^\w.-]', '_', name) or 'repo'
+    return f'{name}-{hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]}.git'
+
+
+class GitMirrorCache:
+    """
+    Bare mirrors of the firmware repositories, shared by all build dirs.
+    Checkouts are cloned from a mirror with --shared, so they borrow its
+    objects instead of copying them; only the working tree and index are
+    stored per build dir. Mirrors never prune objects, as the checkouts
+    using them may still need objects which are no longer referenced.
+    """
+
+    def mirror_dir(self, url):
+        return Path.join(self.directory, _mirror_name(url))
+
+    def update(self, url):
+        """
+        Creates or fetches the mirror of `url`. Returns its directory.
+        """
+        mirror = self.mirror_dir(url)
+        # Parallel builds (e.g. the matrix) may use the same mirror
+        with cache.file_lock(mirror + '.lock'):
+            if Path.isdir(mirror):
+                Log.log(f"Updating mirror of {url} ...")
+                _git('-C', mirror, 'fetch', '--prune', '--progress', 'origin')
+                return mirror
+
+            Log.log(f"Mirroring {url} to {mirror} ...")
+            tmp = tempfile.mkdtemp(dir=self.directory, prefix='.mirror-')
+            try:
+                _git('clone', '--mirror', '--progress', url, tmp)
+                _git('-C', tmp, 'config', 'gc.pruneExpire', 'never')
+                os.rename(tmp, mirror)
+            finally:
+                if Path.isdir(tmp):
+                    shutil.rmtree(tmp)
+        return mirror
+
+    def checkout(self, url, destination, branch=None, submodules=False):
+        """
+        Clones `url` at `branch` into `destination`, borrowing objects from
+        the mirror. The clone's origin points to `url`, as if it was cloned
+        from upstream directly.
+        """
+        mirror = self.update(url)
+        args = ['clone', '--shared', '--progress']
+        if branch:
+            args += ['--branch', branch]
+        _git(*(args + [mirror, destination]))
+        _git('-C', destination, 'remote', 'set-url', 'origin', url)
+        if submodules:
+            update_submodules(destination, self.jobs)
+
+    def __init__(self, directory=None, jobs=1):
+        self.directory = directory or cache.default_cache_dir("git")
+        self.jobs = max(1, int(jobs))
+
+
+def update_submodules(repo_dir, jobs=1, depth=None):
+    args = ['-C', repo_dir, 'submodule', 'update', '--init', '--recursive',
+            '--progress', '--jobs', str(max(1, int(jobs)))]
+    if depth:
+        args += ['--depth', str(depth)]
+    _git(*args)
+
+
+def clone(url, destination, branch=None, submodules=False, jobs=1,
+          depth=None, filter=None):
+    """
+    Clones `url` directly from upstream, optionally shallow (`depth`) or
+    partial (`filter`, e.g. "blob:none"). Used when the mirror cache is
+    disabled.
+    """
+    args = ['clone', '--progress']
+    if branch:
+        args += ['--branch', branch]
+    if depth:
+        args += ['--depth', str(depth)]
+    if filter:
+        args += [f'--filter={filter}']
+    _git(*(args + [url, destination]))
+    if submodules:
+        update_submodules(destination, jobs, depth)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Checks GitMirrorCache against local bare repositories as upstreams:
+creating a mirror and fetching new commits into it, cloning a checkout
+with --shared at a pinned branch, and updating its submodules.
+"""
+
+import argparse
+import os
+import os.path as Path
+import subprocess
+import sys
+import tempfile
+
+from git_cache import GitMirrorCache
+
+
+def _git(*args, cwd=None):
+    result = subprocess.run(['git'] + list(args), cwd=cwd, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode('utf-8').strip()
+
+
+def _commit(work, filename, contents):
+    with open(Path.join(work, filename), 'w') as f:
+        f.write(contents)
+    _git('add', filename, cwd=work)
+    _git('commit', '-q', '-m', f'Write {filename}', cwd=work)
+    return _git('rev-parse', 'HEAD', cwd=work)
+
+
+def make_upstream(directory, name):
+    """
+    Creates the bare repository `name`.git in `directory` and a working
+    copy pushing to it. Returns (url, working copy).
+    """
+    url = Path.join(directory, f'{name}.git')
+    work = Path.join(directory, f'{name}-work')
+    _git('init', '-q', '--bare', '-b', 'main', url)
+    _git('clone', '-q', url, work)
+    _git('config', 'user.name', 'check', cwd=work)
+    _git('config', 'user.email', 'check@localhost', cwd=work)
+    _git('checkout', '-q', '-b', 'main', cwd=work)
+    return url, work
+
+
+def check_mirror(cache, upstream, directory):
+    errors = []
+    url, work = upstream['main']
+    mirror = cache.update(url)
+    if _git('--git-dir', mirror, 'rev-parse', 'main') != _git('rev-parse', 'main', cwd=work):
+        errors.append('mirror main differs from upstream')
+    if _git('--git-dir', mirror, 'rev-parse', '--is-bare-repository') != 'true':
+        errors.append('mirror isn\'t bare')
+    if _git('--git-dir', mirror, 'config', 'gc.pruneExpire') != 'never':
+        errors.append('mirror prunes objects')
+
+    head = _commit(work, 'update.txt', 'new upstream commit\n')
+    _git('push', '-q', 'origin', 'main', cwd=work)
+    if cache.update(url) != mirror:
+        errors.append('update created another mirror')
+    if _git('--git-dir', mirror, 'rev-parse', 'main') != head:
+        errors.append('new upstream commit not fetched into the mirror')
+    mirrors = [name for name in os.listdir(cache.directory) if name.endswith('.git')]
+    if mirrors != [Path.basename(mirror)]:
+        errors.append(f'unexpected mirrors {mirrors}')
+    return f'{Path.basename(mirror)} at {head[:12]}', errors
+
+
+def check_checkout(cache, upstream, directory):
+    errors = []
+    url, work = upstream['main']
+    destination = Path.join(directory, 'checkout')
+    cache.checkout(url, destination, branch='stable', submodules=True)
+    if _git('rev-parse', 'HEAD', cwd=destination) != _git('rev-parse', 'stable', cwd=work):
+        errors.append('checkout isn\'t at the pinned branch')
+    if _git('rev-parse', '--abbrev-ref', 'HEAD', cwd=destination) != 'stable':
+        errors.append('checkout isn\'t on the pinned branch')
+    if _git('remote', 'get-url', 'origin', cwd=destination) != url:
+        errors.append('checkout origin isn\'t upstream')
+    alternates = Path.join(destination, '.git', 'objects', 'info', 'alternates')
+    mirror_objects = Path.join(cache.mirror_dir(url), 'objects')
+    if not Path.isfile(alternates) or Path.realpath(open(alternates).read().strip()) != Path.realpath(mirror_objects):
+        errors.append('checkout doesn\'t borrow the objects of the mirror')
+    if _git('count-objects', cwd=destination).split()[0] != '0':
+        errors.append('checkout has objects of its own')
+
+    _, lib_work = upstream['lib']
+    lib = Path.join(destination, 'lib')
+    if _git('rev-parse', 'HEAD', cwd=lib) != _git('rev-parse', 'HEAD', cwd=lib_work):
+        errors.append('submodule not at its recorded commit')
+    if not Path.isfile(Path.join(lib, 'lib.txt')):
+        errors.append('submodule not checked out')
+    return 'stable with submodule lib', errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.parse_args()
+
+    # The submodule is a local path, which git only clones when allowed
+    os.environ['GIT_CONFIG_COUNT'] = '1'
+    os.environ['GIT_CONFIG_KEY_0'] = 'protocol.file.allow'
+    os.environ['GIT_CONFIG_VALUE_0'] = 'always'
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        upstream = {name: make_upstream(directory, name) for name in ('lib', 'main')}
+        lib_url, lib_work = upstream['lib']
+        _commit(lib_work, 'lib.txt', 'library\n')
+        _git('push', '-q', 'origin', 'main', cwd=lib_work)
+        url, work = upstream['main']
+        _commit(work, 'main.txt', 'main\n')
+        _git('checkout', '-q', '-b', 'stable', cwd=work)
+        _git('submodule', '-q', 'add', lib_url, 'lib', cwd=work)
+        _git('commit', '-q', '-m', 'Add lib', cwd=work)
+        _git('checkout', '-q', 'main', cwd=work)
+        _git('push', '-q', 'origin', 'main', 'stable', cwd=work)
+
+        cache = GitMirrorCache(Path.join(directory, 'cache'))
+        for name, check in (('mirror', check_mirror), ('checkout', check_checkout)):
+            summary, errors = check(cache, upstream, directory)
+            print(f"{name:8} {'fail' if errors else 'pass':5} {summary}")
+            for error in errors:
+                print(f"         {error}")
+            failed |= bool(errors)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
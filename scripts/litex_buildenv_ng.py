@@ -4,9 +4,72 @@ import argh
 import traceback
 from log import Log
 import config
-from prepare import prepare
-from gateware_build import gateware
-from firmware import firmware
+
+# The commands below only import their implementation when they are run,
+# so that starting the CLI (or asking for --help) doesn't pay for loading
+# GitPython, requests and the like. scripts/check_startup.py guards this.
+
+
+def prepare():
+    """
+    Sets up the environment, verifying that all tools are present.
+    If they are not, they are installed and/or configured.
+    """
+    from prepare import prepare as run
+    run()
+
+
+def firmware():
+    """
+    Builds the configured firmware.
+    """
+    from firmware import firmware as run
+    run()
+
+
+def gateware():
+    from gateware_build import gateware as run
+    run()
+
+
+def patch_bitstream(data=None, meminfo=None):
+    """
+    Patches the BIOS (or DATA) into the ROM of the already built bitstream,
+    without running synthesis and place and route again.
+    """
+    from gateware_build import patch_bitstream as run
+    run(data, meminfo)
+
+
+def sim(threads=1, no_run=False):
+    """
+    Builds the firmware and runs it on the configured sim platform SoC.
+    The Verilator model is only compiled when the SoC changes.
+    """
+    from gateware_build import sim as run
+    run(threads, no_run)
+
+
+def framebuffer(output='frame.png', source='hdmi_out0', index=0, write=None,
+                host=None, transport='udp'):
+    """
+    Reads the frame SOURCE shows (or framebuffer INDEX of an hdmi_in) from
+    the running SoC over Etherbone into OUTPUT, .png or raw YCbCr 4:2:2.
+    --write puts a raw frame into the framebuffer instead.
+    """
+    from gateware_build import framebuffer as run
+    run(output, source, index, write, host, transport)
+
+
+def matrix(matrix_file, jobs=1, limit=None, report='build/matrix-report.json'):
+    """
+    Builds every combination listed in MATRIX_FILE in parallel.
+    Each line of the file is "cpu[.variant] platform target [toolchain]",
+    the toolchain defaults to the one used by the platform.
+    --limit restricts concurrent builds per toolchain, e.g. "vivado=1,ise=2".
+    """
+    from matrix import matrix as run
+    run(matrix_file, jobs, limit, report)
 
 
 def init_config(args):
@@ -30,7 +93,8 @@ if __name__ == '__main__':
     parser.add_argument("--trace",
                         action="store_true",
                         help="dump stack trace on error")
-    parser.add_commands([prepare, firmware, gateware])
+    parser.add_commands([prepare, firmware, gateware, patch_bitstream, sim,
+                         framebuffer, matrix])
 
     options = parser.parse_args()
 
@@ -1,17 +1,129 @@
+import atexit
+import contextlib
+import json
 import os
+import os.path as Path
+import sys
+import time
+
+# Buffer size of the log files, they are flushed on exit and stage changes
+BUFFER_SIZE = 64 * 1024
+
+
+def _timestamp(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) + \
+        f".{int(t * 1000) % 1000:03d}"
 
 
 class Log:
+    """
+    Build log, written to the console and to two files:
+    - BUILDENV_BUILD_LOG: plain text, every line prefixed with a timestamp,
+    - BUILDENV_BUILD_LOG_JSON (default: the text log with a .jsonl
+      extension): one JSON record per log message and per build stage.
+    The first process of a build truncates the files, then all the
+    processes append to them.
+    """
+
+    _log = None
+    _json = None
+    _line_start = True
+
+    @staticmethod
+    def _open():
+        if Log._log is not None:
+            return Log._log
+        filename = os.getenv("BUILDENV_BUILD_LOG")
+        if not filename:
+            Log._log = False
+            return Log._log
+
+        json_filename = os.getenv("BUILDENV_BUILD_LOG_JSON")
+        if not json_filename:
+            json_filename = Path.splitext(filename)[0] + ".jsonl"
 
-    _log = open(os.getenv("BUILDENV_BUILD_LOG"), "w")
+        if not os.getenv("BUILDENV_BUILD_LOG_OPEN"):
+            for name in (filename, json_filename):
+                open(name, "w").close()
+            os.environ["BUILDENV_BUILD_LOG_OPEN"] = "1"
+        # Every process appends (O_APPEND): its flushes go to the end of
+        # the files, after the lines of the other processes
+        Log._log = open(filename, "a", buffering=BUFFER_SIZE)
+        Log._json = open(json_filename, "a", buffering=BUFFER_SIZE)
+        atexit.register(Log.flush)
+        return Log._log
+
+    @staticmethod
+    def _write_text(data, t):
+        log = Log._open()
+        if not log or not data:
+            return
+        prefix = f"[{_timestamp(t)}] "
+        lines = data.split("\n")
+        for i, line in enumerate(lines):
+            if i > 0:
+                log.write("\n")
+                Log._line_start = True
+            if not line:
+                continue
+            if Log._line_start:
+                log.write(prefix)
+                Log._line_start = False
+            log.write(line)
+
+    @staticmethod
+    def _write_record(record):
+        if Log._open():
+            Log._json.write(json.dumps(record) + "\n")
 
     @staticmethod
     def log(arg):
         s = str(arg)
+        t = time.time()
         print(s)
-        Log._log.write(s)
+        if not Log._line_start:
+            Log._write_text("\n", t)
+        Log._write_text(s + "\n", t)
+        Log._write_record({"time": t, "pid": os.getpid(), "type": "log",
+                           "message": s})
+
+    @staticmethod
+    def write(data):
+        # Raw output, e.g. streamed from a subprocess, written as it arrives
+        sys.stdout.write(data)
+        sys.stdout.flush()
+        Log._write_text(data, time.time())
+
+    @staticmethod
+    def record_stage(name, start, duration, status="ok"):
+        Log.log(f"Stage {name}: {status} in {duration:.1f}s")
+        Log._write_record({"time": start + duration, "pid": os.getpid(),
+                           "type": "stage", "stage": name, "start": start,
+                           "duration": duration, "status": status})
+        Log.flush()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def stage(name):
+        """
+        Records the duration of the enclosed block as build stage `name`.
+        """
+        start = time.time()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            Log.record_stage(name, start, time.time() - start, status)
+
+    @staticmethod
+    def flush():
+        if Log._log:
+            Log._log.flush()
+            Log._json.flush()
 
     @staticmethod
     def dump():
-        with open(os.getenv("BUILDENV_BUILD_LOG"), "r+") as log_read:
+        Log.flush()
+        with open(os.getenv("BUILDENV_BUILD_LOG"), "r") as log_read:
             return log_read.read()
@@ -1,14 +1,55 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import json
 import os
-
-from litex.build.tools import write_to_file
-from litex.soc.integration.soc_sdram import *
-from litex.soc.integration.builder import *
+import shutil
+import subprocess
+import sys
+import time
+
+import cache
+from log import Log
+from targets.common import cpu_interface
+
+
+# Files generated by LiteX which fully describe the design handed to the
+# vendor toolchain.
+GATEWARE_INPUTS = ["top.v", "top.ucf", "top.xdc", "top.pcf", "top.lpf", "top.sdc", "*.init"]
+# Toolchain outputs, with what patch_bitstream.py needs to patch them:
+# the iCE40 ASCII bitstream and the Vivado memory map, see get_platform().
+GATEWARE_OUTPUTS = ["top.bit", "top.bin", "top.asc"]
+GATEWARE_MEMORY_MAPS = ["top.mmi"]
+
+TOOLCHAIN_VERSION_COMMANDS = {
+    "XilinxISEToolchain": [["xst", "-help"]],
+    "XilinxVivadoToolchain": [["vivado", "-version"]],
+    "LatticeIceStormToolchain": [["yosys", "-V"], ["nextpnr-ice40", "--version"], ["arachne-pnr", "-v"]],
+}
+
+# Files written at the end of each toolchain stage, in order. Their mtimes
+# give the duration of the stages.
+TOOLCHAIN_STAGES = {
+    "XilinxISEToolchain": [("synth", "top.ngc"), ("translate", "top.ngd"), ("place", "top_map.ncd"), ("route", "top.ncd"), ("bitgen", "top.bit")],
+    "XilinxVivadoToolchain": [
+        ("synth", "top_utilization_synth.rpt"), ("place", "top_utilization_place.rpt"),
+        ("route", "top_route.dcp"), ("bitgen", "top.bit"),
+    ],
+    "LatticeIceStormToolchain": [("synth", "top.json"), ("synth", "top.blif"), ("place_route", "top.txt"), ("bitgen", "top.bin")],
+}
+
+# Toolchain attributes which end up in the generated build scripts
+TOOLCHAIN_OPTIONS = [
+    "xst_opt", "map_opt", "par_opt", "bitgen_opt", "ise_commands",
+    "pre_synthesis_commands", "bitstream_commands", "additional_commands",
+    "yosys_template", "nextpnr_build_template", "build_template",
+]
 
 
 def get_args(parser, platform='opsis', target='hdmi2usb'):
+    from litex.soc.integration.soc_sdram import soc_sdram_args
+
     parser.add_argument("--platform", action="store", default=os.environ.get('PLATFORM', platform))
     parser.add_argument("--target", action="store", default=os.environ.get('TARGET', target))
 
@@ -25,6 +66,11 @@ def get_args(parser, platform='opsis', target='hdmi2usb'):
     parser.add_argument("--no-compile-firmware", action="store_true", help="do not compile the firmware")
     parser.add_argument("--override-firmware", action="store", default=None, help="override firmware with file")
 
+    parser.add_argument("--no-gateware-cache", action="store_true", help="always run the gateware toolchain")
+    parser.add_argument("--gateware-cache-dir", action="store", default=cache.default_cache_dir("gateware"), help="gateware cache directory")
+    parser.add_argument("--no-elaboration-cache", action="store_true", help="always elaborate the SoC")
+    parser.add_argument("--elaboration-cache-dir", action="store", default=cache.default_cache_dir("elaboration"), help="SoC elaboration cache directory")
+
 
 def get_builddir(args):
     assert args.platform is not None
@@ -49,10 +95,16 @@ def get_testdir(args):
 def get_platform(args):
     assert args.platform is not None
     exec("from platforms.{} import Platform".format(args.platform), globals())
-    return Platform(**dict(args.platform_option))
+    platform = Platform(**dict(args.platform_option))
+    if type(platform.toolchain).__name__ == "XilinxVivadoToolchain":
+        # Placement of the block RAMs, for patch_bitstream.py
+        platform.toolchain.additional_commands.append("write_mem_info -force {build_name}.mmi")
+    return platform
 
 
 def get_soc(args, platform):
+    from litex.soc.integration.soc_sdram import soc_sdram_argdict
+
     exec("from targets.{}.{} import SoC".format(args.platform, args.target.lower(), args.target), globals())
     soc = SoC(platform, ident=SoC.__name__, **soc_sdram_argdict(args), **dict(args.target_option))
     if hasattr(soc, 'configure_iprange'):
@@ -110,7 +162,216 @@ def get_firmware(builddir, filetype="flash"):
         assert False, "Unknown file type %s" % filetype
 
 
+def add_software_packages(args, builder, soc):
+    if not args.no_compile_firmware or args.override_firmware:
+        builder.add_software_package("uip", "{}/firmware/uip".format(os.getcwd()))
+
+        # FIXME: All platforms which current run their user programs from
+        # SPI flash lack the block RAM resources to run the default
+        # firmware. Check whether to use the stub or default firmware
+        # should be refined (perhaps soc attribute?).
+        if "main_ram" in soc.mem_regions:
+            builder.add_software_package("firmware", "{}/firmware".format(os.getcwd()))
+        else:
+            builder.add_software_package("stub", "{}/firmware/stub".format(os.getcwd()))
+
+
+def get_toolchain_version(platform):
+    versions = [type(platform.toolchain).__name__]
+    for cmd in TOOLCHAIN_VERSION_COMMANDS.get(versions[0], []):
+        if shutil.which(cmd[0]) is None:
+            versions.append("{}: not found".format(cmd[0]))
+            continue
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        lines = output.decode("utf-8", "replace").strip().splitlines()
+        versions.append("{}: {}".format(cmd[0], lines[0] if lines else ""))
+    return "\n".join(versions)
+
+
+def get_gateware_digest(args, platform, gateware_dir):
+    digest = cache.Digest()
+    for pattern in GATEWARE_INPUTS:
+        for filename in sorted(glob.glob(os.path.join(gateware_dir, pattern))):
+            digest.add_file(filename, os.path.basename(filename))
+    for source in sorted(platform.sources):
+        digest.add_file(source[0], "{}:{}".format(os.path.basename(source[0]), source[1]))
+    for name in TOOLCHAIN_OPTIONS:
+        if hasattr(platform.toolchain, name):
+            digest.add(name, repr(getattr(platform.toolchain, name)))
+    digest.add("build-options", repr(sorted(tuple(o) for o in args.build_option)))
+    digest.add("outputs", repr(GATEWARE_OUTPUTS + GATEWARE_MEMORY_MAPS))
+    digest.add("toolchain", get_toolchain_version(platform))
+    return digest.hexdigest()
+
+
+def run_gateware_toolchain(gateware_dir, build_name="top"):
+    # Same scripts LiteX runs itself when building with run=True
+    if sys.platform in ("win32", "cygwin"):
+        cmd = ["build_{}.bat".format(build_name)]
+    else:
+        cmd = ["bash", "build_{}.sh".format(build_name)]
+    if subprocess.call(cmd, cwd=gateware_dir) != 0:
+        raise OSError("Subprocess failed")
+
+
+def record_toolchain_stages(platform, gateware_dir, start):
+    last = start
+    for stage, artifact in TOOLCHAIN_STAGES.get(type(platform.toolchain).__name__, []):
+        filename = os.path.join(gateware_dir, artifact)
+        if not os.path.isfile(filename):
+            continue
+        end = os.path.getmtime(filename)
+        if end < last:
+            continue
+        Log.record_stage(stage, last, end - last)
+        last = end
+
+
+def build_cached_gateware(args, platform, gateware_dir):
+    """
+    Runs the toolchain on the sources LiteX generated into `gateware_dir`,
+    unless a bitstream for identical inputs is already in the cache.
+    """
+    gateware_cache = cache.BuildCache(args.gateware_cache_dir)
+    key = get_gateware_digest(args, platform, gateware_dir)
+    restored = gateware_cache.restore(key, gateware_dir)
+    if restored:
+        Log.log("Gateware cache hit ({}), restored {}".format(key[:16], ", ".join(restored)))
+        return
+    Log.log("Gateware cache miss ({}), running toolchain".format(key[:16]))
+    # Don't let stale outputs of a previous build end up in the cache
+    for name in GATEWARE_OUTPUTS:
+        if os.path.exists(os.path.join(gateware_dir, name)):
+            os.remove(os.path.join(gateware_dir, name))
+    start = time.time()
+    run_gateware_toolchain(gateware_dir)
+    record_toolchain_stages(platform, gateware_dir, start)
+    # Memory maps are only cached when this run wrote them, an older one
+    # doesn't match the new placement
+    memory_maps = [name for name in GATEWARE_MEMORY_MAPS
+                   if os.path.isfile(os.path.join(gateware_dir, name))
+                   and os.path.getmtime(os.path.join(gateware_dir, name)) >= start]
+    gateware_cache.store(key, gateware_dir, GATEWARE_OUTPUTS + memory_maps)
+
+
+def build_from_elaboration_cache(args, buildargs, key):
+    """
+    Restores the generated headers and CSR maps of an identical, previously
+    elaborated SoC and builds its software packages.
+    Returns False if the SoC has to be elaborated.
+    """
+    elaboration_cache = cache.BuildCache(args.elaboration_cache_dir)
+    description = elaboration_cache.read(key, "elaboration.json")
+    if description is None:
+        return False
+    description = json.loads(description.decode("utf-8"))
+    output_dir = buildargs['output_dir']
+    if elaboration_cache.restore(key, output_dir, description["files"]) is None:
+        return False
+    Log.log("Elaboration cache hit ({}), restored {} files".format(key[:16], len(description["files"])))
+
+    if buildargs.get('compile_software', True):
+        with Log.stage("software"):
+            # Same invocation as LiteX's Builder uses for software packages
+            for name, src_dir in description["software_packages"]:
+                dst_dir = os.path.join(output_dir, "software", name)
+                os.makedirs(dst_dir, exist_ok=True)
+                subprocess.check_call(["make", "-C", dst_dir, "-f", os.path.join(src_dir, "Makefile")])
+    return True
+
+
+def get_generated_dir(output_dir):
+    return os.path.join(output_dir, "software", "include", "generated")
+
+
+def get_builder(soc, **kwargs):
+    """
+    The Builder rewrites the generated headers on every run, which makes
+    the software packages rebuild everything. The returned one keeps the
+    unchanged headers as they were.
+    """
+    from litex.soc.integration.builder import Builder
+
+    class IncrementalBuilder(Builder):
+        def _generate_includes(self, *args, **kwargs):
+            with cpu_interface.keep_unchanged_files(get_generated_dir(self.output_dir)):
+                return super()._generate_includes(*args, **kwargs)
+
+    return IncrementalBuilder(soc, **kwargs)
+
+
+def get_elaboration_cache_args(argv=None):
+    """
+    Parses the options the elaboration cache hit path needs, without the
+    LiteX ones: importing LiteX takes longer than the rest of such a run.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-h", "--help", action="store_true")
+    parser.add_argument("--platform", default=os.environ.get('PLATFORM', 'opsis'))
+    parser.add_argument("--target", default=os.environ.get('TARGET', 'hdmi2usb'))
+    parser.add_argument("--cpu-type", default=os.environ.get('CPU', 'lm32'))
+    parser.add_argument("--cpu-variant", default=os.environ.get('CPU_VARIANT', None) or None)
+    parser.add_argument("-Ot", "--target-option", default=[], nargs=2, action="append")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--no-compile-gateware", action="store_true")
+    parser.add_argument("--no-compile-software", action="store_true")
+    parser.add_argument("--no-elaboration-cache", action="store_true")
+    parser.add_argument("--elaboration-cache-dir", default=cache.default_cache_dir("elaboration"))
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def store_elaboration(args, buildargs, key, soc, builder):
+    # The analyzer export needs the Verilog namespace, which isn't cached
+    if hasattr(soc, 'do_exit'):
+        return
+
+    output_dir = buildargs['output_dir']
+    files = []
+    generated_dir = get_generated_dir(output_dir)
+    for root, _, names in os.walk(generated_dir):
+        files += [os.path.relpath(os.path.join(root, name), output_dir) for name in names]
+    extra_files = [
+        buildargs.get('csr_csv', None),
+        buildargs.get('csr_json', None),
+        os.path.join(get_testdir(args), "csr.py"),
+        os.path.join(output_dir, "software", "pcie", "kernel", "csr.h"),
+    ]
+    for filename in extra_files:
+        if filename and os.path.isfile(filename):
+            name = os.path.relpath(filename, output_dir)
+            if name.startswith(os.pardir):
+                # Can't be restored relative to the build directory
+                return
+            files.append(name)
+
+    description = {
+        "files": sorted(files),
+        "software_packages": list(builder.software_packages),
+    }
+    cache.BuildCache(args.elaboration_cache_dir).store(key, output_dir, files, {
+        "elaboration.json": json.dumps(description, indent=1).encode("utf-8"),
+    })
+
+
 def main():
+    # Runs which don't produce gateware only need the products of the
+    # elaboration, which can be taken from the cache before LiteX is even
+    # imported.
+    cache_args = get_elaboration_cache_args()
+    cache_buildargs = {
+        'output_dir': cache_args.output_dir or get_builddir(cache_args),
+        'compile_software': not cache_args.no_compile_software,
+    }
+    elaboration_key = None
+    if cache_args.no_compile_gateware and not cache_args.no_elaboration_cache and not cache_args.help:
+        elaboration_key = cache.soc_inputs_digest(os.getcwd(), [sys.argv[1:]] + sorted(vars(cache_args).items()))
+        if build_from_elaboration_cache(cache_args, cache_buildargs, elaboration_key):
+            return
+
+    from litex.soc.integration.builder import builder_args, builder_argdict
+    from litex.soc.integration.soc_sdram import soc_sdram_args
+
     parser = argparse.ArgumentParser(description="Opsis LiteX SoC", conflict_handler='resolve')
     get_args(parser)
     builder_args(parser)
@@ -118,16 +379,25 @@ def main():
 
     args = parser.parse_args()
 
-    platform = get_platform(args)
-
-    soc = get_soc(args, platform)
-
     builddir = get_builddir(args)
     testdir = get_testdir(args)
 
     buildargs = builder_argdict(args)
     if not buildargs.get('output_dir', None):
         buildargs['output_dir'] = builddir
+    if buildargs['output_dir'] != cache_buildargs['output_dir']:
+        # An abbreviated option only the full parser understood, the cache
+        # would restore the files elsewhere
+        elaboration_key = None
+
+    with Log.stage("elaborate"):
+        platform = get_platform(args)
+        soc = get_soc(args, platform)
+
+    # With the cache enabled LiteX only generates the gateware sources, the
+    # toolchain is run afterwards in build_cached_gateware() on a cache miss.
+    use_gateware_cache = buildargs.get('compile_gateware', True) and not args.no_gateware_cache \
+        and type(getattr(platform, 'toolchain', None)).__name__ in TOOLCHAIN_VERSION_COMMANDS
 
     if hasattr(soc, 'cpu_type'):
         if not buildargs.get('csr_csv', None):
@@ -136,28 +406,33 @@ def main():
         if not buildargs.get('csr_json', None):
             buildargs['csr_json'] = os.path.join(testdir, "csr.json")
 
-        builder = Builder(soc, **buildargs)
-        if not args.no_compile_firmware or args.override_firmware:
-            builder.add_software_package("uip", "{}/firmware/uip".format(os.getcwd()))
-
-            # FIXME: All platforms which current run their user programs from
-            # SPI flash lack the block RAM resources to run the default
-            # firmware. Check whether to use the stub or default firmware
-            # should be refined (perhaps soc attribute?).
-            if "main_ram" in soc.mem_regions:
-                builder.add_software_package("firmware", "{}/firmware".format(os.getcwd()))
-            else:
-                builder.add_software_package("stub", "{}/firmware/stub".format(os.getcwd()))
-        vns = builder.build(**dict(args.build_option))
+        builder = get_builder(soc, **buildargs)
+        add_software_packages(args, builder, soc)
+        if use_gateware_cache:
+            builder.compile_gateware = False
+        with Log.stage("generate" if use_gateware_cache else "build"):
+            vns = builder.build(**dict(args.build_option))
     else:
-        vns = platform.build(soc, build_dir=os.path.join(builddir, "gateware"))
+        with Log.stage("generate" if use_gateware_cache else "build"):
+            vns = platform.build(soc, build_dir=os.path.join(builddir, "gateware"), run=not use_gateware_cache)
+
+    if use_gateware_cache:
+        build_cached_gateware(args, platform, os.path.join(builddir, "gateware"))
+
+    if hasattr(soc, 'cpu_type'):
+        # Register map for host tools
+        csr_python = cpu_interface.get_csr_python(soc.get_csr_regions(), soc.get_constants(), soc.mem_regions)
+        os.makedirs(testdir, exist_ok=True)
+        cpu_interface.write_to_file_if_changed(os.path.join(testdir, "csr.py"), csr_python)
 
     if hasattr(soc, 'pcie_phy'):
-        from targets.common import cpu_interface
         csr_header = cpu_interface.get_csr_header(soc.get_csr_regions(), soc.get_constants())
         kerneldir = os.path.join(builddir, "software", "pcie", "kernel")
         os.makedirs(kerneldir, exist_ok=True)
-        write_to_file(os.path.join(kerneldir, "csr.h"), csr_header)
+        cpu_interface.write_to_file_if_changed(os.path.join(kerneldir, "csr.h"), csr_header)
+
+    if elaboration_key is not None and hasattr(soc, 'cpu_type'):
+        store_elaboration(args, buildargs, elaboration_key, soc, builder)
 
     if hasattr(soc, 'do_exit'):
         soc.do_exit(vns, filename="{}/analyzer.csv".format(testdir))
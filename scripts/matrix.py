@@ -0,0 +1,217 @@
+import json
+import os
+import os.path as Path
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from log import Log
+
+
+class MatrixEntry:
+    def __init__(self, cpu, cpu_variant, platform, target, toolchain,
+                 platform_options=()):
+        self.cpu = cpu
+        self.cpu_variant = cpu_variant
+        self.platform = platform
+        self.target = target
+        self.toolchain = toolchain
+        self.platform_options = list(platform_options)
+        self.status = "pending"
+        self.returncode = None
+        self.duration = None
+        self.log = None
+
+    def name(self):
+        full_cpu = self.cpu
+        if self.cpu_variant:
+            full_cpu = f'{full_cpu}.{self.cpu_variant}'
+        # Matches make.py:get_builddir()
+        return f'{self.platform.lower()}_{self.target.lower()}_{full_cpu.lower()}'
+
+    def make_args(self):
+        args = ['--platform', self.platform, '--target', self.target,
+                '--cpu-type', self.cpu]
+        if self.cpu_variant:
+            args += ['--cpu-variant', self.cpu_variant]
+        for name, value in self.platform_options:
+            args += ['-Op', name, value]
+        return args
+
+    def report(self):
+        return {
+            "cpu": self.cpu,
+            "cpu-variant": self.cpu_variant,
+            "platform": self.platform,
+            "target": self.target,
+            "toolchain": self.toolchain,
+            "status": self.status,
+            "returncode": self.returncode,
+            "duration": self.duration,
+            "log": self.log,
+        }
+
+
+class MatrixBuilder:
+    """
+    Builds many (platform, target, cpu, variant) combinations at once.
+    Every combination is a separate make.py process; at most `jobs` of them
+    run at the same time, and at most `limits[toolchain]` of those may use
+    the same toolchain (Vivado licenses and memory are usually the limit).
+    """
+
+    def _platform_toolchain(self, platform):
+        """
+        Returns the default toolchain of `platform`, and whether it can be
+        changed with its toolchain option.
+        """
+        platform_file = Path.join(self._base_path, "scripts", "platforms",
+                                  f"{platform}.py")
+        if not Path.isfile(platform_file):
+            raise Exception(f"Unknown platform {platform}")
+        with open(platform_file, "r") as f:
+            source = f.read()
+        m = re.search(r'def __init__\(self,[^)]*toolchain\s*=\s*"(\w+)"', source)
+        if m:
+            return m.group(1), True
+        m = re.search(r'toolchain\s*=\s*"(\w+)"', source)
+        if m:
+            return m.group(1), False
+        if "XilinxPlatform" in source:
+            return "ise", False
+        if "LatticePlatform" in source:
+            return "icestorm", False
+        return "sim", False
+
+    def _add_entry(self, line):
+        # entry: cpu[.variant] platform target [toolchain]
+        fields = line.split()
+        if len(fields) not in (3, 4):
+            raise Exception(f"Matrix entry '{line}' not in a proper format")
+        cpu, _, cpu_variant = fields[0].partition('.')
+        platform, target = fields[1], fields[2]
+        toolchain, selectable = self._platform_toolchain(platform)
+        platform_options = []
+        if len(fields) == 4 and fields[3] != toolchain:
+            if not selectable:
+                raise Exception(f"Platform {platform} only builds with "
+                                f"{toolchain}, not {fields[3]}")
+            toolchain = fields[3]
+            platform_options.append(('toolchain', toolchain))
+        self.entries.append(MatrixEntry(cpu, cpu_variant or None, platform,
+                                        target, toolchain, platform_options))
+
+    def scan(self, matrix_file):
+        with open(matrix_file, "r") as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                self._add_entry(line)
+
+    def _build(self, entry):
+        builddir = Path.join(self._base_path, "build", entry.name())
+        os.makedirs(builddir, exist_ok=True)
+        entry.log = Path.join(builddir, "matrix.log")
+
+        env = dict(os.environ)
+        env['PLATFORM'] = entry.platform
+        env['TARGET'] = entry.target
+        env['CPU'] = entry.cpu
+        env['CPU_VARIANT'] = entry.cpu_variant or ''
+        # Keep the timestamped build logs of parallel builds apart
+        env['BUILDENV_BUILD_LOG'] = Path.join(builddir, "build.log")
+        env.pop('BUILDENV_BUILD_LOG_JSON', None)
+        env.pop('BUILDENV_BUILD_LOG_OPEN', None)
+
+        start = time.monotonic()
+        with open(entry.log, "w") as log:
+            entry.returncode = subprocess.call(
+                [sys.executable, 'scripts/make.py'] + entry.make_args(),
+                cwd=self._base_path, env=env, stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT)
+        entry.duration = round(time.monotonic() - start, 3)
+        entry.status = "pass" if entry.returncode == 0 else "fail"
+        return entry
+
+    def _can_start(self, entry, running):
+        limit = self.limits.get(entry.toolchain)
+        if limit is None:
+            return True
+        return sum(1 for e in running.values()
+                   if e.toolchain == entry.toolchain) < limit
+
+    def run(self):
+        pending = list(self.entries)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for entry in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if self._can_start(entry, running):
+                        pending.remove(entry)
+                        entry.status = "running"
+                        Log.log(f"[matrix] Building {entry.name()} "
+                                f"({entry.toolchain})")
+                        running[pool.submit(self._build, entry)] = entry
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        entry.status = "fail"
+                        Log.log(e)
+                    Log.log(f"[matrix] {entry.name()}: {entry.status} "
+                            f"in {entry.duration}s")
+
+    def write_report(self, report_file):
+        os.makedirs(Path.dirname(Path.abspath(report_file)), exist_ok=True)
+        with open(report_file, "w") as f:
+            json.dump([e.report() for e in self.entries], f, indent=2)
+
+        lines = ["Matrix build summary:"]
+        for e in self.entries:
+            lines.append(f"  {e.status:4}  {e.duration or 0:9.1f}s  "
+                         f"{e.toolchain:9}  {e.name()}")
+        passed = sum(1 for e in self.entries if e.status == "pass")
+        lines.append(f"{passed}/{len(self.entries)} passed, "
+                     f"report written to {report_file}")
+        Log.log('\n'.join(lines))
+
+    def failed(self):
+        return [e for e in self.entries if e.status != "pass"]
+
+    def __init__(self, jobs=1, limits=None):
+        self.entries = []
+        self.jobs = max(1, int(jobs))
+        # limits: "vivado=1,ise=2"
+        self.limits = {}
+        if limits:
+            for limit in limits.split(','):
+                toolchain, _, value = limit.partition('=')
+                if not value.isdigit() or int(value) < 1:
+                    raise Exception(f"Toolchain limit '{limit}' not in a "
+                                    "proper format, expected toolchain=N")
+                self.limits[toolchain.strip()] = int(value)
+        self._base_path = Path.abspath(
+            Path.join(Path.dirname(Path.abspath(__file__)), ".."))
+
+
+def matrix(matrix_file, jobs=1, limit=None, report='build/matrix-report.json'):
+    """
+    Builds every combination listed in MATRIX_FILE in parallel.
+    Each line of the file is "cpu[.variant] platform target [toolchain]",
+    the toolchain defaults to the one used by the platform, others are
+    only accepted by the platforms with a toolchain option.
+    --limit restricts concurrent builds per toolchain, e.g. "vivado=1,ise=2".
+    """
+    mb = MatrixBuilder(jobs, limit)
+    mb.scan(matrix_file)
+    mb.run()
+    mb.write_report(report)
+    if mb.failed():
+        sys.exit(-1)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Replaces the contents of a block RAM (by default the BIOS ROM) in an
+already built bitstream, without running synthesis and place and route.
+
+- iCE40: icebram finds the memory by its current contents, the .init file
+  LiteX generated for it, so these must be unique in the design.
+- Xilinx, Vivado: updatemem, needs the .mmi memory map of the design,
+  top.mmi next to the bitstream (written by the build, see make.py) or
+  --meminfo.
+
+ISE isn't supported: data2mem needs a .bmm memory map, which the build
+can't generate.
+"""
+
+import argparse
+import glob
+import os
+import re
+import subprocess
+
+from make import get_args, get_builddir, get_platform, get_bios
+from gateware.firmware import read_firmware_words
+from log import Log
+
+
+CPU_ENDIANNESS = {
+    "lm32": "big",
+    "mor1kx": "big",
+    "picorv32": "little",
+    "vexriscv": "little",
+    "minerva": "little",
+}
+
+
+def get_region_size(builddir, region):
+    mem_h = os.path.join(builddir, "software", "include", "generated", "mem.h")
+    with open(mem_h, "r") as f:
+        m = re.search(r"#define\s+{}_SIZE\s+(0x[0-9a-fA-F]+|\d+)".format(region.upper()), f.read())
+    if m is None:
+        raise Exception("Memory region {} not found in {}".format(region, mem_h))
+    return int(m.group(1), 0)
+
+
+def find_init_file(gateware_dir, depth):
+    # LiteX writes one <memory>.init file per initialized memory, one word
+    # per line.
+    found = []
+    for filename in sorted(glob.glob(os.path.join(gateware_dir, "*.init"))):
+        with open(filename, "r") as f:
+            if sum(1 for line in f if line.strip()) == depth:
+                found.append(filename)
+    if len(found) != 1:
+        raise Exception("{} memory init files of depth {} in {}, select one with --init-file".format(
+            "No" if not found else "Several", depth, gateware_dir))
+    return found[0]
+
+
+def write_hex(filename, words):
+    with open(filename, "w") as f:
+        f.write("".join("{:08x}\n".format(w) for w in words))
+
+
+def write_mem(filename, words):
+    with open(filename, "w") as f:
+        f.write("@0000\n")
+        f.write("".join("{:08X}\n".format(w) for w in words))
+
+
+def bit_to_bin(bit_file, bin_file):
+    # .bit: 13-byte preamble, then fields 'a'-'d' (2-byte length + value)
+    # and 'e' (4-byte length + the raw bitstream, which is the .bin file).
+    with open(bit_file, "rb") as f:
+        data = f.read()
+    pos = 13
+    while data[pos:pos + 1] != b"e":
+        if data[pos:pos + 1] not in (b"a", b"b", b"c", b"d"):
+            raise Exception("Unknown field in bitstream header of {}".format(bit_file))
+        pos += 3 + int.from_bytes(data[pos + 1:pos + 3], "big")
+    length = int.from_bytes(data[pos + 1:pos + 5], "big")
+    with open(bin_file, "wb") as f:
+        f.write(data[pos + 5:pos + 5 + length])
+
+
+def patch_ice40(gateware_dir, init_file, words):
+    asc = os.path.join(gateware_dir, "top.asc")
+    if not os.path.isfile(asc):
+        raise Exception("{} not found, build the gateware first".format(asc))
+    new_init = init_file + ".new"
+    patched = os.path.join(gateware_dir, "top.patched.asc")
+    write_hex(new_init, words)
+    with open(asc, "rb") as f_in, open(patched, "wb") as f_out:
+        subprocess.check_call(["icebram", init_file, new_init], stdin=f_in, stdout=f_out)
+    subprocess.check_call(["icepack", patched, os.path.join(gateware_dir, "top.bin")])
+    os.replace(patched, asc)
+    # The memory now holds the new contents, the next patch starts from them
+    os.replace(new_init, init_file)
+
+
+def patch_vivado(gateware_dir, init_file, meminfo, proc, words):
+    bit = os.path.join(gateware_dir, "top.bit")
+    if not os.path.isfile(bit):
+        raise Exception("{} not found, build the gateware first".format(bit))
+    meminfo = meminfo or os.path.join(gateware_dir, "top.mmi")
+    if not os.path.isfile(meminfo):
+        raise Exception("Memory map {} not found, build the gateware again to write it".format(meminfo))
+    mem = os.path.join(gateware_dir, "patch.mem")
+    patched = os.path.join(gateware_dir, "top.patched.bit")
+    write_mem(mem, words)
+    subprocess.check_call(["updatemem", "-force", "-meminfo", meminfo, "-data", mem,
+                           "-proc", proc, "-bit", bit, "-out", patched])
+    os.replace(patched, bit)
+    bit_to_bin(bit, os.path.join(gateware_dir, "top.bin"))
+    write_hex(init_file, words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Patch block RAM contents into a built bitstream")
+    get_args(parser)
+    parser.add_argument("--region", default="rom", help="memory region to patch, as named in mem.h")
+    parser.add_argument("--data", default=None, help="new contents (default: the BIOS)")
+    parser.add_argument("--init-file", default=None, help="LiteX .init file of the memory")
+    parser.add_argument("--meminfo", default=None, help="Vivado .mmi memory map (default: top.mmi)")
+    parser.add_argument("--proc", default="dummy", help="processor name of the memory in the .mmi file")
+    args = parser.parse_args()
+
+    builddir = get_builddir(args)
+    gateware_dir = os.path.join(builddir, "gateware")
+    data = args.data or get_bios(builddir)
+
+    endianness = CPU_ENDIANNESS.get(args.cpu_type)
+    if endianness is None:
+        raise Exception("Unknown endianness of CPU {}".format(args.cpu_type))
+    depth = get_region_size(builddir, args.region) // 4
+    words = read_firmware_words(data, endianness)
+    if len(words) > depth:
+        raise Exception("{} is too big! {} bytes > {} bytes".format(data, len(words) * 4, depth * 4))
+    words.extend([0] * (depth - len(words)))
+    init_file = args.init_file or find_init_file(gateware_dir, depth)
+
+    toolchain = type(get_platform(args).toolchain).__name__
+    with Log.stage("patch-bitstream"):
+        Log.log("Patching {} into {} ({})".format(data, init_file, toolchain))
+        if toolchain == "LatticeIceStormToolchain":
+            patch_ice40(gateware_dir, init_file, words)
+        elif toolchain == "XilinxVivadoToolchain":
+            patch_vivado(gateware_dir, init_file, args.meminfo, args.proc, words)
+        else:
+            raise Exception("Patching bitstreams of {} is not supported".format(toolchain))
+
+
+if __name__ == "__main__":
+    main()
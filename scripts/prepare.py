@@ -1,12 +1,21 @@
 import config
 import utils
+import importlib.util
+import json
 import re
 import shutil
 import os
 import os.path as Path
 import platform
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from log import Log
 
+# Seconds a single dependency verification may take
+PROBE_TIMEOUT = 60
+
 
 class RequirementsManager:
     def _add_dep(self, list, dep):
@@ -55,18 +64,87 @@ class RequirementsManager:
                         continue
                     self._add_dep(self._pip_deps, dep)
 
+    def _fingerprint(self, kind, name):
+        # Identifies the probed file, a probe result is reused as long as
+        # the file isn't replaced or modified.
+        if kind == "bin":
+            path = shutil.which(name)
+        elif "." in name:
+            # find_spec() would import the parent packages in this process
+            try:
+                path = utils.probe_python_module_origin(name, PROBE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                return None
+        else:
+            try:
+                spec = importlib.util.find_spec(name)
+            except (ImportError, ValueError):
+                return None
+            path = spec.origin if spec and spec.has_location else None
+        if not path:
+            return None
+        path = Path.realpath(path)
+        stat = os.stat(path)
+        return {
+            "path": path,
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "python": sys.executable if kind == "py" else None,
+        }
+
+    def _probe_version(self, kind, name, probe):
+        key = f"{kind}:{name}"
+        fingerprint = self._fingerprint(kind, name)
+        with self._manifest_lock:
+            entry = self._manifest.get(key)
+        if fingerprint and entry and entry["fingerprint"] == fingerprint:
+            return entry["version"]
+
+        version = probe()
+        if fingerprint:
+            with self._manifest_lock:
+                self._manifest[key] = {
+                    "fingerprint": fingerprint,
+                    "version": version,
+                }
+        return version
+
+    def _load_manifest(self):
+        if Path.isfile(self._manifest_file):
+            try:
+                with open(self._manifest_file, "r") as f:
+                    self._manifest = json.load(f)
+            except ValueError:
+                Log.log(f"Ignoring corrupted {self._manifest_file}")
+
+    def _save_manifest(self):
+        os.makedirs(Path.dirname(self._manifest_file), exist_ok=True)
+        with open(self._manifest_file, "w") as f:
+            json.dump(self._manifest, f, indent=1, sort_keys=True)
+
     def _verify_binary_dep(self, name, version):
         if shutil.which(name):
-            return version in utils.get_program_version(
-                name) if version else True
+            try:
+                return version in self._probe_version(
+                    "bin", name,
+                    lambda: utils.get_program_version(name, PROBE_TIMEOUT)
+                ) if version else True
+            except subprocess.TimeoutExpired:
+                Log.log(f"Timed out checking version of {name}")
+                return False
         return False
 
     def _verify_python_dep(self, name, version):
         try:
-            module_version = utils.get_python_module_version(name)
+            module_version = self._probe_version(
+                "py", name,
+                lambda: utils.probe_python_module_version(name, PROBE_TIMEOUT))
             return version in module_version if version else True
         except ImportError:
             return False
+        except subprocess.TimeoutExpired:
+            Log.log(f"Timed out checking version of {name}")
+            return False
 
     def _install_local_tool(self, dep, config):
         tool_config = config.get_tool_config(dep["name"])
@@ -115,11 +193,23 @@ class RequirementsManager:
         else:
             return self._verify_python_dep(to_check, dep["version"])
 
+    def _missing_deps(self, deps, default):
+        """
+        Verifies `deps` concurrently and returns the ones not satisfied.
+        """
+        if len(deps) == 0:
+            return []
+        with ThreadPoolExecutor() as pool:
+            verified = list(pool.map(lambda dep: self._verify_dep(dep, default),
+                                     deps))
+        return [dep for dep, ok in zip(deps, verified) if not ok]
+
     def _build_deps_and_run_install(self, params, deps, noun, config):
         Log.log(f"Installing {noun} dependencies...")
         if len(deps) == 0:
             Log.log("Nothing to install")
             return
+        packages = []
         for dep in deps:
             if config.is_local_tool(dep["name"]):
                 Log.log(f"Using local configuration of {dep['name']}")
@@ -129,52 +219,67 @@ class RequirementsManager:
             # we filter out git+.*, as these indicate python modules fetched
             # from git repositiories, without version information
             if dep["version"] and not dep["name"].startswith("git+") and noun == "pip":
-                params.append(f"{dep['name']}=={dep['version']}")
+                packages.append(f"{dep['name']}=={dep['version']}")
             elif dep["version"] and not dep["name"].startswith("git+") and noun == "conda":
-                params.append(f"{dep['name']}={dep['version']}")
+                packages.append(f"{dep['name']}={dep['version']}")
             else:
-                params.append(dep["name"])
+                packages.append(dep["name"])
 
-        if len(params) == 0:
+        if len(packages) == 0:
             Log.log("Nothing to install")
-            # nothing to install
+            # only local tools
             return
 
-        if utils.run_process_log_output(params):
+        if utils.run_process_log_output(params + packages):
             Log.log(f"Succesfully installed {noun} dependencies")
         else:
             Log.log(
                 f"There was an error installing {noun} packages, see the log")
 
     def install(self, config):
+        self._load_manifest()
+        try:
+            self._install(config)
+        finally:
+            self._save_manifest()
+
+    def _install(self, config):
+
+        # Both lists are verified at once, the pip list again only if conda
+        # installed something, as conda packages may provide pip ones.
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            missing_conda_deps = pool.submit(self._missing_deps,
+                                             self._conda_deps, "bin")
+            missing_pip_deps = pool.submit(self._missing_deps,
+                                           self._pip_deps, "py")
+            missing_conda_deps = missing_conda_deps.result()
+            missing_pip_deps = missing_pip_deps.result()
 
         conda_params = ["conda", "install", "-y"]
         if config.conda_flags:
             conda_params.append(config.conda_flags())
 
-        self._build_deps_and_run_install(conda_params, self._conda_deps,
+        self._build_deps_and_run_install(conda_params, missing_conda_deps,
                                          "conda", config)
 
-        for dep in self._conda_deps:
-            if not self._verify_dep(dep, "bin"):
-                raise Exception(
-                    f"Conda dependency {dep['name']} was not installed properly"
-                )
+        for dep in self._missing_deps(missing_conda_deps, "bin"):
+            raise Exception(
+                f"Conda dependency {dep['name']} was not installed properly"
+            )
 
-        pip_params = ["pip", "install"]
+        if len(missing_conda_deps) > 0:
+            importlib.invalidate_caches()
+            missing_pip_deps = self._missing_deps(missing_pip_deps, "py")
 
-        missing_pip_deps = []
-        for dep in self._pip_deps:
-            if not self._verify_dep(dep, "py"):
-                missing_pip_deps.append(dep)
+        pip_params = ["pip", "install"]
 
         self._build_deps_and_run_install(pip_params, missing_pip_deps, "pip",
                                          config)
+        importlib.invalidate_caches()
 
-        for dep in self._pip_deps:
-            if not self._verify_dep(dep, "py"):
-                raise Exception(
-                    f"PIP dependency {dep['name']} was not installed properly")
+        for dep in self._missing_deps(missing_pip_deps, "py"):
+            raise Exception(
+                f"PIP dependency {dep['name']} was not installed properly")
 
     def __init__(self):
         self._conda_deps = []
@@ -184,6 +289,12 @@ class RequirementsManager:
                       "requirements"))
         if not Path.isdir(self._requirements_dir):
             raise Exception("Missing requirements directory")
+        # Results of the version probes, see _probe_version()
+        self._manifest = {}
+        self._manifest_lock = threading.Lock()
+        build_dir = os.environ.get("BUILD_DIR") or Path.join(
+            Path.dirname(self._requirements_dir), "build")
+        self._manifest_file = Path.join(build_dir, "prepare-manifest.json")
         # ([^\ #]+) non-space, non # character -> package name
         # (==([^ #]+))? - two equality signs followed by version - optional
         # #(bin|py) - hash and information how to check the requirement
@@ -210,12 +321,13 @@ def prepare():
     # conda -> default bin
     # pip - default py
 
-    req = RequirementsManager()
-    cfg = config.ConfigManager()
+    with Log.stage("prepare"):
+        req = RequirementsManager()
+        cfg = config.ConfigManager()
 
-    # first scan for general dependencies
-    req.scan()
-    for target in cfg.get_all_parameters():
-        req.scan(target)
+        # first scan for general dependencies
+        req.scan()
+        for target in cfg.get_all_parameters():
+            req.scan(target)
 
-    req.install(cfg)
+        req.install(cfg)
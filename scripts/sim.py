@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Runs a SoC of the sim platform in Verilator.
+
+The compiled model (obj_dir/Vdut and the simulator modules) is cached by
+the digest of the generated sources, the Verilator version and the number
+of threads, so identical SoCs are only compiled once.
+
+The memories are initialized from the .init files when the simulation
+starts. A firmware change only rewrites these files; the SoC is only
+elaborated again when its inputs changed.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from litex.soc.integration.soc_sdram import *
+from litex.soc.integration.builder import *
+
+import cache
+import utils
+from log import Log
+from make import get_args, get_builddir, get_platform, get_soc, add_software_packages, get_builder
+from gateware.firmware import read_firmware_words
+from patch_bitstream import CPU_ENDIANNESS
+
+
+# State of the generated simulation, in the gateware directory
+SIM_STATE = "sim.json"
+# Files of the gateware directory which the simulation only reads when run
+RUNTIME_FILES = ["*.init", "sim_config.js", "build_*.sh", "run_*.sh", SIM_STATE]
+# Options which don't change the SoC
+SIM_OPTIONS = ["threads", "no_run", "no_sim_cache", "sim_cache_dir"]
+
+
+def get_core_dir():
+    from litex.build.sim import verilator
+    return verilator.core_directory
+
+
+def get_sim_config(args, soc):
+    from litex.build.sim.config import SimConfig
+    sim_config = SimConfig(default_clk="sys_clk")
+    sim_config.add_module("serial2console", "serial")
+    if hasattr(soc, "ethphy"):
+        # tap0 is set up by "make sim-setup"
+        sim_config.add_module("ethernet", "eth", args={"interface": "tap0", "ip": "{}.100".format(args.iprange)})
+    return sim_config
+
+
+def get_elaboration_key(args, ignore=()):
+    ignore = set(SIM_OPTIONS).union(ignore)
+    return cache.soc_inputs_digest(os.getcwd(), sorted((name, value) for name, value in vars(args).items() if name not in ignore))
+
+
+def load_state(gateware_dir):
+    try:
+        with open(os.path.join(gateware_dir, SIM_STATE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def elaborate(args, builddir, key):
+    """
+    Elaborates the SoC, builds its software and generates the simulation
+    sources. Returns the state used to rerun it without elaboration.
+    """
+    with Log.stage("elaborate"):
+        platform = get_platform(args)
+        soc = get_soc(args, platform)
+
+    firmware_mem = soc.firmware_ram.mem
+    if not firmware_mem.init:
+        # The firmware is only built below, it's loaded into the .init file
+        # of the memory afterwards.
+        firmware_mem.init = [0]
+
+    buildargs = builder_argdict(args)
+    if not buildargs.get('output_dir', None):
+        buildargs['output_dir'] = builddir
+    buildargs['compile_gateware'] = False
+    builder = get_builder(soc, **buildargs)
+    add_software_packages(args, builder, soc)
+    sim_config = get_sim_config(args, soc)
+    with Log.stage("generate"):
+        vns = builder.build(build=False, sim_config=sim_config, **dict(args.build_option))
+
+    memories = [{
+        "init": vns.get_name(firmware_mem) + ".init",
+        "data": firmware_mem.filename,
+        "endianness": "big",  # as in FirmwareROM
+        "depth": firmware_mem.depth,
+    }]
+    if hasattr(soc, "rom"):
+        memories.append({
+            "init": vns.get_name(soc.rom.mem) + ".init",
+            "data": os.path.join(builddir, "software", "bios", "bios.bin"),
+            "endianness": CPU_ENDIANNESS[args.cpu_type],
+            "depth": soc.rom.mem.depth,
+        })
+    return {
+        "soc_inputs": key,
+        "software_packages": list(builder.software_packages),
+        "memories": memories,
+        "as_root": sim_config.has_module("ethernet"),
+    }
+
+
+def build_software(builddir, state):
+    with Log.stage("software"):
+        # Same invocation as LiteX's Builder uses for software packages
+        for name, src_dir in state["software_packages"]:
+            dst_dir = os.path.join(builddir, "software", name)
+            os.makedirs(dst_dir, exist_ok=True)
+            subprocess.check_call(["make", "-C", dst_dir, "-f", os.path.join(src_dir, "Makefile")])
+
+
+def load_memories(gateware_dir, state):
+    for memory in state["memories"]:
+        if not os.path.isfile(memory["data"]):
+            Log.log("{} not found, {} keeps its contents".format(memory["data"], memory["init"]))
+            continue
+        words = read_firmware_words(memory["data"], memory["endianness"])
+        if len(words) > memory["depth"]:
+            raise Exception("{} is too big! {} bytes > {} bytes".format(
+                memory["data"], len(words) * 4, memory["depth"] * 4))
+        with open(os.path.join(gateware_dir, memory["init"]), "w") as f:
+            f.write("".join("{:08x}\n".format(w) for w in words))
+
+
+def get_model_digest(gateware_dir, threads):
+    runtime = set()
+    for pattern in RUNTIME_FILES:
+        runtime.update(glob.glob(os.path.join(gateware_dir, pattern)))
+    digest = cache.Digest()
+    for filename in sorted(glob.glob(os.path.join(gateware_dir, "*"))):
+        if os.path.isfile(filename) and filename not in runtime:
+            digest.add_file(filename, os.path.basename(filename))
+    digest.add_tree(get_core_dir(), suffixes=(".c", ".cpp", ".h", ".mak", "Makefile"))
+    digest.add("verilator", utils.get_program_version("verilator"))
+    digest.add("threads", str(threads))
+    return digest.hexdigest()
+
+
+def build_model(args, gateware_dir):
+    key = get_model_digest(gateware_dir, args.threads)
+    stamp = os.path.join(gateware_dir, "obj_dir", ".model")
+    model = os.path.join(gateware_dir, "obj_dir", "Vdut")
+    if os.path.isfile(stamp) and os.path.isfile(model):
+        with open(stamp, "r") as f:
+            if f.read().strip() == key:
+                Log.log("Sim model up to date ({})".format(key[:16]))
+                return
+
+    model_cache = cache.BuildCache(args.sim_cache_dir)
+    restored = None if args.no_sim_cache else model_cache.restore(key, gateware_dir)
+    if restored:
+        Log.log("Sim model cache hit ({}), restored {}".format(key[:16], ", ".join(restored)))
+    else:
+        Log.log("Sim model cache miss ({}), running Verilator".format(key[:16]))
+        with Log.stage("verilate"):
+            # Same build LiteX runs itself, without removing obj_dir first
+            cmd = ["make", "-C", gateware_dir, "-f", os.path.join(get_core_dir(), "Makefile")]
+            if args.threads > 1:
+                cmd.append("THREADS={}".format(args.threads))
+            subprocess.check_call(cmd)
+            modules_dir = os.path.join(gateware_dir, "modules")
+            os.makedirs(modules_dir, exist_ok=True)
+            for module in glob.glob(os.path.join(gateware_dir, "obj_dir", "*.so")):
+                shutil.copy(module, modules_dir)
+        names = [os.path.relpath(model, gateware_dir)]
+        names += [os.path.relpath(module, gateware_dir) for module in sorted(glob.glob(os.path.join(gateware_dir, "modules", "*.so")))]
+        if not args.no_sim_cache:
+            model_cache.store(key, gateware_dir, names)
+    with open(stamp, "w") as f:
+        f.write(key)
+
+
+def prepare_sim(args, ignore=()):
+    """
+    Brings the simulation of `args` up to date, `ignore` names additional
+    options which don't change the SoC.
+    Returns the gateware directory and the simulation state.
+    """
+    builddir = get_builddir(args)
+    gateware_dir = os.path.join(builddir, "gateware")
+    if not any(name == "firmware_filename" for name, _ in args.target_option):
+        args.target_option.append(("firmware_filename", os.path.join(builddir, "software", "firmware", "firmware.fbi")))
+
+    key = get_elaboration_key(args, ignore)
+    state = load_state(gateware_dir)
+    if state is not None and state["soc_inputs"] == key:
+        Log.log("SoC unchanged, rebuilding software and reloading memories")
+        build_software(builddir, state)
+    else:
+        state = elaborate(args, builddir, key)
+        with open(os.path.join(gateware_dir, SIM_STATE), "w") as f:
+            json.dump(state, f, indent=1)
+    load_memories(gateware_dir, state)
+    build_model(args, gateware_dir)
+    return gateware_dir, state
+
+
+def get_sim_command(state):
+    cmd = [os.path.join("obj_dir", "Vdut")]
+    if state["as_root"]:
+        cmd = ["sudo"] + cmd
+    return cmd
+
+
+def run_sim(gateware_dir, state):
+    # serial2console switches the terminal to raw mode
+    termios_settings = None
+    if sys.stdin.isatty():
+        import termios
+        termios_settings = termios.tcgetattr(sys.stdin.fileno())
+    try:
+        with Log.stage("sim"):
+            return subprocess.call(get_sim_command(state), cwd=gateware_dir)
+    finally:
+        if termios_settings is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSAFLUSH, termios_settings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verilator simulation of the sim platform", conflict_handler='resolve')
+    get_args(parser, platform='sim', target='base')
+    builder_args(parser)
+    soc_sdram_args(parser)
+    parser.add_argument("--threads", type=int, default=1, help="number of Verilator threads")
+    parser.add_argument("--no-run", action="store_true", help="only build the simulation")
+    parser.add_argument("--no-sim-cache", action="store_true", help="always compile the Verilator model")
+    parser.add_argument("--sim-cache-dir", action="store", default=cache.default_cache_dir("sim"), help="Verilator model cache directory")
+    args = parser.parse_args()
+
+    gateware_dir, state = prepare_sim(args)
+    if not args.no_run:
+        sys.exit(run_sim(gateware_dir, state))
+
+
+if __name__ == "__main__":
+    main()
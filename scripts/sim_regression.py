@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Boots the firmware on a sim platform SoC and runs scripted console
+sessions on its UART, which is attached to a pty.
+
+A session file has one step per line:
+    send <line>         types <line> and Enter on the console
+    expect <regex>      waits until the console output matches <regex>
+    reject <regex>      fails if the output the last expect waited for
+                        matches <regex>
+    timeout <seconds>   wall-clock timeout of the following expects
+    requires <define>   skips the session if csr.h lacks <define>
+Lines starting with '#' are comments.
+
+Reports the boot time, the clock cycles the firmware counted until its
+first prompt and the simulated cycles per wall-clock second.
+"""
+
+import argparse
+import glob
+import json
+import os
+import pty
+import re
+import select
+import signal
+import subprocess
+import sys
+import time
+import tty
+
+from litex.soc.integration.soc_sdram import *
+from litex.soc.integration.builder import *
+
+import cache
+from log import Log
+from make import get_args, get_builddir
+from sim import prepare_sim, get_sim_command
+
+
+# Printed by the firmware when it's ready for a command
+PROMPT = r"H2U \d\d:\d\d:\d\d>"
+CYCLES = r"cycles: 0x([0-9a-fA-F]+)"
+DEFAULT_TIMEOUT = 60
+# Options of this script which don't change the SoC
+HARNESS_OPTIONS = ["boot_timeout", "max_boot_cycles", "min_cycles_per_second", "report", "sessions"]
+SESSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_sessions")
+
+
+class SessionError(Exception):
+    pass
+
+
+class SimConsole:
+    """
+    The UART of a running simulation. serial2console talks to the
+    simulation's stdin/stdout, which are a pty here.
+    """
+
+    def __init__(self, gateware_dir, state):
+        self.output = ""
+        self.consumed = ""
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.start = time.monotonic()
+        self.process = subprocess.Popen(get_sim_command(state), cwd=gateware_dir,
+                                        stdin=slave, stdout=slave, stderr=slave,
+                                        start_new_session=True)
+        os.close(slave)
+        self.master = master
+
+    def _read(self, timeout):
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            data = b""
+        if not data:
+            raise SessionError("Simulation exited with code {}".format(self.process.wait()))
+        data = data.decode("utf-8", "replace")
+        Log.write(data)
+        self.output += data
+
+    def expect(self, pattern, timeout=DEFAULT_TIMEOUT):
+        """
+        Waits for `pattern` in the output, which is consumed up to the end
+        of the match. Returns the match.
+        """
+        regex = re.compile(pattern)
+        deadline = time.monotonic() + timeout
+        while True:
+            m = regex.search(self.output)
+            if m:
+                self.consumed = self.output[:m.end()]
+                self.output = self.output[m.end():]
+                return m
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SessionError("Timeout waiting for '{}', last output:\n{}".format(pattern, self.output[-2000:]))
+            self._read(remaining)
+
+    def send(self, line):
+        os.write(self.master, (line + "\n").encode("utf-8"))
+
+    def cycles(self, timeout=DEFAULT_TIMEOUT):
+        self.send("debug cycles")
+        cycles = int(self.expect(CYCLES, timeout).group(1), 16)
+        self.expect(PROMPT, timeout)
+        return cycles
+
+    def close(self):
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        os.close(self.master)
+
+
+def load_session(filename):
+    steps = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            command, _, argument = line.partition(" ")
+            if command not in ("send", "expect", "reject", "timeout", "requires"):
+                raise Exception("Unknown step '{}' in {}".format(command, filename))
+            steps.append((command, argument))
+    return steps
+
+
+def run_session(console, steps, defines):
+    timeout = DEFAULT_TIMEOUT
+    console.consumed = ""
+    for command, argument in steps:
+        if command == "requires" and argument not in defines:
+            return "skip"
+        elif command == "timeout":
+            timeout = float(argument)
+        elif command == "send":
+            console.send(argument)
+        elif command == "expect":
+            console.expect(argument, timeout)
+        elif command == "reject" and re.search(argument, console.consumed):
+            raise SessionError("Output matches '{}':\n{}".format(argument, console.consumed))
+    return "pass"
+
+
+def get_defines(builddir):
+    with open(os.path.join(builddir, "software", "include", "generated", "csr.h"), "r") as f:
+        return set(re.findall(r"#define\s+(\w+)", f.read()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Firmware regression sessions on the sim platform", conflict_handler='resolve')
+    get_args(parser, platform='sim', target='base')
+    builder_args(parser)
+    soc_sdram_args(parser)
+    parser.add_argument("--threads", type=int, default=1, help="number of Verilator threads")
+    parser.add_argument("--no-sim-cache", action="store_true", help="always compile the Verilator model")
+    parser.add_argument("--sim-cache-dir", action="store", default=cache.default_cache_dir("sim"), help="Verilator model cache directory")
+    parser.add_argument("--boot-timeout", type=float, default=600, help="seconds to wait for the first prompt")
+    parser.add_argument("--max-boot-cycles", type=int, default=None, help="fail if booting takes more cycles")
+    parser.add_argument("--min-cycles-per-second", type=float, default=None, help="fail if the simulation is slower")
+    parser.add_argument("--report", default=None, help="JSON report (default: <builddir>/test/sim-report.json)")
+    parser.add_argument("sessions", nargs="*", help="session files (default: all in scripts/sim_sessions)")
+    args = parser.parse_args()
+
+    sessions = args.sessions or sorted(glob.glob(os.path.join(SESSIONS_DIR, "*.session")))
+    gateware_dir, state = prepare_sim(args, HARNESS_OPTIONS)
+    builddir = get_builddir(args)
+    defines = get_defines(builddir)
+
+    report = {"sessions": []}
+    console = SimConsole(gateware_dir, state)
+    try:
+        with Log.stage("sim-boot"):
+            console.expect(PROMPT, args.boot_timeout)
+        report["boot_seconds"] = round(time.monotonic() - console.start, 3)
+        start = time.monotonic()
+        report["boot_cycles"] = console.cycles()
+
+        for filename in sessions:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            session_start = time.monotonic()
+            try:
+                status = run_session(console, load_session(filename), defines)
+                error = None
+            except SessionError as e:
+                status, error = "fail", str(e)
+                # Get back to a prompt for the next session
+                console.send("")
+                console.expect(PROMPT)
+            report["sessions"].append({"name": name, "status": status, "error": error,
+                                       "duration": round(time.monotonic() - session_start, 3)})
+
+        cycles = console.cycles() - report["boot_cycles"]
+        report["cycles_per_second"] = round(cycles / (time.monotonic() - start), 1)
+    finally:
+        console.close()
+
+    failed = [s["name"] for s in report["sessions"] if s["status"] == "fail"]
+    if args.max_boot_cycles is not None and report["boot_cycles"] > args.max_boot_cycles:
+        failed.append("boot cycles {} > {}".format(report["boot_cycles"], args.max_boot_cycles))
+    if args.min_cycles_per_second is not None and report["cycles_per_second"] < args.min_cycles_per_second:
+        failed.append("{} cycles/s < {}".format(report["cycles_per_second"], args.min_cycles_per_second))
+
+    report_file = args.report or os.path.join(builddir, "test", "sim-report.json")
+    os.makedirs(os.path.dirname(os.path.abspath(report_file)), exist_ok=True)
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+
+    lines = ["Sim regression summary:"]
+    for s in report["sessions"]:
+        lines.append("  {:4}  {:9.1f}s  {}".format(s["status"], s["duration"], s["name"]))
+    lines.append("Boot: {}s, {} cycles; {} cycles/s".format(report["boot_seconds"], report["boot_cycles"], report["cycles_per_second"]))
+    if failed:
+        lines.append("Failed: {}".format(", ".join(failed)))
+    Log.log("\n".join(lines))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ from litedram.modules import MT41K128M16
 from litedram.phy import a7ddrphy
 from litedram.core import ControllerSettings
 
+from gateware import flash_cache
 from gateware import info
 from gateware import led
 from gateware import spi_flash
@@ -52,6 +53,7 @@ class _CRG(Module):
 class BaseSoC(SoCCore):
     csr_peripherals = (
         "spiflash",
+        "spiflash_cache",
         "info",
     )
     csr_map_update(SoCCore.csr_map, csr_peripherals)
@@ -68,6 +70,7 @@ class BaseSoC(SoCCore):
             kwargs['integrated_sram_size']=0x8000
 
         clk_freq = int(100e6)
+        spiflash_cache = flash_cache.pop_flash_cache_args(kwargs)
         SoCCore.__init__(self, platform, clk_freq, **kwargs)
 
         self.submodules.crg = _CRG(platform)
@@ -90,10 +93,12 @@ class BaseSoC(SoCCore):
         self.submodules.spiflash = spi_flash.SpiFlash(
                 spiflash_pads,
                 dummy=spiflash_dummy[spiflash],
-                div=2)
+                div=2,
+                **flash_cache.spi_flash_args(spiflash_cache, spiflash_pads))
+        spiflash_bus = flash_cache.add_flash_cache(self, self.spiflash.bus, spiflash_cache)
         self.add_constant("SPIFLASH_PAGE_SIZE", 256)
         self.add_constant("SPIFLASH_SECTOR_SIZE", 0x10000)
-        self.add_wb_slave(mem_decoder(self.mem_map["spiflash"]), self.spiflash.bus)
+        self.add_wb_slave(mem_decoder(self.mem_map["spiflash"]), spiflash_bus)
         self.add_memory_region(
             "spiflash", self.mem_map["spiflash"], 16*1024*1024)
 
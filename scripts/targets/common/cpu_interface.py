@@ -1,61 +1,144 @@
+import contextlib
+import os
+import pprint
+
 from migen import *
 from litex.soc.interconnect.csr import CSRStatus
 
 
 def _get_rw_functions(reg_name, reg_base, nwords, busword, read_only):
-    r = ""
+    reg_name = reg_name.upper()
+    return [
+        "#define CSR_"+reg_name+"_ADDR "+hex(reg_base)+"\n",
+        "#define CSR_"+reg_name+"_SIZE "+str(nwords)+"\n",
+        "#define CSR_"+reg_name+"_RO "+str(int(read_only))+"\n",
+    ]
+
 
-    r += "#define CSR_"+reg_name.upper()+"_ADDR "+hex(reg_base)+"\n"
-    r += "#define CSR_"+reg_name.upper()+"_SIZE "+str(nwords)+"\n"
-    r += "#define CSR_"+reg_name.upper()+"_RO "+str(int(read_only))+"\n"
-    return r
+def _iter_csrs(name, origin, busword, obj):
+    # (name, address, number of bus words, read only) of every CSR of a region
+    for csr in obj:
+        nr = (csr.size + busword - 1)//busword
+        yield name + "_" + csr.name, origin, nr, isinstance(csr, CSRStatus)
+        origin += 4*nr
 
 
 def get_csr_header(regions, constants):
-    r = "#ifndef __GENERATED_CSR_H\n#define __GENERATED_CSR_H\n"
+    r = ["#ifndef __GENERATED_CSR_H\n#define __GENERATED_CSR_H\n"]
     for name, origin, busword, obj in regions:
         origin = origin & 0x7fffffff
         if isinstance(obj, Memory):
-            r += "#define "+name.upper()+"_BASE "+hex(origin)+"\n"
+            r.append("#define "+name.upper()+"_BASE "+hex(origin)+"\n")
         else:
-            r += "\n/* "+name+" */\n"
-            r += "#define "+name.upper()+"_BASE "+hex(origin)+"\n"
-            for csr in obj:
-                nr = (csr.size + busword - 1)//busword
-                r += _get_rw_functions(name + "_" + csr.name, origin, nr, busword, isinstance(csr, CSRStatus))
-                origin += 4*nr
-
-    r += "\n/* constants */\n"
+            r.append("\n/* "+name+" */\n")
+            r.append("#define "+name.upper()+"_BASE "+hex(origin)+"\n")
+            for csr_name, address, nr, read_only in _iter_csrs(name, origin, busword, obj):
+                r += _get_rw_functions(csr_name, address, nr, busword, read_only)
+
+    r.append("\n/* constants */\n")
     for name, value in constants:
-        r += "#define " + name
         if value is not None:
-            r += " " + str(value)
-        r += "\n"
+            r.append("#define " + name + " " + str(value) + "\n")
+        else:
+            r.append("#define " + name + "\n")
 
-    r += "\n#endif\n"
-    return r
+    r.append("\n#endif\n")
+    return "".join(r)
 
 
 def get_csr_csv(csr_regions=None, constants=None, memory_regions=None):
-    r = ""
+    r = []
 
     if csr_regions is not None:
         for name, origin, busword, obj in csr_regions:
-            r += "csr_base,{},0x{:08x},,\n".format(name, origin)
+            r.append("csr_base,{},0x{:08x},,\n".format(name, origin))
 
         for name, origin, busword, obj in csr_regions:
             if not isinstance(obj, Memory):
-                for csr in obj:
-                    nr = (csr.size + busword - 1)//busword
-                    r += "csr_register,{}_{},0x{:08x},{},{}\n".format(name, csr.name, origin, nr, "ro" if isinstance(csr, CSRStatus) else "rw")
-                    origin += 4*nr
+                for csr_name, address, nr, read_only in _iter_csrs(name, origin, busword, obj):
+                    r.append("csr_register,{},0x{:08x},{},{}\n".format(csr_name, address, nr, "ro" if read_only else "rw"))
 
     if constants is not None:
         for name, value in constants:
-            r += "constant,{},{},,\n".format(name.lower(), value)
+            r.append("constant,{},{},,\n".format(name.lower(), value))
 
     if memory_regions is not None:
         for name, origin, length in memory_regions:
-            r += "memory_region,{},0x{:08x},{:d},\n".format(name.lower(), origin, length)
+            r.append("memory_region,{},0x{:08x},{:d},\n".format(name.lower(), origin, length))
+
+    return "".join(r)
+
+
+def get_csr_map(regions, constants, mem_regions):
+    """
+    Register map in the layout of LiteX's csr.json, for host tools.
+    """
+    csr_bases = {}
+    csr_registers = {}
+    constants = {name.lower(): value for name, value in constants}
+    for name, origin, busword, obj in regions:
+        csr_bases[name] = origin
+        if not isinstance(obj, Memory):
+            # Host tools combine the bus words of a CSR with it
+            constants.setdefault("config_csr_data_width", busword)
+            for csr_name, address, nr, read_only in _iter_csrs(name, origin, busword, obj):
+                csr_registers[csr_name] = {"addr": address, "size": nr, "type": "ro" if read_only else "rw"}
+    return {
+        "csr_bases": csr_bases,
+        "csr_registers": csr_registers,
+        "constants": constants,
+        "memories": {name.lower(): {"base": region.origin, "size": region.length} for name, region in mem_regions.items()},
+    }
+
+
+def get_csr_python(regions, constants, mem_regions):
+    """
+    The register map as a Python module, e.g. build/<...>/test/csr.py.
+    """
+    csr_map = get_csr_map(regions, constants, mem_regions)
+    r = ["# Generated by make.py, same layout as csr.json\n"]
+    for name in ("csr_bases", "csr_registers", "constants", "memories"):
+        r.append("\n{} = {}\n".format(name, pprint.pformat(csr_map[name], width=120)))
+    return "".join(r)
+
+
+def write_to_file_if_changed(filename, contents, force_unix=False):
+    """
+    Same as litex.build.tools.write_to_file(), but leaves the file alone
+    when its contents are the same, so make doesn't rebuild what depends
+    on it. Returns True if the file was written.
+    """
+    newline = "\n" if force_unix else None
+    try:
+        with open(filename, "r", newline=newline) as f:
+            if f.read() == contents:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with open(filename, "w", newline=newline) as f:
+        f.write(contents)
+    return True
+
 
-    return r
+@contextlib.contextmanager
+def keep_unchanged_files(directory):
+    """
+    Gives the files under `directory` which are rewritten with the same
+    contents in the context their previous times back, as if they were
+    written with write_to_file_if_changed().
+    """
+    before = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            filename = os.path.join(root, name)
+            with open(filename, "rb") as f:
+                before[filename] = (f.read(), os.stat(filename))
+    yield
+    for filename, (contents, stat) in before.items():
+        try:
+            with open(filename, "rb") as f:
+                if f.read() != contents:
+                    continue
+        except OSError:
+            continue
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
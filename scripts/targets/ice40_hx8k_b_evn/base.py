@@ -11,6 +11,7 @@ from litex.soc.integration.soc_core import *
 from litex.soc.integration.builder import *
 
 from gateware import cas
+from gateware import flash_cache
 from gateware import spi_flash
 
 from targets.utils import csr_map_update
@@ -45,6 +46,7 @@ class _CRG(Module):
 class BaseSoC(SoCCore):
     csr_peripherals = (
         "spiflash",
+        "spiflash_cache",
         "cas",
     )
     csr_map_update(SoCCore.csr_map, csr_peripherals)
@@ -65,6 +67,7 @@ class BaseSoC(SoCCore):
         clk_freq = int(12e6)
 
         kwargs['cpu_reset_address']=self.mem_map["spiflash"]+platform.gateware_size
+        spiflash_cache = flash_cache.pop_flash_cache_args(kwargs)
         SoCCore.__init__(self, platform, clk_freq, **kwargs)
 
         self.submodules.crg = _CRG(platform)
@@ -78,10 +81,11 @@ class BaseSoC(SoCCore):
             platform.request("spiflash"),
             dummy=platform.spiflash_read_dummy_bits,
             div=platform.spiflash_clock_div)
+        spiflash_bus = flash_cache.add_flash_cache(self, self.spiflash.bus, spiflash_cache)
         self.add_constant("SPIFLASH_PAGE_SIZE", platform.spiflash_page_size)
         self.add_constant("SPIFLASH_SECTOR_SIZE", platform.spiflash_sector_size)
         self.register_mem("spiflash", self.mem_map["spiflash"],
-            self.spiflash.bus, size=platform.spiflash_total_size)
+            spiflash_bus, size=platform.spiflash_total_size)
 
         bios_size = 0x8000
         self.add_constant("ROM_DISABLE", 1)
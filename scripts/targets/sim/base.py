@@ -18,7 +18,6 @@ from targets.utils import csr_map_update
 
 class BaseSoC(SoCSDRAM):
     csr_peripherals = (
-        ,
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -32,10 +31,13 @@ class BaseSoC(SoCSDRAM):
             kwargs['integrated_rom_size']=0x8000
         if 'integrated_sram_size' not in kwargs:
             kwargs['integrated_sram_size']=0x8000
-        if 'firmware_ram_size' not in kwargs:
-            kwargs['firmware_ram_size']=0x10000
-        if 'firmware_filename' not in kwargs:
-            kwargs['firmware_filename'] = "build/sim_{}_{}/software/firmware/firmware.fbi".format(
+        firmware_ram_size = kwargs.pop('firmware_ram_size', 0x10000)
+        if isinstance(firmware_ram_size, str):
+            # -Ot firmware_ram_size 0x20000
+            firmware_ram_size = int(firmware_ram_size, 0)
+        firmware_filename = kwargs.pop('firmware_filename', None)
+        if firmware_filename is None:
+            firmware_filename = "build/sim_{}_{}/software/firmware/firmware.fbi".format(
                 self.__class__.__name__.lower()[:-3], kwargs.get('cpu_type', 'lm32'))
 
         clk_freq = int((1/(platform.default_clk_period))*1000000000)
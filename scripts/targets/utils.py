@@ -67,3 +67,111 @@ class MHzType(int):
 
 
 MHz = MHzType(1)
+
+
+# Legal parameters of the clock generators, for the slowest speed grade.
+# Output = input * m / d / divide, the VCO runs at input * m / d and the
+# phase detector at input / d.
+PLL_LIMITS = {
+    # Spartan-6 DCM_CLKGEN, CLKFX has no VCO or output divider
+    "DCM_CLKGEN": dict(m=(2, 256), d=(1, 256), divide=(1, 1), vco=None, pfd=None, output=(5e6, 375e6)),
+    # Spartan-6 PLL_BASE/PLL_ADV
+    "PLL_BASE": dict(m=(1, 64), d=(1, 52), divide=(1, 128), vco=(400e6, 1000e6), pfd=(19e6, 400e6), output=(3.125e6, 1000e6)),
+    # 7 Series PLLE2_BASE/PLLE2_ADV
+    "PLLE2": dict(m=(2, 64), d=(1, 56), divide=(1, 128), vco=(800e6, 1600e6), pfd=(19e6, 450e6), output=(6.25e6, 800e6)),
+    # 7 Series MMCME2_BASE/MMCME2_ADV
+    "MMCME2": dict(m=(2, 64), d=(1, 106), divide=(1, 128), vco=(600e6, 1200e6), pfd=(10e6, 450e6), output=(4.69e6, 800e6)),
+}
+
+
+def solve_pll(primitive, clkin, freqs, divides=None):
+    """
+    Searches the legal multipliers and dividers of `primitive` for the
+    closest match of the output frequencies `freqs` from `clkin` (in Hz).
+    `divides` fixes the output dividers where not None.
+    Returns (m, d, divides, output frequencies). Of equally good solutions
+    the one with the highest VCO frequency, then the smallest d is taken.
+    """
+    limits = PLL_LIMITS[primitive]
+    clkin = int(clkin)
+    freqs = [int(f) for f in freqs]
+    divides = divides or [None]*len(freqs)
+
+    def in_range(value, limit):
+        return limit is None or limit[0] <= value <= limit[1]
+
+    def best_divide(vco_num, vco_den, freq, divide):
+        # Output divider closest to vco/freq, and its error as a fraction
+        if divide is None:
+            divide = max(limits["divide"][0], min(limits["divide"][1], round(vco_num / (vco_den*freq)) or 1))
+        return divide, abs(vco_num - freq*vco_den*divide), vco_den*divide
+
+    best = None
+    m_min, m_max = limits["m"]
+    for d in range(limits["d"][0], limits["d"][1] + 1):
+        if not in_range(clkin / d, limits["pfd"]):
+            continue
+        if len(freqs) == 1 and divides[0] is not None:
+            # Only the closest multipliers matter
+            ideal = freqs[0]*d*divides[0] // clkin
+            ms = [m for m in (ideal, ideal + 1) if m_min <= m <= m_max]
+        else:
+            ms = range(m_min, m_max + 1)
+        for m in ms:
+            vco = clkin*m / d
+            if not in_range(vco, limits["vco"]):
+                continue
+            outputs = [best_divide(clkin*m, d, f, div) for f, div in zip(freqs, divides)]
+            if not all(in_range(clkin*m / (d*div), limits["output"]) for div, _, _ in outputs):
+                continue
+            # Sum of the relative errors, as a fraction
+            num, den = 0, 1
+            for (div, e_num, e_den), f in zip(outputs, freqs):
+                num, den = num*e_den*f + e_num*den, den*e_den*f
+            if best is None or num*best[1] < best[0]*den or (num*best[1] == best[0]*den and vco > best[2]):
+                best = (num, den, vco, m, d, [div for div, _, _ in outputs])
+    if best is None:
+        raise Exception("{} can't generate {} from {} Hz".format(primitive, freqs, clkin))
+    m, d, divides = best[3:]
+    return m, d, divides, [clkin*m / (d*div) for div in divides]
+
+
+def get_pixel_clock_table(pixel_clocks):
+    """
+    C lookup table of the clock generator settings of the HDMI outputs for
+    the pixel clocks (in 10 kHz) of firmware/processor.c's modes, which its
+    fb_get_clock_md() otherwise searches at runtime.
+    """
+    tables = [
+        # Spartan-6: DCM_CLKGEN from 50 MHz
+        ("CSR_HDMI_OUT0_DRIVER_CLOCKING_PLL_RESET_ADDR", "DCM_CLKGEN", 50e6, [1]),
+        # Artix-7: MMCM from 100 MHz. The pixel clock is CLKOUT0 and the 5x
+        # serializer clock CLKOUT1, so CLKOUT0 is divided by a multiple of 5.
+        ("CSR_HDMI_OUT0_DRIVER_CLOCKING_MMCM_RESET_ADDR", "MMCME2", 100e6, range(5, 127, 5)),
+    ]
+    pixel_clocks = sorted(set(pixel_clocks))
+    r = ["/* Generated from the modes in processor.c by clock_table.py, do not edit */\n",
+         "#ifndef __CLOCK_TABLE_H\n#define __CLOCK_TABLE_H\n\n",
+         "#include <generated/csr.h>\n\n",
+         "struct clock_md {\n\tunsigned int pixel_clock;\n\tunsigned short m;\n\tunsigned short d;\n\tunsigned short divide;\n};\n"]
+    for i, (define, primitive, clkin, divides) in enumerate(tables):
+        r.append("\n#{} defined({})\n".format("if" if i == 0 else "elif", define))
+        r.append("/* {} from {:g} MHz */\n".format(primitive, clkin/1e6))
+        r.append("#define CLOCK_MD_TABLE_SIZE {}\n".format(len(pixel_clocks)))
+        r.append("static const struct clock_md clock_md_table[CLOCK_MD_TABLE_SIZE] = {\n")
+        for pixel_clock in pixel_clocks:
+            freq = pixel_clock*10000
+            solutions = []
+            for divide in divides:
+                try:
+                    m, d, _, outputs = solve_pll(primitive, clkin, [freq], [divide])
+                except Exception:
+                    continue
+                solutions.append((abs(outputs[0] - freq), -clkin*m/d, m, d, divide, outputs[0]))
+            if not solutions:
+                raise Exception("{} can't generate a pixel clock of {} Hz".format(primitive, freq))
+            _, _, m, d, divide, output = min(solutions)
+            r.append("\t{{ {:5}, {:3}, {:3}, {:3} }}, /* {:.3f} MHz */\n".format(pixel_clock, m, d, divide, output/1e6))
+        r.append("};\n")
+    r.append("#endif\n\n#endif\n")
+    return "".join(r)
@@ -1,3 +1,5 @@
+import codecs
+import collections
 import subprocess
 import importlib
 import importlib.util
@@ -8,6 +10,11 @@ import io
 import contextlib
 import os.path as Path
 
+# Size of the reads from a child process' output
+CHUNK_SIZE = 64 * 1024
+# Longest partial line kept for the error report
+MAX_LINE = 4096
+
 
 def create_symlink(source, destination):
     if Path.exists(destination):
@@ -36,10 +43,64 @@ def get_python_module_version(module_name):
         raise
 
 
-def get_program_version(program):
+def get_program_version(program, timeout=None):
     return subprocess.run([program, '--version'],
                           stdout=subprocess.PIPE,
-                          stderr=subprocess.STDOUT).stdout.decode('utf-8')
+                          stderr=subprocess.STDOUT,
+                          timeout=timeout).stdout.decode('utf-8')
+
+
+# Same lookup as get_python_module_version(), run in a separate interpreter
+_PYTHON_VERSION_PROBE = """
+import importlib, sys
+module = importlib.import_module(sys.argv[1])
+version = getattr(module, '__version__', None)
+if version is None:
+    version = importlib.import_module(sys.argv[1] + '.version').__version__
+print(version)
+"""
+
+
+def probe_python_module_version(module_name, timeout=None):
+    """
+    Like get_python_module_version(), but imports the module in a child
+    process, so the import can't affect this one and can be timed out.
+    Raises ImportError if the module or its version can't be found.
+    """
+    result = subprocess.run(
+        [sys.executable, '-c', _PYTHON_VERSION_PROBE, module_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout)
+    if result.returncode != 0:
+        raise ImportError(
+            f"Cannot get version of {module_name}: "
+            f"{result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout.decode('utf-8').strip()
+
+
+# Finds the file of a module in a separate interpreter
+_PYTHON_ORIGIN_PROBE = """
+import importlib.util, sys
+spec = importlib.util.find_spec(sys.argv[1])
+print(spec.origin if spec and spec.has_location else '')
+"""
+
+
+def probe_python_module_origin(module_name, timeout=None):
+    """
+    Returns the path of the file of the module, or None if it can't be
+    found. Finding a submodule imports its parent packages, so it's done
+    in a child process, as in probe_python_module_version().
+    """
+    result = subprocess.run(
+        [sys.executable, '-c', _PYTHON_ORIGIN_PROBE, module_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        timeout=timeout)
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode('utf-8').strip() or None
 
 
 def run_python_module_log_output(name, module_path, tools_dir):
@@ -63,23 +124,40 @@ def run_python_module_log_output(name, module_path, tools_dir):
             f"Module {module_path} does not implement `setup` function")
 
 
-def run_process_log_output(params):
-    log = ""
+def run_process_log_output(params, tail_lines=20):
+    """
+    Runs `params`, streaming its output to the console and the build log as
+    it arrives. Only the last `tail_lines` lines are kept in memory, to be
+    included in the exception raised when the command fails.
+    """
+    tail = collections.deque(maxlen=tail_lines)
+    line = ""
+    decoder = codecs.getincrementaldecoder(sys.stdout.encoding or "utf-8")(
+        errors="replace")
     process = subprocess.Popen(params,
                                stderr=subprocess.STDOUT,
                                stdout=subprocess.PIPE)
 
-    while True:
-        output = process.stdout.readline()
-
-        if output == b'' and process.poll() is not None:
-            break
-        if output:
-            log += output.decode(sys.stdout.encoding)
-    Log.log(log)
-
-    if process.poll() != 0:
-        raise Exception(
-            f"Command '{' '.join(params)}' exited with code {process.poll()}")
-
-    return process.poll() == 0
+    with process:
+        while True:
+            chunk = process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            output = decoder.decode(chunk)
+            Log.write(output)
+            if tail_lines:
+                lines = (line + output).split("\n")
+                line = lines.pop()[-MAX_LINE:]
+                tail.extend(lines)
+        output = decoder.decode(b"", final=True)
+        Log.write(output)
+        if tail_lines and line + output:
+            tail.append(line + output)
+
+    if process.returncode != 0:
+        message = f"Command '{' '.join(params)}' exited with code {process.returncode}"
+        if tail:
+            message += ", last lines of output:\n" + "\n".join(tail)
+        raise Exception(message)
+
+    return True